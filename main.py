@@ -1,12 +1,10 @@
 import argparse, json, logging
 from pathlib import Path
 
-from scripts.database import init_db
-from scripts.data_processing import (download_sentinel_tiles_via_drive, download_mosaic_via_drive,)
-from scripts.ndvi_utils import batch_compute_ndvi
-from scripts.drive_sync import download_new_exports
-from scripts.backup import backup_artifacts
-from scripts.evaluation import evaluate_from_csv
+# Só dependências leves no topo: cada estágio importa as suas (ee, rasterio, TF, pydrive2...)
+# ao rodar, para que --backup, --make-labels, --help etc. iniciem rápido.
+# Orçamento de startup: python -m scripts.benchmark importtime
+from scripts.metrics import span, enable_profiling, write_metrics
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 
@@ -26,123 +24,304 @@ def main():
     ap.add_argument("--nowait", action="store_true", help="Não aguardar término das tarefas do GEE")
     ap.add_argument("--sync-drive", action="store_true")
     ap.add_argument("--ndvi", action="store_true")
+    ap.add_argument("--ndvi-stream", action="store_true", help="NDVI em janelas (memória constante para cenas grandes)")
+    ap.add_argument("--ndvi-format", choices=["float32", "int16"], default=None,
+                    help="Formato de saída do NDVI: float32 (LZW) ou int16 escalado em COG (padrão: cfg ndvi.format)")
+    ap.add_argument("--workers", type=int, default=1, help="Processos paralelos no --ndvi")
+    ap.add_argument("--force", action="store_true", help="Ignora o manifesto e recalcula todos os NDVI")
+    ap.add_argument("--cube", action="store_true", help="Anexa os NDVI novos ao datacube multi-data do AOI")
+    ap.add_argument("--change", action="store_true", help="Detecção de mudança no datacube (delta, queda máxima, data)")
+    ap.add_argument("--index", action="store_true", help="Atualiza o catálogo de footprints (data/raw, data/ndvi)")
+    ap.add_argument("--bbox", type=float, nargs=4, metavar=("W", "S", "E", "N"), default=None,
+                    help="Restringe predição/avaliação/dashboard aos tiles que intersectam o bbox (catálogo)")
+    ap.add_argument("--aoi", default=None, help="Idem, com um GeoJSON")
+    ap.add_argument("--since", default=None, help="Data de aquisição mínima (AAAA-MM-DD) do subconjunto")
+    ap.add_argument("--until", default=None, help="Data de aquisição máxima (AAAA-MM-DD) do subconjunto")
     ap.add_argument("--make-labels", action="store_true")
     ap.add_argument("--train", action="store_true")
+    ap.add_argument("--sweep", action="store_true",
+                    help="Busca de hiperparâmetros da CNN (cfg sweep) em processos paralelos; leaderboard em output/reports")
+    ap.add_argument("--sweep-workers", type=int, default=None, help="Processos do --sweep (padrão: núcleos / threads)")
     ap.add_argument("--predict", action="store_true")
+    ap.add_argument("--infer-batch-size", type=int, default=None,
+                    help="Tiles por lote no --predict (padrão: cnn.infer_batch_size ou 16). Lotes > 1 podem mudar o "
+                         "último bit de 'prob' (~1e-7) em relação ao predict por tile; 1 reproduz o CSV antigo bit a bit")
+    ap.add_argument("--export-tflite", action="store_true", help="Exporta o modelo para TFLite e compara com o Keras")
+    ap.add_argument("--quantize", action="store_true", help="Com --export-tflite: int8 calibrado em data/ndvi")
+    ap.add_argument("--backend", choices=["keras", "tflite"], default=None, help="Backend do --predict (padrão: cnn.backend)")
+    ap.add_argument("--heatmap", action="store_true", help="Mapa de probabilidade por janelas deslizantes (GeoTIFF)")
     ap.add_argument("--evaluate", action="store_true")
+    ap.add_argument("--eval-db", action="store_true", help="--evaluate lê a última execução do SQLite em vez do CSV")
     ap.add_argument("--backup", action="store_true")
+    ap.add_argument("--restore", default=None, metavar="SNAPSHOT", help="Restaura um snapshot do backup (id ou 'latest')")
+    ap.add_argument("--stats", action="store_true",
+                    help="Estatísticas por tile/zona dos NDVI existentes para o dashboard (--force recalcula todas)")
     ap.add_argument("--dashboard", action="store_true")
+    ap.add_argument("--no-cache", action="store_true", help="Não usar o cache de arrays pré-processados")
+    ap.add_argument("--clear-cache", action="store_true", help="Apaga o cache de arrays pré-processados")
+    ap.add_argument("--pipeline", action="store_true",
+                    help="Executa download/sync → NDVI → predição em streaming por tile (com --download parte do GEE)")
     ap.add_argument("--schedule", type=int, default=None, help="Agendar a cada N horas")
+    ap.add_argument("--daemon", action="store_true",
+                    help="Daemon quente: observa data/raw (NDVI + inferência dos novos), aquisição a cada --schedule "
+                         "horas (ou cfg daemon.interval_h) e status em http://127.0.0.1:<daemon.port>/status")
+    ap.add_argument("--profile", default="", help="Estágios a perfilar, separados por vírgula (ex.: ndvi,predict)")
+    ap.add_argument("--profiler", choices=["cprofile", "pyinstrument"], default="cprofile")
+    ap.add_argument("--metrics-dir", default="output/logs", help="Destino de metrics_*.jsonl e metrics.prom")
     args = ap.parse_args()
 
     cfg = load_cfg(args.config)
+    enable_profiling([s for s in args.profile.split(",") if s], args.profiler, args.metrics_dir)
+    try:
+        run_stages(args, cfg)
+    finally:
+        jl, prom = write_metrics(args.metrics_dir)
+        logging.info("Métricas: %s | %s", jl, prom)
+
+
+def run_stages(args, cfg):
     gee = cfg.get("gee", {})
     cnn = cfg.get("cnn", {})
 
+    if args.no_cache or args.clear_cache:
+        from scripts.ndvi_cache import configure, invalidate
+        if args.clear_cache: logging.info("Cache: %d entradas removidas", invalidate())
+        if args.no_cache: configure(None)
+
+    # Parâmetros do NDVI: os mesmos no pipeline, no hook por tile do download e no passo 3 (senão o manifesto recalcula)
+    ndvi_kw = {}
+    if args.ndvi or args.pipeline or args.daemon:
+        from scripts.ndvi_stats import zones_from_cfg
+        cube = None
+        if args.cube:
+            from scripts.datacube import cube_from_cfg
+            cube = cube_from_cfg(cfg)
+        ndvi_kw = dict(streaming=args.ndvi_stream, fmt=args.ndvi_format or cfg.get("ndvi", {}).get("format", "float32"),
+                       cube=cube, zones=zones_from_cfg(cfg))
+
+    # 0) Pipeline em streaming: substitui os passos 1a, 2, 3 e 6 sequenciais
+    if args.pipeline:
+        with span("pipeline"):
+            from scripts.pipeline import run_vigiai_pipeline
+            n = run_vigiai_pipeline(cfg, download=args.download, workers=cfg.get("pipeline"), **ndvi_kw)
+            logging.info("Pipeline: %s tiles inferidos", n)
+            args.download = args.sync_drive = args.ndvi = args.predict = False
+
     # 1a) Download (tiles)
     if args.download:
-        download_sentinel_tiles_via_drive(
-            aoi_geojson=gee.get("aoi_geojson"),
-            bbox=gee.get("bbox_approx"),
-            start_date=gee.get("start_date"),
-            end_date=gee.get("end_date"),
-            collection=gee.get("collection", "COPERNICUS/S2_SR_HARMONIZED"),
-            cloud_filter=int(gee.get("cloud_filter", 80)),
-            drive_folder=gee.get("drive_folder", "VigiAI"),
-            max_tiles=int(gee.get("max_tiles", 6)),
-            export_scale=int(gee.get("export_scale", 20)),
-            out_dir="data/raw",
-            wait_for_tasks=not args.nowait,
-        )
+        with span("download"):
+            from scripts.automation import make_tile_hook
+            from scripts.data_processing import download_sentinel_tiles_via_drive
+            download_sentinel_tiles_via_drive(
+                aoi_geojson=gee.get("aoi_geojson"),
+                bbox=gee.get("bbox_approx"),
+                start_date=gee.get("start_date"),
+                end_date=gee.get("end_date"),
+                collection=gee.get("collection", "COPERNICUS/S2_SR_HARMONIZED"),
+                cloud_filter=int(gee.get("cloud_filter", 80)),
+                drive_folder=gee.get("drive_folder", "VigiAI"),
+                max_tiles=int(gee.get("max_tiles", 6)),
+                export_scale=int(gee.get("export_scale", 20)),
+                out_dir="data/raw",
+                shard_deg=gee.get("shard_deg"),
+                max_active=gee.get("max_concurrent_tasks"),
+                wait_for_tasks=not args.nowait,
+                # com --sync-drive --ndvi, cada tile é baixado e processado assim que seu export termina
+                on_task_done=make_tile_hook(gee.get("drive_folder", "VigiAI"), db_path="data/db/ndvi_data.db", **ndvi_kw)
+                if args.sync_drive and args.ndvi else None,
+            )
 
     # 1b) Download (mosaico)
     if args.download_mosaic:
-        download_mosaic_via_drive(
-            aoi_geojson=gee.get("aoi_geojson"),
-            bbox=gee.get("bbox_approx"),
-            start_date=gee.get("start_date"),
-            end_date=gee.get("end_date"),
-            collection=gee.get("collection", "COPERNICUS/S2_SR_HARMONIZED"),
-            cloud_filter=int(gee.get("cloud_filter", 20)),
-            drive_folder=gee.get("drive_folder", "VigiAI"),
-            export_scale=int(gee.get("export_scale", 30)),
-            description="vigiai_tile_mosaic",
-            wait_for_task=not args.nowait,
-        )
+        with span("download_mosaic"):
+            from scripts.data_processing import download_mosaic_via_drive
+            download_mosaic_via_drive(
+                aoi_geojson=gee.get("aoi_geojson"),
+                bbox=gee.get("bbox_approx"),
+                start_date=gee.get("start_date"),
+                end_date=gee.get("end_date"),
+                collection=gee.get("collection", "COPERNICUS/S2_SR_HARMONIZED"),
+                cloud_filter=int(gee.get("cloud_filter", 20)),
+                drive_folder=gee.get("drive_folder", "VigiAI"),
+                export_scale=int(gee.get("export_scale", 30)),
+                description="vigiai_tile_mosaic",
+                wait_for_task=not args.nowait,
+            )
 
     # 2) Sincronizar Drive -> data/raw
     if args.sync_drive:
-        download_new_exports(
-            folder_name=gee.get("drive_folder", "VigiAI"),
-            local_dir="data/raw",
-            prefix="vigiai_tile_",
-            dry_run=False
-        )
+        with span("sync_drive"):
+            from scripts.drive_sync import download_new_exports, missing_exports
+            download_new_exports(
+                folder_name=gee.get("drive_folder", "VigiAI"),
+                local_dir="data/raw",
+                prefix="vigiai_tile_",
+                dry_run=False,
+                workers=int(gee.get("drive_workers", 4)),
+                db_path="data/db/ndvi_data.db",
+            )
+            missing = missing_exports("data/raw")
+            if missing:
+                logging.warning("Exports concluídos ainda ausentes em data/raw: %d (ex.: %s)", len(missing), missing[:3])
 
     # 3) NDVI
     if args.ndvi:
-        init_db("data/db/ndvi_data.db")
-        n = batch_compute_ndvi("data/raw", "data/ndvi", "data/processed")
-        logging.info("NDVI processados: %s", n)
+        with span("ndvi"):
+            from scripts.database import init_db
+            from scripts.ndvi_utils import batch_compute_ndvi
+            init_db("data/db/ndvi_data.db")
+            n = batch_compute_ndvi("data/raw", "data/ndvi", "data/processed", workers=args.workers,
+                                   db_path="data/db/ndvi_data.db", force=args.force, **ndvi_kw)
+            logging.info("NDVI processados: %s", n)
+
+    # 3a) Estatísticas dos NDVI já existentes (sem estatística ou alterados; --force recalcula, ex. zonas novas)
+    if args.stats:
+        with span("stats"):
+            from scripts.ndvi_stats import backfill_stats, zones_from_cfg
+            z = zones_from_cfg(cfg) or (None, "name")
+            n = backfill_stats("data/db/ndvi_data.db", "data/ndvi", z[0], z[1], force=args.force)
+            logging.info("Estatísticas de NDVI calculadas: %d", n)
+
+    # 3b) Mudança entre datas (datacube)
+    if args.change:
+        with span("change"):
+            from scripts.datacube import cube_from_cfg, detect_change
+            c = cfg.get("cube", {})
+            r = detect_change(cube_from_cfg(cfg), "output/change", c.get("start"), c.get("end"), float(c.get("min_drop", 0.2)))
+            logging.info("Mudança: %d datas (%s → %s)", len(r["dates"]), r["dates"][0], r["dates"][-1])
+
+    # 3c) Catálogo espacial: atualiza e seleciona o subconjunto (bbox/GeoJSON/datas)
+    subset = None
+    if args.index or args.bbox or args.aoi or args.since or args.until:
+        with span("catalog"):
+            from scripts.catalog import index_rasters, select_tiles
+            index_rasters("data/db/ndvi_data.db")
+            if args.bbox or args.aoi or args.since or args.until:
+                subset = select_tiles("data/db/ndvi_data.db", args.bbox, args.aoi, args.since, args.until)
+                logging.info("Catálogo: %d tiles no subconjunto", len(subset))
 
     # 4) labels.csv auxiliar
     if args.make_labels:
-        labels = Path("data/labels/labels.csv")
-        ndvi_dir = Path("data/ndvi")
-        lines = ["path,label"]
-        for f in sorted(ndvi_dir.glob("*_ndvi.tif")):
-            lines.append(f"{f.as_posix()},0")
-        labels.parent.mkdir(parents=True, exist_ok=True)
-        labels.write_text("\n".join(lines), encoding="utf-8")
-        print(f"[OK] labels.csv criado com {len(lines)-1} linhas em {labels}")
+        with span("make_labels"):
+            labels = Path("data/labels/labels.csv")
+            ndvi_dir = Path("data/ndvi")
+            lines = ["path,label"]
+            for f in sorted(ndvi_dir.glob("*_ndvi.tif")):
+                lines.append(f"{f.as_posix()},0")
+            labels.parent.mkdir(parents=True, exist_ok=True)
+            labels.write_text("\n".join(lines), encoding="utf-8")
+            print(f"[OK] labels.csv criado com {len(lines)-1} linhas em {labels}")
 
     # 5) Treino da CNN
     if args.train:
-        from scripts.cnn_model import train_cnn
-        train_cnn(
-            ndvi_dir="data/ndvi",
-            labels_csv="data/labels/labels.csv",
-            models_dir="models",
-            input_size=tuple(cnn.get("input_size", [128, 128])),
-            batch_size=int(cnn.get("batch_size", 16)),
-            epochs=int(cnn.get("epochs", 8)),
-            lr=float(cnn.get("learning_rate", 5e-4)),
-            augment=bool(cnn.get("augment", True)),
-        )
+        with span("train"):
+            from scripts.cnn_model import train_cnn
+            train_cnn(
+                ndvi_dir="data/ndvi",
+                labels_csv="data/labels/labels.csv",
+                models_dir="models",
+                input_size=tuple(cnn.get("input_size", [128, 128])),
+                batch_size=int(cnn.get("batch_size", 16)),
+                epochs=int(cnn.get("epochs", 8)),
+                lr=float(cnn.get("learning_rate", 5e-4)),
+                augment=bool(cnn.get("augment", True)),
+            )
+
+    # 5a) Busca de hiperparâmetros
+    if args.sweep:
+        with span("sweep"):
+            from scripts.sweep import run_sweep
+            rows = run_sweep(cfg, workers=args.sweep_workers)
+            ok = [r for r in rows if r["status"] != "failed"]
+            if ok:
+                logging.info("Sweep: melhor trial %d (val_acc=%.3f, val_loss=%.4f)", ok[0]["trial"],
+                             ok[0]["val_accuracy"], ok[0]["val_loss"])
+
+    # 5b) Exportação TFLite (+ paridade/latência contra o Keras)
+    if args.export_tflite:
+        with span("export_tflite"):
+            from scripts.tflite_model import export_tflite, compare_backends
+            out = export_tflite("models/modelo_final.h5", quantize=args.quantize,
+                                calib_samples=int(cnn.get("calib_samples", 200)), size=tuple(cnn.get("input_size", [128, 128])))
+            rep = compare_backends("models/modelo_final.h5", str(out), "data/ndvi", threads=cnn.get("tflite_threads"))
+            Path("output/reports").mkdir(parents=True, exist_ok=True)
+            Path("output/reports/tflite_parity.json").write_text(json.dumps(rep, indent=2), encoding="utf-8")
+            if not rep["ok"]:
+                logging.warning("TFLite diverge do Keras (concordância %.1f%%, |Δprob| máx %.4g)", 100 * rep["agreement"], rep["max_abs"])
 
     # 6) Inferência
     if args.predict:
-        from scripts.cnn_model import run_inference
-        run_inference(
-            model_path="models/modelo_final.h5",
-            ndvi_dir="data/ndvi",
-            out_csv="output/reports/resultados_queimadas.csv",
-            db_path="data/db/ndvi_data.db",
-        )
+        with span("predict"):
+            from scripts.cnn_model import run_inference
+            run_inference(
+                model_path="models/modelo_final.h5",
+                ndvi_dir="data/ndvi",
+                out_csv="output/reports/resultados_queimadas.csv",
+                db_path="data/db/ndvi_data.db",
+                batch_size=int(args.infer_batch_size or cnn.get("infer_batch_size", 16)),
+                backend=args.backend or cnn.get("backend", "keras"),
+                threads=cnn.get("tflite_threads"),
+                paths=subset,
+            )
+
+    # 6b) Mapa de calor por janelas
+    if args.heatmap:
+        with span("heatmap"):
+            from scripts.cnn_model import run_patch_inference
+            run_patch_inference(
+                model_path="models/modelo_final.h5",
+                ndvi_dir="data/ndvi",
+                out_dir="output/heatmaps",
+                stride=int(cnn.get("patch_stride", 64)),
+                batch_size=int(cnn.get("patch_batch_size", 256)),
+            )
 
     # 7) Avaliação
     if args.evaluate:
-        evaluate_from_csv(
-            "output/reports/resultados_queimadas.csv",
-            "data/labels/labels.csv",
-            out_dir="output/figures"
-        )
+        with span("evaluate"):
+            if args.eval_db:
+                from scripts.evaluation import evaluate_from_db
+                evaluate_from_db("data/db/ndvi_data.db", "data/labels/labels.csv", out_dir="output/figures", tiles=subset)
+            else:
+                from scripts.evaluation import evaluate_from_csv
+                evaluate_from_csv(
+                    "output/reports/resultados_queimadas.csv",
+                    "data/labels/labels.csv",
+                    out_dir="output/figures",
+                    tiles=subset,
+                )
 
     # 8) Backup
     if args.backup:
-        backup_artifacts()
+        with span("backup"):
+            from scripts.backup import backup_artifacts
+            bk = cfg.get("backup", {})
+            backup_artifacts(keep_daily=int(bk.get("keep_daily", 7)), keep_weekly=int(bk.get("keep_weekly", 4)))
+
+    if args.restore:
+        with span("restore"):
+            from scripts.backup import restore_snapshot
+            restore_snapshot(args.restore)
 
     # 9) Dash
     if args.dashboard:
-        from scripts.dashboard import build_dashboard
-        build_dashboard(
-            ndvi_dir="data/ndvi",
-            results_csv="output/reports/resultados_queimadas.csv",
-            out_html="output/reports/relatorio_final.html",
-        )
+        with span("dashboard"):
+            from scripts.dashboard import build_dashboard
+            build_dashboard(
+                ndvi_dir="data/ndvi",
+                results_csv="output/reports/resultados_queimadas.csv",
+                out_html="output/reports/relatorio_final.html",
+                paths=subset,
+                db_path="data/db/ndvi_data.db",
+                zones_geojson=cfg.get("stats", {}).get("zones_geojson"),
+                zone_field=cfg.get("stats", {}).get("zone_field", "name"),
+            )
 
     # 10) Agendamento
-    if args.schedule:
+    if args.daemon:
+        from scripts.daemon import run_daemon
+        run_daemon(cfg, interval_h=args.schedule, metrics_dir=args.metrics_dir, **ndvi_kw)
+    elif args.schedule:
         from scripts.automation import schedule_every
         schedule_every(int(args.schedule), cfg)
 
@@ -1,13 +1,41 @@
 from __future__ import annotations
 import schedule, time
 from pathlib import Path
-from .data_processing import download_sentinel_tiles_via_drive
-from .ndvi_utils import batch_compute_ndvi
-from .cnn_model import run_inference
+
+
+def make_tile_hook(drive_folder: str = "VigiAI", raw_dir: str = "data/raw", ndvi_dir: str = "data/ndvi",
+                   fmt: str = "float32", db_path: str | None = None, processed_dir: str = "data/processed", **ndvi_kw):
+    """
+    Hook por tarefa do EE: assim que o export de um tile termina, baixa só os arquivos
+    dele do Drive e calcula o NDVI desses arquivos (sem esperar os demais exports).
+    Passa pelo mesmo caminho do batch_compute_ndvi (manifesto, footprints, estatísticas, cubo),
+    então a passada completa seguinte pula os tiles que o hook já produziu.
+    """
+    from .drive_sync import download_new_exports
+    from .ndvi_utils import batch_compute_ndvi
+    if db_path:
+        from .database import init_db
+        init_db(db_path)
+
+    def _hook(task, status):
+        desc = status.get("description")
+        if status.get("state") != "COMPLETED" or not desc:
+            return
+        download_new_exports(folder_name=drive_folder, local_dir=raw_dir, prefix=desc)
+        tifs = sorted(Path(raw_dir).glob(f"{desc}*.tif"))
+        if tifs:
+            batch_compute_ndvi(raw_dir, ndvi_dir, processed_dir, db_path=db_path, fmt=fmt, paths=tifs, **ndvi_kw)
+    return _hook
 
 
 def run_once(cfg: dict):
+    from .data_processing import download_sentinel_tiles_via_drive
+    from .ndvi_utils import batch_compute_ndvi
+    from .cnn_model import run_inference
+    from .database import init_db
+    from .ndvi_stats import zones_from_cfg
     gee = cfg.get("gee", {})
+    fmt = cfg.get("ndvi", {}).get("format", "float32")
     download_sentinel_tiles_via_drive(
         aoi_geojson=gee.get("aoi_geojson"),
         bbox=gee.get("bbox_approx"),
@@ -19,9 +47,16 @@ def run_once(cfg: dict):
         max_tiles=int(gee.get("max_tiles", 6)),
         export_scale=int(gee.get("export_scale", 20)),
         out_dir="data/raw",
+        shard_deg=gee.get("shard_deg"),
+        max_active=gee.get("max_concurrent_tasks"),
         wait_for_tasks=True,
+        on_task_done=make_tile_hook(gee.get("drive_folder", "VigiAI"), fmt=fmt, db_path="data/db/ndvi_data.db",
+                                    zones=zones_from_cfg(cfg)),
     )
-    batch_compute_ndvi("data/raw", "data/ndvi", "data/processed")
+    init_db("data/db/ndvi_data.db")
+    # só o que o hook não processou (export que falhou no hook, arquivos já presentes em data/raw)
+    batch_compute_ndvi("data/raw", "data/ndvi", "data/processed", db_path="data/db/ndvi_data.db", fmt=fmt,
+                       zones=zones_from_cfg(cfg))
     run_inference("models/modelo_final.h5", "data/ndvi", "output/reports/resultados_queimadas.csv", "data/db/ndvi_data.db")
 
 
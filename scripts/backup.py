@@ -1,18 +1,190 @@
+"""
+Backup incremental com endereçamento por conteúdo.
+- Cada arquivo é lido em blocos de CHUNK bytes; cada bloco é guardado uma única vez em
+  backup/chunks/<aa>/<sha256>.<zst|gz> (zstd com o pacote zstandard, do requirements.txt; sem ele, gzip —
+  e restaurar blocos .zst exige o pacote).
+- Cada execução grava um snapshot backup/snapshots/<AAAAMMDD_HHMMSS_ffffff>.json com a lista de blocos por arquivo.
+- Arquivo inalterado → só a passada de hash; nenhum byte novo em disco.
+- Retenção: keep_daily / keep_weekly (mais recente de cada dia/semana) + coleta de blocos órfãos
+  (só blocos sem uso há GC_GRACE_S: um backup concorrente ainda sem snapshot não perde os seus).
+"""
+
 from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import shutil, datetime
+import datetime, gzip, hashlib, json, os, tempfile
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
+CHUNK = 4 << 20  # 4 MiB
+CHUNK_EXTS = ("zst", "gz")
+GC_GRACE_S = 3600  # blocos gravados/reutilizados há menos que isso não são coletados
+
+
+def _codec() -> str:
+    return "zst" if zstandard is not None else "gz"
+
+
+def _compress(data: bytes, codec: str) -> bytes:
+    return zstandard.ZstdCompressor(level=3).compress(data) if codec == "zst" else gzip.compress(data, 6)
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zst":
+        if zstandard is None: raise RuntimeError("Snapshot usa zstd; instale o pacote 'zstandard'.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def _atomic_write(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _chunk_path(store: Path, h: str) -> Path | None:
+    """Bloco existente (qualquer codec) ou None."""
+    for ext in CHUNK_EXTS:
+        p = store / "chunks" / h[:2] / f"{h}.{ext}"
+        if p.exists(): return p
+    return None
+
+
+def _store_file(src: Path, store: Path, codec: str, chunk: int = CHUNK) -> tuple[dict, int]:
+    """Divide/hasheia 'src' e grava só os blocos ainda ausentes. Retorna (entrada do manifesto, bytes novos)."""
+    whole, chunks, new = hashlib.sha256(), [], 0
+    with open(src, "rb") as f:
+        for buf in iter(lambda: f.read(chunk), b""):
+            whole.update(buf)
+            h = hashlib.sha256(buf).hexdigest()
+            chunks.append(h)
+            p = _chunk_path(store, h)
+            if p is None:
+                data = _compress(buf, codec)
+                _atomic_write(store / "chunks" / h[:2] / f"{h}.{codec}", data); new += len(data)
+            else:
+                os.utime(p)  # reutilizado: renova o prazo de carência da coleta
+    st = src.stat()
+    return {"path": src.as_posix(), "size": st.st_size, "mtime": st.st_mtime, "sha256": whole.hexdigest(), "chunks": chunks}, new
 
 
 def backup_artifacts(models_dir: str = "models",
                      reports_dir: str = "output/reports",
-                     backup_dir: str = "backup") -> int:
+                     backup_dir: str = "backup",
+                     files: list | None = None,
+                     keep_daily: int | None = 7,
+                     keep_weekly: int | None = 4) -> int:
+    """
+    Snapshot dos modelos e relatórios (ou de 'files') no repositório deduplicado em backup_dir
+    e aplica a retenção. Retorna o número de arquivos no snapshot.
+    """
     md, rd, bd = Path(models_dir), Path(reports_dir), Path(backup_dir)
-    bd.mkdir(parents=True, exist_ok=True)
-    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    copied = 0
-    for p in [md/"modelo_final.h5", md/"melhor_modelo.h5", rd/"resultados_queimadas.csv", rd/"metricas_modelo.txt"]:
+    if files is None:
+        files = [md/"modelo_final.h5", md/"melhor_modelo.h5", rd/"resultados_queimadas.csv", rd/"metricas_modelo.txt"]
+    codec = _codec()
+    entries, new = [], 0
+    for p in map(Path, files):
         if p.exists():
-            dst = bd / f"{p.stem}_{ts}{p.suffix}"
-            shutil.copy2(p, dst); copied += 1
-    print(f"[Backup] {copied} arquivos copiados para {bd}.")
-    return copied
+            e, n = _store_file(p, bd, codec); entries.append(e); new += n
+    now = datetime.datetime.now()
+    while (bd / "snapshots" / f"{now:%Y%m%d_%H%M%S_%f}.json").exists():  # ids únicos mesmo no mesmo segundo
+        now += datetime.timedelta(microseconds=1)
+    sid = now.strftime("%Y%m%d_%H%M%S_%f")
+    snap = {"id": sid, "created_at": now.isoformat(timespec="seconds"), "chunk": CHUNK, "files": entries}
+    _atomic_write(bd / "snapshots" / f"{sid}.json", json.dumps(snap, indent=1).encode("utf-8"))
+    total = sum(e["size"] for e in entries)
+    print(f"[Backup] Snapshot {sid}: {len(entries)} arquivos ({total/2**20:.1f} MB), "
+          f"{new/2**20:.2f} MB novos gravados ({codec}) em {bd}.")
+    if keep_daily is not None or keep_weekly is not None:
+        prune_snapshots(bd, keep_daily or 0, keep_weekly or 0)
+    return len(entries)
+
+
+def list_snapshots(backup_dir: str = "backup") -> list[dict]:
+    """Snapshots do mais antigo ao mais recente (id, created_at, nº de arquivos, tamanho lógico)."""
+    out = []
+    for p in sorted((Path(backup_dir) / "snapshots").glob("*.json")):
+        s = json.loads(p.read_text(encoding="utf-8"))
+        out.append({"id": s["id"], "created_at": s["created_at"], "files": len(s["files"]),
+                    "bytes": sum(f["size"] for f in s["files"])})
+    return out
+
+
+def prune_snapshots(backup_dir: str = "backup", keep_daily: int = 7, keep_weekly: int = 4, keep_last: int = 1) -> dict:
+    """
+    Mantém o snapshot mais recente de cada um dos últimos 'keep_daily' dias e 'keep_weekly' semanas
+    (ISO) que têm snapshot, além dos 'keep_last' mais novos; apaga o resto e os blocos sem referência.
+    """
+    bd = Path(backup_dir)
+    snaps = sorted((bd / "snapshots").glob("*.json"), reverse=True)  # mais novo primeiro
+    keep, days, weeks = set(snaps[:max(0, int(keep_last))]), [], []
+    for p in snaps:
+        ts = datetime.datetime.strptime(p.stem[:15], "%Y%m%d_%H%M%S")  # ids antigos não têm os microssegundos
+        d, w = ts.date(), ts.isocalendar()[:2]
+        if d not in days and len(days) < keep_daily: days.append(d); keep.add(p)
+        if w not in weeks and len(weeks) < keep_weekly: weeks.append(w); keep.add(p)
+    removed = [p for p in snaps if p not in keep]
+    for p in removed: p.unlink()
+    # coleta de lixo: blocos que nenhum snapshot restante referencia
+    live = set()
+    for p in keep:
+        for f in json.loads(p.read_text(encoding="utf-8"))["files"]:
+            live.update(f["chunks"])
+    freed, cutoff = 0, datetime.datetime.now().timestamp() - GC_GRACE_S
+    for c in (p for ext in CHUNK_EXTS for p in (bd / "chunks").glob(f"*/*.{ext}")):  # não os .tmp em gravação
+        st = c.stat()
+        if c.name.split(".")[0] not in live and st.st_mtime < cutoff:
+            freed += st.st_size; c.unlink(missing_ok=True)
+    if removed:
+        print(f"[Backup] Retenção: {len(removed)} snapshots removidos, {freed/2**20:.1f} MB liberados.")
+    return {"kept": len(keep), "removed": len(removed), "freed_bytes": freed}
+
+
+def _restore_file(e: dict, store: Path, dst: Path) -> bool:
+    """Reconstrói um arquivo a partir dos blocos (confere o sha256). False se o destino já era idêntico."""
+    if dst.exists() and dst.stat().st_size == e["size"]:
+        h = hashlib.sha256()
+        with open(dst, "rb") as f:
+            for buf in iter(lambda: f.read(CHUNK), b""): h.update(buf)
+        if h.hexdigest() == e["sha256"]: return False
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dst.parent, suffix=".restore")
+    h = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for c in e["chunks"]:
+                p = _chunk_path(store, c)
+                if p is None: raise FileNotFoundError(f"Bloco {c[:12]}… ausente no backup.")
+                buf = _decompress(p.read_bytes(), p.suffix[1:])
+                h.update(buf); out.write(buf)
+        if h.hexdigest() != e["sha256"]:
+            raise IOError(f"sha256 divergente ao restaurar {e['path']}")
+        os.replace(tmp, dst)
+    finally:
+        Path(tmp).unlink(missing_ok=True)
+    os.utime(dst, (e["mtime"], e["mtime"]))
+    return True
+
+
+def restore_snapshot(snapshot: str = "latest", backup_dir: str = "backup", dest: str = ".",
+                     files: list | None = None, workers: int = 4) -> int:
+    """
+    Restaura um snapshot (id ou 'latest') em dest/<caminho original>. 'files' filtra por caminho.
+    Arquivos já idênticos no destino não são reescritos. Retorna o número de arquivos restaurados.
+    """
+    bd = Path(backup_dir)
+    snaps = sorted((bd / "snapshots").glob("*.json"))
+    if not snaps: raise FileNotFoundError(f"Nenhum snapshot em {bd}.")
+    p = snaps[-1] if snapshot == "latest" else bd / "snapshots" / f"{snapshot}.json"
+    if not p.exists(): raise FileNotFoundError(f"Snapshot {snapshot} não encontrado em {bd}.")
+    entries = json.loads(p.read_text(encoding="utf-8"))["files"]
+    if files: entries = [e for e in entries if e["path"] in {Path(f).as_posix() for f in files}]
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as ex:
+        done = list(ex.map(lambda e: _restore_file(e, bd, Path(dest) / e["path"]), entries))
+    print(f"[Backup] Snapshot {p.stem}: {sum(done)} arquivos restaurados, {len(done) - sum(done)} já idênticos.")
+    return sum(done)
@@ -0,0 +1,410 @@
+"""
+Benchmarks offline do pipeline (sem GEE/Drive).
+Uso: python -m scripts.benchmark ndvi-workers --tiles 16 --size 2048 --workers 1 2 4 8
+     python -m scripts.benchmark inference --images 2000 --batch-sizes 1 16 64
+     python -m scripts.benchmark tflite --images 300 --batch-sizes 1 32
+     python -m scripts.benchmark ndvi-format --tiles 4 --size 2048 --reads 200
+     python -m scripts.benchmark suite --tiles 8 --size 1024 [--save-baseline | --threshold 0.2]
+     python -m scripts.benchmark importtime [--commands "--backup" "--make-labels"] [--budget-ms 250]
+"""
+
+from __future__ import annotations
+from pathlib import Path
+import argparse, json, os, shutil, tempfile, time
+import numpy as np
+
+
+def _synthetic_bands(rng, size: int) -> tuple:
+    """B4/B8 int16 com textura de floresta (campo suave + ruído) e algumas clareiras retangulares."""
+    k = max(1, size // 32)
+    field = np.kron(rng.random((-(-size // k), -(-size // k))), np.ones((k, k)))[:size, :size]
+    b8 = 2500 + 1500 * field + rng.normal(0, 150, (size, size))
+    b4 = 400 + 300 * (1 - field) + rng.normal(0, 60, (size, size))
+    for _ in range(int(rng.integers(1, 6))):  # clareiras: NIR cai, vermelho sobe
+        h, w = rng.integers(size // 32 + 1, size // 6 + 2, 2)
+        y, x = rng.integers(0, size - h + 1), rng.integers(0, size - w + 1)
+        b8[y:y+h, x:x+w] *= 0.45; b4[y:y+h, x:x+w] *= 2.2
+    return np.clip(b4, 0, 10000).astype("int16"), np.clip(b8, 0, 10000).astype("int16")
+
+
+def make_synthetic_tiles(out_dir: str | Path, n: int = 8, size: int = 1024, seed: int = 0) -> list[Path]:
+    """Gera 'n' GeoTIFFs int16 com 2 bandas (B4/B8), no mesmo layout dos exports do GEE (determinístico por seed)."""
+    import rasterio as rio
+    from rasterio.transform import from_origin
+    out = Path(out_dir); out.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(int(n)):
+        b4, b8 = _synthetic_bands(rng, size)
+        profile = {"driver": "GTiff", "height": size, "width": size, "count": 2, "dtype": "int16",
+                   "crs": "EPSG:4326", "transform": from_origin(-62.0 + i * 0.1, -2.0, 5e-4, 5e-4),
+                   "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "lzw"}
+        p = out / f"vigiai_tile_{i:04d}.tif"
+        with rio.open(p, "w", **profile) as ds:
+            ds.write(np.stack([b4, b8]))
+        paths.append(p)
+    return paths
+
+
+def bench_ndvi_workers(tiles: int = 16, size: int = 2048, workers=(1, 2, 4, 8), streaming: bool = False) -> list[dict]:
+    """Mede tiles/s do batch_compute_ndvi para cada número de workers."""
+    from .ndvi_utils import batch_compute_ndvi
+    tmp = Path(tempfile.mkdtemp(prefix="vigiai_bench_"))
+    try:
+        make_synthetic_tiles(tmp / "raw", tiles, size)
+        rows = []
+        for w in workers:
+            t0 = time.perf_counter()
+            n = batch_compute_ndvi(tmp / "raw", tmp / f"ndvi_{w}", tmp / "processed", streaming=streaming, workers=w)
+            dt = time.perf_counter() - t0
+            rows.append({"workers": w, "tiles": n, "seconds": round(dt, 3), "tiles_per_s": round(n / dt, 3)})
+        base = rows[0]["tiles_per_s"]
+        for r in rows:
+            r["speedup"] = round(r["tiles_per_s"] / base, 2)
+        return rows
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def make_synthetic_ndvi(out_dir: str | Path, n: int = 2000, size: int = 256, seed: int = 0) -> list[Path]:
+    """Gera 'n' NDVI float32 (1 banda, [-1, 1]) no formato de saída do compute_ndvi_from_tif."""
+    import rasterio as rio
+    from rasterio.transform import from_origin
+    out = Path(out_dir); out.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(int(n)):
+        arr = np.clip(rng.normal(0.6, 0.25, (size, size)), -1, 1).astype("float32")
+        profile = {"driver": "GTiff", "height": size, "width": size, "count": 1, "dtype": "float32",
+                   "crs": "EPSG:4326", "transform": from_origin(-62.0 + (i % 100) * 0.1, -2.0 - (i // 100) * 0.1, 5e-4, 5e-4),
+                   "compress": "lzw"}
+        p = out / f"vigiai_tile_{i:04d}_ndvi.tif"
+        with rio.open(p, "w", **profile) as ds:
+            ds.write(arr, 1)
+        paths.append(p)
+    return paths
+
+
+def bench_inference(n: int = 2000, size: int = 256, batch_sizes=(1, 16, 64), prefetch: int = 2, loaders: int = 2) -> list[dict]:
+    """images/s da inferência: laço antigo (m.predict por tile) vs. predict_paths em lotes com prefetch."""
+    from .cnn_model import build_cnn, predict_paths, _load_ndvi
+    tmp = Path(tempfile.mkdtemp(prefix="vigiai_bench_"))
+    try:
+        paths = make_synthetic_ndvi(tmp / "ndvi", n, size)
+        m = build_cnn(augment=False)
+        t0 = time.perf_counter()
+        ref = np.array([m.predict(_load_ndvi(p)[None, ...], verbose=0)[0][0] for p in paths], dtype="float32")
+        dt = time.perf_counter() - t0
+        rows = [{"mode": "per-image predict", "images": n, "seconds": round(dt, 3), "images_per_s": round(n / dt, 1)}]
+        for bs in batch_sizes:
+            t0 = time.perf_counter()
+            probs = predict_paths(m, paths, bs, prefetch, loaders)
+            dt = time.perf_counter() - t0
+            rows.append({"mode": f"batched bs={bs}", "images": n, "seconds": round(dt, 3), "images_per_s": round(n / dt, 1),
+                         "identical": bool(np.array_equal(ref, probs)), "max_abs_diff": float(np.abs(ref - probs).max())})
+        return rows
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def bench_tflite(n: int = 300, size: int = 256, batch_sizes=(1, 32), threads: int | None = None) -> list[dict]:
+    """Keras × TFLite float32 × TFLite int8 (calibrado nos próprios NDVI sintéticos): paridade e images/s."""
+    from .cnn_model import build_cnn
+    from .tflite_model import export_tflite, compare_backends
+    tmp = Path(tempfile.mkdtemp(prefix="vigiai_tfl_"))
+    try:
+        make_synthetic_ndvi(tmp / "ndvi", n, size)
+        h5 = tmp / "m.h5"; build_cnn(augment=False).save(str(h5))
+        rows = []
+        for quantize in (False, True):
+            tfl = export_tflite(str(h5), quantize=quantize, calib_dir=str(tmp / "ndvi"), calib_samples=100)
+            for bs in batch_sizes:
+                r = compare_backends(str(h5), str(tfl), str(tmp / "ndvi"), n, bs, threads)
+                rows.append({"model": "int8" if quantize else "float32", "kb": round(tfl.stat().st_size / 1024, 1), **r})
+        return rows
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def bench_ndvi_format(tiles: int = 4, size: int = 2048, reads: int = 200, window: int = 256,
+                      streaming: bool = False, seed: int = 0) -> list[dict]:
+    """
+    float32 (LZW, formato atual) × int16 COG (ZSTD, overviews) nos mesmos tiles sintéticos:
+    bytes em disco, tempo de escrita (NDVI + gravação), latência de leitura de janelas
+    aleatórias window² (abrindo o arquivo a cada leitura, como o dashboard) e de uma visão
+    reduzida 256² da cena inteira (zoom baixo), além do erro de quantização.
+    """
+    import rasterio as rio
+    from rasterio.windows import Window
+    from .ndvi_utils import compute_ndvi_from_tif, read_ndvi
+    tmp = Path(tempfile.mkdtemp(prefix="vigiai_fmt_"))
+    try:
+        raws = make_synthetic_tiles(tmp / "raw", tiles, size, seed)
+        rng = np.random.default_rng(seed)
+        picks = [(int(rng.integers(len(raws))), int(rng.integers(0, size - window + 1)), int(rng.integers(0, size - window + 1)))
+                 for _ in range(int(reads))]
+        rows, ref = [], {}
+        for fmt in ("float32", "int16"):
+            d = tmp / fmt; d.mkdir()
+            outs = [d / (r.stem + "_ndvi.tif") for r in raws]
+            t0 = time.perf_counter()
+            for r, o in zip(raws, outs):
+                compute_ndvi_from_tif(r, o, streaming=streaming, fmt=fmt)
+            write_s = time.perf_counter() - t0
+            lat = []
+            for i, x, y in picks:
+                t0 = time.perf_counter()
+                with rio.open(outs[i]) as ds:
+                    read_ndvi(ds, window=Window(x, y, window, window))
+                lat.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            for o in outs:
+                with rio.open(o) as ds:
+                    ds.read(1, out_shape=(256, 256))
+            ov_ms = 1000 * (time.perf_counter() - t0) / len(outs)
+            full = []
+            for o in outs:
+                with rio.open(o) as ds: full.append(read_ndvi(ds))
+            row = {"format": fmt, "mb": round(sum(o.stat().st_size for o in outs) / 2**20, 2),
+                   "write_s": round(write_s, 3), "read_ms_p50": round(1000 * float(np.median(lat)), 3),
+                   "read_ms_p95": round(1000 * float(np.percentile(lat, 95)), 3), "overview_ms": round(ov_ms, 2)}
+            if fmt == "float32":
+                ref = full
+            else:
+                row["max_abs_err"] = float(max(np.nanmax(np.abs(a - b)) for a, b in zip(ref, full)))
+                base = rows[0]
+                row.update(size_ratio=round(base["mb"] / row["mb"], 2), write_speedup=round(base["write_s"] / row["write_s"], 2),
+                           read_speedup=round(base["read_ms_p50"] / row["read_ms_p50"], 2))
+            rows.append(row)
+        return rows
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+# ---------- Suíte completa (com baseline) ----------
+
+# Cada estágio faz os imports/preparo (fora da medição) e devolve a função medida → nº de itens.
+
+def _stage_ndvi(work: str):
+    from .ndvi_utils import batch_compute_ndvi
+    w = Path(work)
+    return lambda: batch_compute_ndvi(w / "raw", w / "ndvi", w / "processed", force=True)
+
+
+def _stage_load_ndvi(work: str):
+    from .cnn_model import _decode_ndvi
+    paths = sorted((Path(work) / "ndvi").glob("*_ndvi.tif"))
+    def run():
+        for p in paths: _decode_ndvi(p)
+        return len(paths)
+    return run
+
+
+def _stage_inference(work: str):
+    from .ndvi_cache import configure
+    from .cnn_model import run_inference
+    configure(None)  # mede a decodificação real, não o cache
+    w = Path(work)
+    def run():
+        run_inference(str(w / "model.h5"), str(w / "ndvi"), str(w / "results.csv"), str(w / "bench.db"))
+        return len(list((w / "ndvi").glob("*_ndvi.tif")))
+    return run
+
+
+def _stage_dashboard(work: str):
+    from .dashboard import build_dashboard
+    w = Path(work)
+    shutil.rmtree(w / "report", ignore_errors=True)
+    def run():
+        build_dashboard(str(w / "ndvi"), str(w / "results.csv"), str(w / "report" / "index.html"))
+        return len(list((w / "ndvi").glob("*_ndvi.tif")))
+    return run
+
+
+def _stage_model(work: str):
+    from .cnn_model import build_cnn
+    import tensorflow as tf
+    tf.keras.utils.set_random_seed(0)
+    return lambda: build_cnn(augment=False).save(str(Path(work) / "model.h5")) or 1
+
+
+def _run_child(fn, work: str) -> dict:
+    from .metrics import peak_rss_bytes
+    t0 = time.perf_counter()
+    run = fn(work)
+    t1 = time.perf_counter()
+    n = run()
+    return {"seconds": time.perf_counter() - t1, "setup_seconds": round(t1 - t0, 4), "items": n,
+            "peak_rss_bytes": peak_rss_bytes()}  # processo novo por estágio: o pico é do estágio
+
+
+SUITE_STAGES = {"ndvi": _stage_ndvi, "load_ndvi": _stage_load_ndvi, "inference": _stage_inference, "dashboard": _stage_dashboard}
+
+
+def run_suite(tiles: int = 8, size: int = 1024, stages=None, repeat: int = 1, seed: int = 0) -> dict:
+    """
+    Gera tiles sintéticos + modelo com pesos aleatórios (mesma arquitetura do train_cnn) e mede
+    cada estágio num processo novo (pico de RSS isolado). Com repeat>1 fica o melhor tempo.
+    """
+    import multiprocessing as mp, platform
+    from concurrent.futures import ProcessPoolExecutor
+    stages = list(stages or SUITE_STAGES)
+    tmp = Path(tempfile.mkdtemp(prefix="vigiai_suite_"))
+    ctx = mp.get_context("spawn")
+    try:
+        make_synthetic_tiles(tmp / "raw", tiles, size, seed)
+        with ProcessPoolExecutor(1, mp_context=ctx) as ex:
+            ex.submit(_run_child, _stage_model, str(tmp)).result()
+        results = {}
+        for name in stages:
+            best = None
+            for _ in range(max(1, int(repeat))):
+                with ProcessPoolExecutor(1, mp_context=ctx) as ex:  # processo novo por medição
+                    r = ex.submit(_run_child, SUITE_STAGES[name], str(tmp)).result()
+                if best is None or r["seconds"] < best["seconds"]: best = r
+            best["items_per_s"] = round(best["items"] / best["seconds"], 3) if best["seconds"] > 0 else None
+            best["seconds"] = round(best["seconds"], 4)
+            results[name] = best
+            print(f"[Bench] {name:10s} {best['seconds']:8.3f}s  {best['items_per_s']} it/s  pico RSS {best['peak_rss_bytes']/2**20:.0f} MB")
+        return {"params": {"tiles": tiles, "size": size, "seed": seed, "repeat": repeat},
+                "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+                "ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "stages": results}
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def compare_to_baseline(results: dict, baseline: dict, threshold: float = 0.2, min_delta_s: float = 0.05) -> list:
+    """
+    Regressões (tempo ou pico de RSS) acima de 'threshold' (fração) em relação ao baseline.
+    Diferenças de tempo menores que min_delta_s são ignoradas (ruído em estágios muito curtos).
+    """
+    if results.get("params") != baseline.get("params"):
+        print("[Bench] Aviso: parâmetros diferentes do baseline; comparação pode não ser justa.")
+    regs = []
+    for name, r in results["stages"].items():
+        b = baseline.get("stages", {}).get(name)
+        if not b: continue
+        for key in ("seconds", "peak_rss_bytes"):
+            if key == "seconds" and r[key] - b.get(key, 0) < min_delta_s: continue
+            if b.get(key) and r[key] > b[key] * (1 + threshold):
+                regs.append({"stage": name, "metric": key, "baseline": b[key], "current": r[key],
+                             "change": round(r[key] / b[key] - 1, 3)})
+    return regs
+
+
+# ---------- Tempo de startup do CLI (python -X importtime) ----------
+
+# comando do main.py → orçamento de imports (ms); estágios leves não podem puxar ee/rasterio/TF
+IMPORT_BUDGET_MS = {"--help": 250, "--backup": 250, "--make-labels": 250, "--clear-cache": 400}
+_ROOT = Path(__file__).resolve().parent.parent
+
+
+def _parse_importtime(stderr: str) -> tuple:
+    """(ms cumulativos dos imports de 1º nível, {módulo: ms} dos mais caros)."""
+    total, mods = 0, {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line: continue
+        _, cum_us, name = line.split("|", 2)
+        if len(name) - len(name.lstrip()) == 1:  # 1º nível; filhos vêm indentados
+            total += int(cum_us); mods[name.strip()] = int(cum_us) / 1000
+    return total / 1000, dict(sorted(mods.items(), key=lambda kv: -kv[1])[:5])
+
+
+def bench_importtime(commands=None, repeat: int = 3, budget: dict | None = None) -> list[dict]:
+    """Roda 'python -X importtime main.py <cmd>' num diretório temporário e fica com a menor medição."""
+    import subprocess, sys
+    budget = {**IMPORT_BUDGET_MS, **(budget or {})}
+    rows = []
+    for cmd in commands or list(budget):
+        best = None
+        for _ in range(max(1, int(repeat))):
+            with tempfile.TemporaryDirectory(prefix="vigiai_imp_") as tmp:
+                t0 = time.perf_counter()
+                p = subprocess.run([sys.executable, "-X", "importtime", str(_ROOT / "main.py"), *cmd.split()],
+                                   cwd=tmp, capture_output=True, text=True)
+                wall = (time.perf_counter() - t0) * 1000
+            imp, top = _parse_importtime(p.stderr)
+            if best is None or imp < best["import_ms"]:
+                best = {"cmd": cmd, "import_ms": round(imp, 1), "wall_ms": round(wall, 1), "rc": p.returncode, "top": top}
+        best["budget_ms"] = budget.get(cmd)
+        best["ok"] = best["rc"] == 0 and (best["budget_ms"] is None or best["import_ms"] <= best["budget_ms"])
+        rows.append(best)
+    return rows
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="VigiAI benchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("ndvi-workers", help="Escalonamento do NDVI com o número de processos")
+    p.add_argument("--tiles", type=int, default=16)
+    p.add_argument("--size", type=int, default=2048)
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    p.add_argument("--stream", action="store_true")
+    p = sub.add_parser("inference", help="images/s da inferência (antes/depois do batching)")
+    p.add_argument("--images", type=int, default=2000)
+    p.add_argument("--size", type=int, default=256)
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 64])
+    p = sub.add_parser("tflite", help="Paridade e images/s: Keras × TFLite (float32/int8)")
+    p.add_argument("--images", type=int, default=300)
+    p.add_argument("--size", type=int, default=256)
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32])
+    p.add_argument("--threads", type=int, default=None)
+    p = sub.add_parser("ndvi-format", help="Tamanho, escrita e leitura: NDVI float32 × int16 COG")
+    p.add_argument("--tiles", type=int, default=4)
+    p.add_argument("--size", type=int, default=2048)
+    p.add_argument("--reads", type=int, default=200)
+    p.add_argument("--window", type=int, default=256)
+    p.add_argument("--stream", action="store_true")
+    p = sub.add_parser("suite", help="Todos os estágios + comparação com baseline")
+    p.add_argument("--tiles", type=int, default=8)
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--stages", nargs="+", choices=list(SUITE_STAGES), default=None)
+    p.add_argument("--repeat", type=int, default=1)
+    p.add_argument("--out", default="output/bench/results.json")
+    p.add_argument("--baseline", default="output/bench/baseline.json")
+    p.add_argument("--threshold", type=float, default=0.2, help="Regressão tolerada (fração, ex.: 0.2 = 20%%)")
+    p.add_argument("--save-baseline", action="store_true")
+    p = sub.add_parser("importtime", help="Tempo de import do main.py por comando, com orçamento")
+    p.add_argument("--commands", nargs="+", default=None, help='Ex.: "--backup" "--make-labels"')
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--budget-ms", type=float, default=None, help="Orçamento único para todos os comandos")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "ndvi-workers":
+        for r in bench_ndvi_workers(args.tiles, args.size, args.workers, args.stream):
+            print(json.dumps(r))
+    elif args.cmd == "inference":
+        for r in bench_inference(args.images, args.size, args.batch_sizes):
+            print(json.dumps(r))
+    elif args.cmd == "tflite":
+        for r in bench_tflite(args.images, args.size, args.batch_sizes, args.threads):
+            print(json.dumps(r))
+    elif args.cmd == "ndvi-format":
+        for r in bench_ndvi_format(args.tiles, args.size, args.reads, args.window, args.stream):
+            print(json.dumps(r))
+    elif args.cmd == "importtime":
+        cmds = args.commands or list(IMPORT_BUDGET_MS)
+        budget = {c: args.budget_ms for c in cmds} if args.budget_ms is not None else None
+        rows = bench_importtime(cmds, args.repeat, budget)
+        for r in rows:
+            print(f"[Bench] {r['cmd']:16s} imports {r['import_ms']:7.1f} ms (orçamento {r['budget_ms']}) "
+                  f"total {r['wall_ms']:7.1f} ms  {'OK' if r['ok'] else 'ESTOUROU'}  {r['top']}")
+        if not all(r["ok"] for r in rows): raise SystemExit(1)
+    elif args.cmd == "suite":
+        res = run_suite(args.tiles, args.size, args.stages, args.repeat)
+        out = Path(args.out); out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps(res, indent=2), encoding="utf-8")
+        base = Path(args.baseline)
+        if args.save_baseline:
+            base.parent.mkdir(parents=True, exist_ok=True); shutil.copyfile(out, base)
+            print(f"[Bench] Baseline salvo em {base}")
+        elif base.exists():
+            regs = compare_to_baseline(res, json.loads(base.read_text(encoding="utf-8")), args.threshold)
+            for r in regs:
+                print(f"[Bench] REGRESSÃO {r['stage']}.{r['metric']}: {r['baseline']} -> {r['current']} (+{r['change']:.0%})")
+            if regs: raise SystemExit(1)
+            print("[Bench] Sem regressões acima do limite.")
+
+
+if __name__ == "__main__":
+    main()
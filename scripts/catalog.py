@@ -0,0 +1,105 @@
+"""
+Catálogo de footprints dos rasters (tabela footprints + R*Tree em data/db/ndvi_data.db).
+- record_footprints: chamado quando rasters brutos/NDVI são gravados (drive_sync, batch_compute_ndvi, pipeline).
+- index_rasters: indexa/atualiza diretórios inteiros (só abre arquivos novos ou alterados).
+- select_tiles: tiles que intersectam um bbox/GeoJSON num intervalo de datas, sem abrir os GeoTIFFs.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+import json, logging
+from .database import init_db, upsert_footprints, delete_footprints, load_footprints, query_footprints
+
+log = logging.getLogger(__name__)
+
+
+def footprint_of(tif: str | Path, kind: str, src: str | Path | None = None) -> dict:
+    """Metadados do raster para o catálogo; bounds sempre em EPSG:4326."""
+    import rasterio as rio
+    from rasterio.warp import transform_bounds
+    from .datacube import scene_date
+    tif = Path(tif)
+    with rio.open(tif) as ds:
+        bounds = transform_bounds(ds.crs, "EPSG:4326", *ds.bounds) if ds.crs else tuple(ds.bounds)
+        crs = ds.crs.to_string() if ds.crs else None
+        res, w, h = ds.res, ds.width, ds.height
+    return {"path": tif.as_posix(), "kind": kind, "crs": crs, "res_x": float(res[0]), "res_y": float(res[1]),
+            "width": int(w), "height": int(h), "acq_date": scene_date(src or tif),
+            "src_path": Path(src).as_posix() if src else None, "mtime_ns": tif.stat().st_mtime_ns, "bounds": list(bounds)}
+
+
+def record_footprints(db_path: str | None, tifs, kind: str, srcs=None):
+    """Registra (upsert) os rasters recém-gravados; falha de leitura vira aviso, não interrompe o estágio."""
+    if not db_path: return 0
+    tifs = list(tifs); srcs = list(srcs) if srcs is not None else [None] * len(tifs)
+    entries = []
+    for tif, src in zip(tifs, srcs):
+        try:
+            entries.append(footprint_of(tif, kind, src))
+        except Exception as e:
+            log.warning("[Catálogo] %s não indexado: %s", Path(tif).name, e)
+    upsert_footprints(db_path, entries)
+    return len(entries)
+
+
+def index_rasters(db_path: str, raw_dir: str | None = "data/raw", ndvi_dir: str | None = "data/ndvi") -> dict:
+    """Sincroniza o catálogo com os diretórios: indexa novos/alterados (mtime) e remove os que sumiram."""
+    init_db(db_path)
+    out = {}
+    for kind, d, pattern in (("raw", raw_dir, "*.tif"), ("ndvi", ndvi_dir, "*_ndvi.tif")):
+        if not d: continue
+        known = load_footprints(db_path, kind)
+        files = sorted(Path(d).glob(pattern))
+        if kind == "raw": files = [f for f in files if not f.name.endswith("_ndvi.tif")]
+        cur = {f.as_posix(): f for f in files}
+        todo = [f for k, f in cur.items() if k not in known or known[k]["mtime_ns"] != f.stat().st_mtime_ns]
+        srcs = None
+        if kind == "ndvi" and raw_dir:
+            srcs = [next(iter(sorted(Path(raw_dir).glob(f.name[:-len("_ndvi.tif")] + ".tif*"))), None) for f in todo]
+        n = record_footprints(db_path, todo, kind, srcs)
+        base = Path(d).as_posix()
+        gone = [k for k in known if k not in cur and Path(k).parent.as_posix() == base]  # só os deste diretório
+        delete_footprints(db_path, gone)
+        out[kind] = {"indexed": n, "removed": len(gone), "total": len(cur)}
+    log.info("[Catálogo] %s", out)
+    return out
+
+
+def geojson_bbox(geojson) -> tuple:
+    """bbox (W, S, E, N) de um GeoJSON (arquivo, dict, Feature/FeatureCollection/Geometry)."""
+    if isinstance(geojson, (str, Path)):
+        geojson = json.loads(Path(geojson).read_text(encoding="utf-8"))
+    xs, ys = [], []
+
+    def _walk(c):
+        if isinstance(c, (list, tuple)) and c and isinstance(c[0], (int, float)):
+            xs.append(float(c[0])); ys.append(float(c[1]))
+        elif isinstance(c, (list, tuple)):
+            for v in c: _walk(v)
+
+    def _geom(g):
+        if not g: return
+        t = g.get("type")
+        if t == "FeatureCollection":
+            for f in g.get("features", []): _geom(f)
+        elif t == "Feature": _geom(g.get("geometry"))
+        elif t == "GeometryCollection":
+            for gg in g.get("geometries", []): _geom(gg)
+        else: _walk(g.get("coordinates"))
+
+    _geom(geojson)
+    if not xs: raise ValueError("GeoJSON sem coordenadas.")
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def select_tiles(db_path: str, bbox=None, geojson=None, start: str | None = None, end: str | None = None,
+                 kind: str = "ndvi") -> list[Path]:
+    """
+    Caminhos dos rasters que intersectam bbox (ou o retângulo do GeoJSON) no intervalo de datas,
+    só os que ainda existem em disco. O teste é pelos retângulos do R*Tree.
+    """
+    if geojson is not None:
+        gb = geojson_bbox(geojson)
+        bbox = gb if bbox is None else (max(bbox[0], gb[0]), max(bbox[1], gb[1]), min(bbox[2], gb[2]), min(bbox[3], gb[3]))
+    rows = query_footprints(db_path, bbox, start, end, kind)
+    return [Path(r["path"]) for r in rows if Path(r["path"]).exists()]
@@ -1,37 +1,34 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import hashlib, json, queue, threading
 import numpy as np, pandas as pd, rasterio as rio, cv2
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report
-import tensorflow as tf
-from tensorflow.keras import layers, models, callbacks, optimizers
+from rasterio.windows import Window
 from tqdm import tqdm
+from .ndvi_cache import load_cached
+from .ndvi_utils import read_ndvi
+from .metrics import span
+from .database import init_db, start_run, finish_run, insert_predictions
 
+# TensorFlow/sklearn são importados dentro das funções que os usam: a inferência com
+# backend="tflite" roda só com o interpretador (sem carregar o TF inteiro).
 
-def _load_ndvi(path: Path, size=(128,128)) -> np.ndarray:
+
+def _decode_ndvi(path: Path, size=(128,128)) -> np.ndarray:
     with rio.open(path) as ds:
-        ndvi = ds.read(1).astype("float32")
+        ndvi = read_ndvi(ds)
     img = (ndvi + 1.0) / 2.0
     img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
     return img[...,None]
 
 
-def train_cnn(ndvi_dir: str, labels_csv: str, models_dir: str,
-              input_size=(128,128), batch_size=16, epochs=8, lr=5e-4, augment=True):
-    models_path = Path(models_dir); models_path.mkdir(parents=True, exist_ok=True)
-    df = pd.read_csv(labels_csv, comment="#").dropna()
-    X, y = [], []
-    
-    for _, row in tqdm(df.iterrows(), total=len(df)):
-        p = Path(row["path"])
-        if not p.is_absolute(): p = Path(ndvi_dir)/Path(row["path"]).name
-        if not p.exists(): continue
-        X.append(_load_ndvi(p, input_size))
-        y.append(int(row["label"]))
-    X = np.array(X, dtype="float32"); y = np.array(y, dtype="int32")
+def _load_ndvi(path: Path, size=(128,128)) -> np.ndarray:
+    """NDVI normalizado/redimensionado para a CNN, via cache em disco (mmap) quando habilitado."""
+    return load_cached(path, tuple(size), "cnn", lambda: _decode_ndvi(path, size))
 
-    if len(X) < 4: print("[WARN] Poucos exemplos em labels.csv.")
-    Xtr, Xva, ytr, yva = train_test_split(X, y, test_size=0.25, random_state=42, stratify=y if len(np.unique(y))>1 else None)
 
+def build_cnn(input_size=(128,128), lr=5e-4, augment=True):
+    import tensorflow as tf
+    from tensorflow.keras import layers, models, optimizers
     aug = tf.keras.Sequential([layers.RandomFlip("horizontal"), layers.RandomRotation(0.05)]) if augment else (lambda z: z)
     inp = layers.Input(shape=(input_size[1], input_size[0], 1)); x = aug(inp)
     x = layers.Conv2D(16,3,activation="relu",padding="same")(x); x = layers.MaxPool2D()(x)
@@ -40,28 +37,249 @@ def train_cnn(ndvi_dir: str, labels_csv: str, models_dir: str,
     x = layers.Dense(64,activation="relu")(x); out = layers.Dense(1,activation="sigmoid")(x)
     model = models.Model(inp,out)
     model.compile(optimizer=optimizers.Adam(learning_rate=lr), loss="binary_crossentropy", metrics=["accuracy"])
+    return model
+
+
+def _labelled_paths(labels_csv: str, ndvi_dir: str) -> tuple[list, np.ndarray]:
+    """Lê labels.csv (path,label) e resolve caminhos relativos em ndvi_dir; ignora arquivos ausentes."""
+    df = pd.read_csv(labels_csv, comment="#").dropna()
+    paths, y = [], []
+    for row in df.itertuples(index=False):
+        p = Path(row.path)
+        if not p.is_absolute(): p = Path(ndvi_dir)/Path(row.path).name
+        if not p.exists(): continue
+        paths.append(str(p)); y.append(int(row.label))
+    return paths, np.array(y, dtype="int32")
+
+
+def make_dataset(paths, labels, input_size=(128,128), batch_size=16, shuffle_buffer=0, cache_file=None):
+    """
+    tf.data: decodifica os NDVI sob demanda (map paralelo), guarda os tensores já
+    redimensionados em disco no 1º epoch (cache), embaralha com buffer limitado e faz prefetch.
+    """
+    import tensorflow as tf
+    w, h = int(input_size[0]), int(input_size[1])
+
+    def _load(p):
+        return _load_ndvi(Path(p.decode()), (w, h)).astype("float32")
+
+    def _map(p, lab):
+        img = tf.numpy_function(_load, [p], tf.float32)
+        img.set_shape((h, w, 1))
+        return img, lab
+
+    ds = tf.data.Dataset.from_tensor_slices((list(paths), np.asarray(labels, dtype="int32")))
+    ds = ds.map(_map, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    if cache_file is not None:
+        Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+        ds = ds.cache(str(cache_file))
+    if shuffle_buffer:
+        ds = ds.shuffle(int(shuffle_buffer), seed=42, reshuffle_each_iteration=True)
+    return ds.batch(int(batch_size)).prefetch(tf.data.AUTOTUNE)
+
+
+def _cache_file(cache_dir, split: str, paths, labels, input_size) -> Path:
+    """
+    Nome do cache depende da lista (path,label), do mtime de cada NDVI e do tamanho → nunca reaproveita
+    cache de outro conjunto nem de NDVI regenerado (--ndvi --force), como no ndvi_cache.
+    """
+    versioned = [f"{p}@{Path(p).stat().st_mtime_ns}" for p in paths]
+    key = hashlib.sha1(json.dumps([versioned, [int(v) for v in labels], list(input_size)]).encode()).hexdigest()[:12]
+    return Path(cache_dir) / f"{split}_{input_size[0]}x{input_size[1]}_{key}"
+
+
+def train_cnn(ndvi_dir: str, labels_csv: str, models_dir: str,
+              input_size=(128,128), batch_size=16, epochs=8, lr=5e-4, augment=True,
+              cache_dir: str|None = "data/cache/tfdata", shuffle_buffer: int = 1024):
+    from tensorflow.keras import callbacks
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import classification_report
+    models_path = Path(models_dir); models_path.mkdir(parents=True, exist_ok=True)
+    paths, y = _labelled_paths(labels_csv, ndvi_dir)
+
+    if len(paths) < 4: print("[WARN] Poucos exemplos em labels.csv.")
+    # split estratificado sobre (path, label): mesma semântica do antigo split sobre (X, y)
+    ptr, pva, ytr, yva = train_test_split(paths, y, test_size=0.25, random_state=42, stratify=y if len(np.unique(y))>1 else None)
+    cf = (lambda split, p, lab: _cache_file(cache_dir, split, p, lab, input_size)) if cache_dir else (lambda *a: None)
+    ds_tr = make_dataset(ptr, ytr, input_size, batch_size, shuffle_buffer, cf("train", ptr, ytr))
+    ds_va = make_dataset(pva, yva, input_size, batch_size, 0, cf("val", pva, yva))
+
+    model = build_cnn(input_size, lr, augment)
 
     ck = callbacks.ModelCheckpoint(str(models_path/"melhor_modelo.h5"), save_best_only=True, monitor="val_accuracy", mode="max")
     es = callbacks.EarlyStopping(patience=5, restore_best_weights=True)
-    model.fit(Xtr, ytr, validation_data=(Xva,yva), epochs=epochs, batch_size=batch_size, callbacks=[ck,es], verbose=2)
+    model.fit(ds_tr, validation_data=ds_va, epochs=epochs, callbacks=[ck,es], verbose=2)
     model.save(models_path/"modelo_final.h5")
 
-    if len(Xva):
-        ypred = (model.predict(Xva, verbose=0) > 0.5).astype("int32").ravel()
+    if len(pva):
+        ypred = (model.predict(ds_va, verbose=0) > 0.5).astype("int32").ravel()
         rep = classification_report(yva, ypred, digits=3)
         Path("output/reports").mkdir(parents=True, exist_ok=True)
         (Path("output/reports")/"metricas_modelo.txt").write_text(rep, encoding="utf-8")
         print(rep)
 
 
-def run_inference(model_path: str, ndvi_dir: str, out_csv: str, db_path: str):
-    import pandas as pd, sqlite3
-    m = tf.keras.models.load_model(model_path, compile=False)
-    paths = sorted(Path(ndvi_dir).glob("*_ndvi.tif"))
-    rows = []
-    for p in paths:
-        img = _load_ndvi(p)
-        prob = float(m.predict(img[None,...], verbose=0)[0][0])
-        rows.append({"path": str(p), "prob": prob, "pred": int(prob>0.5)})
+def _prefetch_batches(paths, batch_size: int, prefetch: int, loaders: int, size=(128,128)):
+    """
+    Gera (paths_do_lote, X) decodificando/redimensionando em uma thread de fundo
+    enquanto o lote anterior está no modelo. Fila limitada a 'prefetch' lotes.
+    """
+    q = queue.Queue(maxsize=max(1, int(prefetch)))
+    stop = threading.Event()
+    END = object()
+
+    def _producer():
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, int(loaders))) as ex:
+                for i in range(0, len(paths), batch_size):
+                    if stop.is_set(): return
+                    chunk = paths[i:i+batch_size]
+                    q.put((chunk, np.stack(list(ex.map(lambda p: _load_ndvi(p, size), chunk)))))
+            q.put(END)
+        except Exception as e:  # repassa o erro para a thread principal
+            q.put(e)
+
+    th = threading.Thread(target=_producer, name="ndvi-prefetch", daemon=True); th.start()
+    try:
+        while True:
+            item = q.get()
+            if item is END: break
+            if isinstance(item, Exception): raise item
+            yield item
+    finally:
+        stop.set()
+        while th.is_alive():  # libera o produtor se ele estiver bloqueado no put()
+            try: q.get_nowait()
+            except queue.Empty: th.join(0.05)
+
+
+def predict_paths(m, paths, batch_size: int = 16, prefetch: int = 2, loaders: int = 2, size=(128,128)) -> np.ndarray:
+    """
+    Probabilidades (float32) para cada NDVI, em lotes, na mesma ordem de 'paths'.
+    Lotes (padrão 16, como no pipeline e no daemon) são mais rápidos, mas o blocking do GEMM no CPU
+    pode mudar o último bit (~1e-7) de 'prob'; batch_size=1 reproduz bit a bit o antigo m.predict por tile.
+    """
+    probs = np.empty(len(paths), dtype="float32")
+    k = 0
+    for chunk, X in tqdm(_prefetch_batches(list(paths), int(batch_size), prefetch, loaders, size),
+                         total=-(-len(paths) // int(batch_size)), desc="Inferência"):
+        probs[k:k+len(chunk)] = np.asarray(m.predict_on_batch(X)).reshape(-1)
+        k += len(chunk)
+    return probs
+
+
+def load_model(model_path: str, backend: str = "keras", threads: int | None = None):
+    """
+    Modelo com predict_on_batch(X): Keras (.h5) ou TFLite (.tflite; com backend="tflite" e um .h5,
+    usa o .tflite exportado ao lado, ver tflite_model.export_tflite).
+    """
+    if backend == "tflite":
+        from .tflite_model import TFLiteModel, tflite_path_for
+        return TFLiteModel(tflite_path_for(model_path), threads=threads)
+    if backend != "keras":
+        raise ValueError(f"Backend desconhecido: {backend!r} (use 'keras' ou 'tflite').")
+    import tensorflow as tf
+    return tf.keras.models.load_model(model_path, compile=False)
+
+
+def run_inference(model_path: str, ndvi_dir: str, out_csv: str, db_path: str,
+                  batch_size: int = 16, prefetch: int = 2, loaders: int = 2, backend: str = "keras",
+                  threads: int | None = None, paths=None):
+    """Prediz todos os NDVI de ndvi_dir, ou só 'paths' (ex.: subconjunto do catálogo, catalog.select_tiles)."""
+    m = load_model(model_path, backend, threads)
+    paths = sorted(Path(ndvi_dir).glob("*_ndvi.tif")) if paths is None else sorted(Path(p) for p in paths)
+    with span("inference", items=len(paths)):
+        probs = predict_paths(m, paths, batch_size, prefetch, loaders)
+    rows = [{"path": str(p), "prob": float(prob), "pred": int(prob>0.5)} for p, prob in zip(paths, probs)]
     df = pd.DataFrame(rows); out = Path(out_csv); out.parent.mkdir(parents=True, exist_ok=True); df.to_csv(out, index=False, encoding="utf-8")
-    con = sqlite3.connect(db_path); df.to_sql("predictions", con, if_exists="replace", index=False); con.close()
+    init_db(db_path)
+    run_id = start_run(db_path, model_path=model_path if backend == "keras" else f"{model_path} ({backend})", source=str(ndvi_dir))
+    finish_run(db_path, run_id, insert_predictions(db_path, run_id, rows))
+
+
+def merge_results_csv(out_csv, rows: list):
+    """Atualiza só as linhas destes tiles no CSV de resultados (o dashboard lê dele); gravação atômica."""
+    import os
+    out = Path(out_csv)
+    new = pd.DataFrame(rows)
+    if out.exists():
+        old = pd.read_csv(out)
+        new = pd.concat([old[~old["path"].isin(new["path"])], new], ignore_index=True).sort_values("path")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_name(out.name + ".tmp")
+    new.to_csv(tmp, index=False, encoding="utf-8"); os.replace(tmp, out)
+
+
+# ---------- Inferência por janelas deslizantes (mapa de calor) ----------
+
+def _offsets(n: int, patch: int, stride: int) -> list:
+    """Inícios das janelas ao longo de um eixo; a última encosta na borda."""
+    if n <= patch: return [0]
+    offs = list(range(0, n - patch + 1, stride))
+    if offs[-1] != n - patch: offs.append(n - patch)
+    return offs
+
+
+def _iter_patches(ds, y: int, ph: int, xs: list, patch: int, batch_size: int):
+    """
+    Gera (xs_do_lote, X, válidos) para a faixa de linhas [y, y+ph), lendo só essa faixa do raster.
+    Sem dado (NaN, ex.: nodata do int16) entra no modelo como NDVI 0 e sai em 'válidos' (máscara por janela);
+    janelas sem nenhum pixel válido são puladas.
+    """
+    strip = read_ndvi(ds, window=Window(0, y, ds.width, ph))
+    valid = ~np.isnan(strip)
+    strip = (np.where(valid, strip, 0.0) + 1.0) / 2.0
+    if strip.shape[0] < patch or strip.shape[1] < patch:  # cena menor que a janela
+        pad = ((0, max(0, patch - strip.shape[0])), (0, max(0, patch - strip.shape[1])))
+        strip, valid = np.pad(strip, pad, mode="edge"), np.pad(valid, pad, mode="edge")
+    xs = [x for x in xs if valid[:patch, x:x+patch].any()]
+    for i in range(0, len(xs), batch_size):
+        chunk = xs[i:i+batch_size]
+        yield (chunk, np.stack([strip[:patch, x:x+patch] for x in chunk])[..., None],
+               np.stack([valid[:patch, x:x+patch] for x in chunk]))
+
+
+def _blend_weights(patch: int) -> np.ndarray:
+    """Peso piramidal: o centro da janela domina, bordas ainda contam (>0)."""
+    w = np.minimum(np.arange(1, patch + 1), np.arange(patch, 0, -1)).astype("float32")
+    return np.outer(w, w) / w.max() ** 2
+
+
+def predict_heatmap(m, ndvi_path: Path, out_tif: Path, stride: int = 64, batch_size: int = 256) -> None:
+    """
+    Varre o NDVI em resolução nativa com janelas do tamanho da entrada do modelo e grava
+    a probabilidade mesclada (média ponderada nas sobreposições) num GeoTIFF com o mesmo
+    transform/CRS. Memória ~ janela x largura da cena: as linhas já finalizadas são
+    gravadas e o acumulador desliza para baixo. Pixels sem NDVI não entram no peso da mescla
+    e saem como nodata (NaN).
+    """
+    patch = int(m.input_shape[1]); stride = max(1, min(int(stride), patch))
+    wgt = _blend_weights(patch)
+    with rio.open(ndvi_path) as ds:
+        H, W = ds.height, ds.width
+        ys, xs = _offsets(H, patch, stride), _offsets(W, patch, stride)
+        profile = {"driver":"GTiff","height":H,"width":W,"count":1,"dtype":"float32","crs":ds.crs,"transform":ds.transform,"compress":"lzw","nodata":float("nan")}
+        acc = np.zeros((patch, max(W, patch)), "float32"); wt = np.zeros_like(acc)
+        with rio.open(out_tif, "w", **profile) as dst:
+            for i, y in enumerate(ys):
+                ph = min(patch, H - y)
+                for chunk, X, V in _iter_patches(ds, y, ph, xs, patch, batch_size):
+                    probs = np.asarray(m.predict_on_batch(X)).reshape(-1)
+                    for x, p, v in zip(chunk, probs, V):
+                        w = wgt * v
+                        acc[:, x:x+patch] += p * w; wt[:, x:x+patch] += w
+                n = (ys[i+1] if i + 1 < len(ys) else H) - y  # linhas que nenhuma janela futura toca
+                a, b = acc[:n, :W], wt[:n, :W]
+                dst.write(np.divide(a, b, out=np.full_like(a, np.nan), where=b > 0), 1, window=Window(0, y, W, n))
+                acc[:-n] = acc[n:].copy(); acc[-n:] = 0
+                wt[:-n] = wt[n:].copy(); wt[-n:] = 0
+
+
+def run_patch_inference(model_path: str, ndvi_dir: str, out_dir: str = "output/heatmaps",
+                        stride: int = 64, batch_size: int = 256) -> int:
+    m = load_model(model_path)
+    out = Path(out_dir); out.mkdir(parents=True, exist_ok=True)
+    paths = sorted(Path(ndvi_dir).glob("*_ndvi.tif"))
+    for p in tqdm(paths, desc="Heatmap"):
+        predict_heatmap(m, p, out / (p.name.replace("_ndvi.tif", "_prob.tif")), stride, batch_size)
+    return len(paths)
@@ -0,0 +1,396 @@
+"""
+Daemon de monitoramento (python main.py --daemon): um processo de longa duração, "quente".
+- Modelo carregado uma vez (recarregado só se o arquivo mudar) e conexão SQLite aberta.
+- Observa raw_dir por varredura de stat: arquivos novos/alterados, estáveis por 'settle_s',
+  passam pelo batch_compute_ndvi (o mesmo do --ndvi) → inferência em micro-lotes; o resto não é
+  relido (assinaturas em memória, semeadas do manifesto do NDVI).
+- Aquisição (GEE → Drive) a cada 'interval_h' horas numa thread própria: o próximo ciclo é agendado
+  a partir do fim do anterior (nunca se sobrepõem) e intervalos perdidos (daemon parado ou ciclo
+  longo) viram um único ciclo de recuperação cobrindo o período desde o último sucesso.
+- Lock de arquivo: um daemon por diretório de dados.
+- GET /health e /status em http://127.0.0.1:<port>: fila, totais e tempos do último ciclo.
+"""
+
+from __future__ import annotations
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import datetime, json, logging, os, tempfile, threading, time
+
+try:
+    import fcntl
+except Exception:  # Windows: lock via msvcrt
+    fcntl = None
+try:
+    import msvcrt
+except Exception:
+    msvcrt = None
+
+log = logging.getLogger(__name__)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now().replace(microsecond=0)
+
+
+def _write_json(path: Path, data: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+class MonitorDaemon:
+    def __init__(self, cfg: dict, raw_dir: str = "data/raw", ndvi_dir: str = "data/ndvi",
+                 model_path: str = "models/modelo_final.h5", db_path: str = "data/db/ndvi_data.db",
+                 out_csv: str = "output/reports/resultados_queimadas.csv", interval_h: float | None = None,
+                 poll_s: float = 5.0, settle_s: float = 2.0, batch_size: int = 16, host: str = "127.0.0.1",
+                 port: int = 8765, state_file: str = "output/logs/daemon_state.json",
+                 lock_file: str = "data/db/daemon.lock", acquire=None, metrics_dir: str = "output/logs",
+                 processed_dir: str = "data/processed", streaming: bool = False, fmt: str | None = None,
+                 cube=None, zones: tuple | None = None):
+        """
+        'acquire(start_date, end_date)' substitui a aquisição padrão (GEE → Drive → raw_dir), ex.: em testes;
+        sem 'interval_h' o daemon só observa raw_dir. streaming/fmt/cube/zones: os mesmos do --ndvi
+        (o NDVI passa pelo batch_compute_ndvi, com manifesto, footprints, estatísticas e cubo).
+        """
+        d = cfg.get("daemon", {}); cnn = cfg.get("cnn", {})
+        self.cfg = cfg
+        self.raw_dir, self.ndvi_dir, self.processed_dir = Path(raw_dir), Path(ndvi_dir), Path(processed_dir)
+        self.model_path, self.db_path, self.out_csv = model_path, db_path, Path(out_csv)
+        self.backend, self.threads = cnn.get("backend", "keras"), cnn.get("tflite_threads")
+        self.streaming, self.cube = streaming, cube
+        self.fmt = fmt or cfg.get("ndvi", {}).get("format", "float32")
+        from .ndvi_stats import zones_from_cfg
+        self.zones = zones if zones is not None else zones_from_cfg(cfg)
+        self.interval_h = interval_h if interval_h is not None else d.get("interval_h")
+        self.poll_s, self.settle_s = float(d.get("poll_s", poll_s)), float(d.get("settle_s", settle_s))
+        self.batch_size = int(d.get("batch_size", batch_size))
+        self.retry_s = float(d.get("retry_s", 60))  # inferência falhou (ex.: sem modelo): nova tentativa após
+        self.rolling = bool(d.get("rolling_window", True))
+        self.host, self.port = host, int(d.get("port", port))
+        self.state_file, self.lock_file = Path(state_file), Path(lock_file)
+        self._acquire_fn = acquire or self._acquire_gee
+        self.metrics_dir = metrics_dir
+        self._metrics_run = "daemon_" + _now().strftime("%Y%m%d_%H%M%S")
+
+        self._stop = threading.Event()
+        self._mu = threading.Lock()  # protege o estado lido pelo /status
+        self._seen: dict = {}        # caminho → (assinatura, visto desde) aguardando estabilizar
+        self._done: dict = {}        # caminho → assinatura já processada (NDVI e inferência)
+        self._model = self._model_mtime = self._con = self._lock_fh = self._http = None
+        self._threads: list = []
+        self.stats = {"started_at": None, "cycles": 0, "processed": 0, "failed": 0, "last_cycle": None,
+                      "cycle_started": None, "acq": {"running": False, "last_ok": None, "last_error": None,
+                                                     "missed": 0, "cycles": 0, "next_due": None}}
+
+    def _flush_metrics(self):
+        """Descarrega os eventos de métricas a cada ciclo (a lista em memória não cresce com o uptime)."""
+        from .metrics import write_metrics
+        try:
+            write_metrics(self.metrics_dir, self._metrics_run, clear=True)
+        except Exception:
+            log.exception("[Daemon] Falha ao gravar métricas")
+
+    # ---------- recursos quentes ----------
+
+    def _lock(self):
+        """Lock exclusivo do lock_file (flock no Unix, msvcrt.locking no Windows); sem nenhum, não inicia."""
+        if fcntl is None and msvcrt is None:
+            raise RuntimeError("Sem lock de arquivo nesta plataforma (fcntl/msvcrt); o daemon não inicia.")
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        fh = os.fdopen(os.open(self.lock_file, os.O_RDWR | os.O_CREAT), "r+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                fh.seek(0); msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)  # 1º byte
+        except OSError:
+            fh.close()
+            raise RuntimeError(f"Outro daemon já está rodando ({self.lock_file}).")
+        fh.seek(0); fh.write(str(os.getpid()).ljust(16)); fh.flush()  # sem truncate: região travada no Windows
+        self._lock_fh = fh
+
+    def _ensure_model(self):
+        """Carrega o modelo na 1ª vez e quando o arquivo muda (ex.: novo --train)."""
+        from .cnn_model import load_model
+        from .tflite_model import tflite_path_for
+        f = tflite_path_for(self.model_path) if self.backend == "tflite" else Path(self.model_path)
+        mt = f.stat().st_mtime_ns
+        if self._model is None or mt != self._model_mtime:
+            t0 = time.perf_counter()
+            self._model, self._model_mtime = load_model(self.model_path, self.backend, self.threads), mt
+            log.info("[Daemon] Modelo %s carregado (%s) em %.1fs", f, self.backend, time.perf_counter() - t0)
+        return self._model
+
+    # ---------- observação de raw_dir ----------
+
+    def _load_manifest(self):
+        """Semeia o que já foi processado (manifesto do NDVI) para não refazer nada na partida."""
+        from .database import load_ndvi_manifest
+        from .ndvi_utils import _ndvi_params
+        params = _ndvi_params(self.streaming, self.fmt)
+        for out, e in load_ndvi_manifest(self.db_path).items():
+            if e["status"] == "ok" and e["params"] == params and Path(out).exists():
+                self._done[e["src_path"]] = (e["src_size"], e["src_mtime_ns"])
+
+    def scan(self) -> list[Path]:
+        """Arquivos novos/alterados cuja assinatura (tamanho, mtime) está estável há 'settle_s'."""
+        now, ready, sigs = time.monotonic(), [], {}
+        for p in sorted(list(self.raw_dir.glob("*.tif")) + list(self.raw_dir.glob("*.tiff"))):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            sigs[p.as_posix()] = (p, (st.st_size, st.st_mtime_ns))
+        with self._mu:
+            for key, (p, sig) in sigs.items():
+                if self._done.get(key) == sig: continue
+                prev = self._seen.get(key)
+                if prev is None or prev[0] != sig:
+                    self._seen[key] = (sig, now)
+                elif now - prev[1] >= self.settle_s:
+                    ready.append(p)
+            for k in [k for k in self._seen if k not in sigs]: del self._seen[k]
+        return ready
+
+    # ---------- ciclo de processamento (NDVI → inferência) ----------
+
+    def _settled(self, tifs, delay: float = 0.0):
+        """Marca como processados (ou, com 'delay', devolve à espera por mais 'delay' segundos)."""
+        with self._mu:
+            for tif in tifs:
+                try:
+                    st = tif.stat()
+                except FileNotFoundError:
+                    self._seen.pop(tif.as_posix(), None); continue
+                sig = (st.st_size, st.st_mtime_ns)
+                if delay: self._seen[tif.as_posix()] = (sig, time.monotonic() + delay)
+                else: self._done[tif.as_posix()] = sig; self._seen.pop(tif.as_posix(), None)
+
+    def process(self, tifs: list[Path]) -> dict:
+        """
+        NDVI dos arquivos dados via batch_compute_ndvi (manifesto, footprints, estatísticas, cubo) e
+        inferência dos que têm NDVI válido; uma execução 'daemon' no banco. Um arquivo só é dado como
+        processado depois da inferência: se ela falhar (ex.: modelo ausente) volta à fila após 'retry_s'.
+        NDVI com erro só é tentado de novo quando o arquivo mudar.
+        """
+        from .ndvi_utils import batch_compute_ndvi
+        from .database import load_ndvi_manifest, start_run, finish_run, insert_predictions
+        from .cnn_model import _load_ndvi
+        import numpy as np
+        t = {"files": len(tifs), "started_at": _now().isoformat()}
+        t0 = time.perf_counter()
+        n = batch_compute_ndvi(self.raw_dir, self.ndvi_dir, self.processed_dir, streaming=self.streaming,
+                               db_path=self.db_path, cube=self.cube, fmt=self.fmt, zones=self.zones, paths=tifs)
+        outs = {tif: self.ndvi_dir / (tif.stem + "_ndvi.tif") for tif in tifs}
+        man = load_ndvi_manifest(self.db_path, [o.as_posix() for o in outs.values()])
+        ok = [tif for tif, o in outs.items() if man.get(o.as_posix(), {}).get("status") == "ok" and o.exists()]
+        bad = [tif for tif in tifs if tif not in ok]
+        for tif in bad: log.warning("[Daemon] NDVI falhou para %s", tif.name)
+        self._settled(bad)
+        t["ndvi_ms"] = round(1000 * (time.perf_counter() - t0), 1)
+
+        rows, t1 = [], time.perf_counter()
+        try:
+            if ok:
+                m = self._ensure_model()
+                paths = [outs[tif] for tif in ok]
+                for i in range(0, len(paths), self.batch_size):
+                    chunk = paths[i:i + self.batch_size]
+                    probs = np.asarray(m.predict_on_batch(np.stack([_load_ndvi(p) for p in chunk]))).reshape(-1)
+                    rows += [{"path": str(p), "prob": float(pr), "pred": int(pr > 0.5)} for p, pr in zip(chunk, probs)]
+        except Exception:
+            self._settled(ok, delay=self.retry_s)
+            raise
+        t["predict_ms"] = round(1000 * (time.perf_counter() - t1), 1)
+
+        t2 = time.perf_counter()
+        if rows:
+            rid = start_run(self.db_path, model_path=self.model_path if self.backend == "keras"
+                            else f"{self.model_path} ({self.backend})", source="daemon", con=self._con)
+            finish_run(self.db_path, rid, insert_predictions(self.db_path, rid, rows, con=self._con), con=self._con)
+            self._merge_csv(rows)
+            t["run_id"] = rid
+        self._settled(ok)
+        t["db_ms"] = round(1000 * (time.perf_counter() - t2), 1)
+        t.update(ndvi=n, predicted=len(rows), failed=len(bad), total_ms=round(1000 * (time.perf_counter() - t0), 1))
+        return t
+
+    def _merge_csv(self, rows: list):
+        """Atualiza as linhas destes tiles no CSV de resultados (o dashboard lê dele)."""
+        from .cnn_model import merge_results_csv
+        merge_results_csv(self.out_csv, rows)
+
+    def _watch_loop(self):
+        from .database import connect
+        self._con = connect(self.db_path)  # conexão da thread de processamento, aberta durante toda a vida do daemon
+        while not self._stop.is_set():
+            ready = None
+            try:
+                ready = self.scan()
+                if ready:
+                    with self._mu: self.stats["cycle_started"] = time.time()
+                    res = self.process(ready)
+                    with self._mu:
+                        self.stats["cycles"] += 1; self.stats["last_cycle"] = res; self.stats["cycle_started"] = None
+                        self.stats["processed"] += res["ndvi"]; self.stats["failed"] += res["failed"]
+                    log.info("[Daemon] Ciclo: %d arquivos, %d NDVI, %d predições em %.0f ms",
+                             res["files"], res["ndvi"], res["predicted"], res["total_ms"])
+            except Exception:
+                log.exception("[Daemon] Ciclo de processamento falhou")
+                with self._mu: self.stats["cycle_started"] = None
+            if ready: self._flush_metrics()
+            self._stop.wait(self.poll_s)
+        self._con.close()
+
+    # ---------- aquisição agendada (com recuperação) ----------
+
+    def _load_state(self) -> dict:
+        return json.loads(self.state_file.read_text(encoding="utf-8")) if self.state_file.exists() else {}
+
+    def _acquire_gee(self, start_date: str | None, end_date: str | None):
+        from .data_processing import download_sentinel_tiles_via_drive
+        from .drive_sync import download_new_exports
+        gee = self.cfg.get("gee", {})
+        folder = gee.get("drive_folder", "VigiAI")
+
+        def _hook(task, s):  # cada export concluído é baixado na hora; o watcher pega o arquivo
+            if s.get("state") == "COMPLETED":
+                download_new_exports(folder_name=folder, local_dir=str(self.raw_dir), prefix=s["description"],
+                                     workers=1, db_path=self.db_path)
+        download_sentinel_tiles_via_drive(
+            aoi_geojson=gee.get("aoi_geojson"), bbox=gee.get("bbox_approx"),
+            start_date=start_date or gee.get("start_date"), end_date=end_date or gee.get("end_date"),
+            collection=gee.get("collection", "COPERNICUS/S2_SR_HARMONIZED"),
+            cloud_filter=int(gee.get("cloud_filter", 80)), drive_folder=folder,
+            max_tiles=int(gee.get("max_tiles", 6)), export_scale=int(gee.get("export_scale", 20)),
+            out_dir=str(self.raw_dir), shard_deg=gee.get("shard_deg"), max_active=gee.get("max_concurrent_tasks"),
+            wait_for_tasks=True, on_task_done=_hook)
+
+    def _acquire_loop(self):
+        interval = datetime.timedelta(hours=float(self.interval_h))
+        retry = min(interval, datetime.timedelta(minutes=15))
+        while not self._stop.is_set():
+            state = self._load_state()
+            last = datetime.datetime.fromisoformat(state["last_ok"]) if state.get("last_ok") else None
+            due = last + interval if last else _now()
+            if state.get("last_error_at"):
+                due = max(due, datetime.datetime.fromisoformat(state["last_error_at"]) + retry)
+            with self._mu: self.stats["acq"]["next_due"] = due.isoformat()
+            wait = (due - _now()).total_seconds()
+            if wait > 0:
+                self._stop.wait(min(wait, 60.0)); continue
+            missed = int((_now() - last) / interval) - 1 if last else 0
+            start = end = None
+            if self.rolling and last:  # janela desde o último sucesso (1 dia de folga) até amanhã
+                start = (last.date() - datetime.timedelta(days=1)).isoformat()
+                end = (_now().date() + datetime.timedelta(days=1)).isoformat()
+            if missed > 0:
+                log.info("[Daemon] %d intervalos perdidos; recuperando com um ciclo (%s → %s).", missed, start, end)
+            t0 = _now()
+            with self._mu: self.stats["acq"].update(running=True, missed=self.stats["acq"]["missed"] + max(missed, 0))
+            try:
+                self._acquire_fn(start, end)
+                state = {"last_ok": t0.isoformat(), "last_seconds": (_now() - t0).total_seconds(), "missed": max(missed, 0)}
+                with self._mu: self.stats["acq"].update(last_ok=t0.isoformat(), last_error=None, cycles=self.stats["acq"]["cycles"] + 1)
+            except Exception as e:
+                log.exception("[Daemon] Aquisição falhou; nova tentativa em %s", retry)
+                state = {**state, "last_error": f"{type(e).__name__}: {e}", "last_error_at": _now().isoformat()}
+                with self._mu: self.stats["acq"]["last_error"] = state["last_error"]
+            finally:
+                with self._mu: self.stats["acq"]["running"] = False
+            _write_json(self.state_file, state)
+            self._flush_metrics()
+
+    # ---------- status/health ----------
+
+    def status(self) -> dict:
+        with self._mu:
+            s = json.loads(json.dumps(self.stats))
+            pending = sorted(Path(k).name for k in self._seen)
+        started = s.pop("cycle_started")
+        s.update(pid=os.getpid(), uptime_s=round(time.time() - s["started_at"], 1), queue_depth=len(pending),
+                 pending=pending[:20], running_for_s=round(time.time() - started, 1) if started else None,
+                 model={"path": self.model_path, "backend": self.backend, "loaded": self._model is not None},
+                 interval_h=self.interval_h, poll_s=self.poll_s)
+        s["started_at"] = datetime.datetime.fromtimestamp(s["started_at"]).isoformat(timespec="seconds")
+        return s
+
+    def health(self) -> tuple[bool, dict]:
+        """Saudável se as threads estão vivas e nenhum ciclo de processamento está travado (> 30 min)."""
+        s = self.status()
+        alive = all(t.is_alive() for t in self._threads)
+        stalled = (s["running_for_s"] or 0) > 1800
+        return alive and not stalled, {"ok": alive and not stalled, "threads_alive": alive, "stalled": stalled,
+                                       "queue_depth": s["queue_depth"], "uptime_s": s["uptime_s"]}
+
+    def _serve(self):
+        daemon = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") == "/health":
+                    ok, body = daemon.health(); code = 200 if ok else 503
+                elif self.path.rstrip("/") in ("", "/status"):
+                    body, code = daemon.status(), 200
+                else:
+                    body, code = {"error": "use /health ou /status"}, 404
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers(); self.wfile.write(data)
+
+            def log_message(self, *args):  # sem log de acesso no stderr
+                pass
+
+        self._http = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self.port = self._http.server_address[1]
+        threading.Thread(target=self._http.serve_forever, name="daemon-http", daemon=True).start()
+
+    # ---------- ciclo de vida ----------
+
+    def start(self):
+        from .database import init_db
+        self._lock()
+        init_db(self.db_path)
+        self.raw_dir.mkdir(parents=True, exist_ok=True)
+        self._load_manifest()
+        self.stats["started_at"] = time.time()
+        if Path(self.model_path).exists(): self._ensure_model()
+        self._serve()
+        self._threads = [threading.Thread(target=self._watch_loop, name="daemon-watch", daemon=True)]
+        if self.interval_h:
+            self._threads.append(threading.Thread(target=self._acquire_loop, name="daemon-acquire", daemon=True))
+        for t in self._threads: t.start()
+        log.info("[Daemon] Observando %s (a cada %gs); aquisição %s; status em http://%s:%d/status",
+                 self.raw_dir, self.poll_s, f"a cada {self.interval_h}h" if self.interval_h else "desligada",
+                 self.host, self.port)
+        return self
+
+    def stop(self, timeout: float = 30.0):
+        self._stop.set()
+        for t in self._threads: t.join(timeout)
+        if self._http is not None: self._http.shutdown(); self._http.server_close()
+        if self._lock_fh is not None:
+            if fcntl is not None:
+                fcntl.flock(self._lock_fh, fcntl.LOCK_UN)
+            else:
+                self._lock_fh.seek(0); msvcrt.locking(self._lock_fh.fileno(), msvcrt.LK_UNLCK, 1)
+            self._lock_fh.close()
+        log.info("[Daemon] Encerrado.")
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self._stop.wait(1.0): pass
+        except KeyboardInterrupt:
+            print("[Daemon] Encerrado pelo usuário.")
+        finally:
+            self.stop()
+
+
+def run_daemon(cfg: dict, interval_h: float | None = None, **kw):
+    """Entrada do main.py --daemon (bloqueia até Ctrl+C)."""
+    MonitorDaemon(cfg, interval_h=interval_h, **kw).run_forever()
@@ -1,23 +1,244 @@
 from pathlib import Path
+import json, math
 import folium, rasterio as rio, numpy as np, pandas as pd, plotly.express as px
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.warp import reproject, transform_bounds
+from rasterio.errors import WindowError
+from rasterio.windows import Window, from_bounds
+from PIL import Image
+from .ndvi_utils import read_ndvi
 
-def build_dashboard(ndvi_dir: str, results_csv: str, out_html: str):
+TILE = 256
+_MERC = 20037508.342789244  # meia-largura do mundo em EPSG:3857 (m)
+
+
+def _vis_uint8(arr: np.ndarray) -> np.ndarray:
+    return (np.clip((arr + 0.2)/1.1, 0, 1)*255).astype("uint8")
+
+
+# ---------- Pirâmide XYZ (Web Mercator) ----------
+
+def _lonlat_to_tile(lon: float, lat: float, z: int) -> tuple:
+    lat = max(min(lat, 85.0511), -85.0511); n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _tiles_for_bounds(b, z: int):
+    """Tiles XYZ do zoom z que intersectam bounds (left, bottom, right, top) em lon/lat."""
+    x0, y0 = _lonlat_to_tile(b[0], b[3], z); x1, y1 = _lonlat_to_tile(b[2], b[1], z)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def _tile_transform(x: int, y: int, z: int) -> Affine:
+    size = 2 * _MERC / 2 ** z
+    return Affine(size / TILE, 0, -_MERC + x * size, 0, -size / TILE, _MERC - y * size)
+
+
+def _native_zoom(res_deg: float, cap: int = 14) -> int:
+    """Menor zoom cuja resolução do tile já alcança a resolução nativa do raster."""
+    return min(cap, max(0, math.ceil(math.log2(360.0 / (TILE * res_deg)))))
+
+
+def _open_for_zoom(src: Path, z: int):
+    """Abre o nível de overview mais grosso que ainda atende a resolução do zoom z."""
+    need = 360.0 / 2 ** z / TILE
+    with rio.open(src) as ds:
+        res = abs(ds.res[0]) if ds.crs.is_geographic else abs(ds.res[0]) / 111_320.0
+        level = None
+        for i, f in enumerate(ds.overviews(1)):
+            if f <= need / res: level = i
+    return rio.open(src, **({"overview_level": level} if level is not None else {}))
+
+
+def _read_for_tile(ds, x: int, y: int, z: int) -> np.ndarray:
+    """Reprojeta para o tile (EPSG:3857) só a janela do raster que fica sob ele."""
+    dst = np.full((TILE, TILE), np.nan, dtype="float32")
+    tb = transform_bounds("EPSG:3857", ds.crs, *rio.transform.array_bounds(TILE, TILE, _tile_transform(x, y, z)))
+    try:
+        win = from_bounds(*tb, transform=ds.transform).round_offsets().round_lengths()
+        win = win.intersection(Window(0, 0, ds.width, ds.height))
+    except WindowError:  # tile só encosta na borda do raster
+        return dst
+    # NDVI sem overviews (gravados antes delas): lê a janela já decimada para ~2x a resolução do tile
+    f = max(1.0, min(win.width, win.height) / (2 * TILE))
+    shape = (max(1, round(win.height / f)), max(1, round(win.width / f)))
+    arr = read_ndvi(ds, window=win, out_shape=shape if f > 1 else None)
+    src_tr = ds.window_transform(win) * Affine.scale(win.width / shape[1], win.height / shape[0])
+    reproject(arr, dst, src_transform=src_tr, src_crs=ds.crs, src_nodata=np.nan,
+              dst_transform=_tile_transform(x, y, z), dst_crs="EPSG:3857", dst_nodata=np.nan,
+              resampling=Resampling.bilinear)
+    return dst
+
+
+def _render_tile(sources: list, x: int, y: int, z: int, out: Path):
+    """Compõe os rasters que tocam o tile (o último vence) e grava PNG cinza + alfa."""
+    acc = np.full((TILE, TILE), np.nan, dtype="float32")
+    for ds in sources:
+        arr = _read_for_tile(ds, x, y, z)
+        acc = np.where(np.isnan(arr), acc, arr)
+    valid = ~np.isnan(acc)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    if not valid.any():
+        out.unlink(missing_ok=True); return
+    g = _vis_uint8(np.nan_to_num(acc))
+    Image.fromarray(np.dstack([g, g, g, np.where(valid, 255, 0).astype("uint8")]), "RGBA").save(out, optimize=True)
+
+
+def render_xyz_tiles(ndvi_dir: str, tiles_dir: str, zmin: int = 5, zmax: int | None = None, paths=None) -> dict:
+    """
+    Pré-renderiza uma pirâmide {z}/{x}/{y}.png com todos os NDVI de ndvi_dir (ou só 'paths').
+    Incremental: só os tiles XYZ sob rasters novos/alterados/removidos são refeitos
+    (tiles_dir/manifest.json guarda mtime e bounds de cada origem). Com 'paths' a pirâmide continua
+    compartilhada: as demais origens do manifesto (ainda em disco) são mantidas e compostas nos tiles.
+    Retorna as origens desta chamada em "sources".
+    """
+    tdir = Path(tiles_dir); tdir.mkdir(parents=True, exist_ok=True)
+    mf = tdir / "manifest.json"
+    old = json.loads(mf.read_text(encoding="utf-8")) if mf.exists() else {"sources": {}}
+    cur = {}
+    for tif in sorted(Path(ndvi_dir).glob("*_ndvi.tif")) if paths is None else sorted(Path(p) for p in paths):
+        key = tif.as_posix(); prev = old["sources"].get(key)
+        if prev and prev["mtime_ns"] == tif.stat().st_mtime_ns:
+            cur[key] = prev; continue
+        with rio.open(tif) as ds:
+            b = transform_bounds(ds.crs, "EPSG:4326", *ds.bounds)
+            res = abs(ds.res[0]) if ds.crs.is_geographic else abs(ds.res[0]) / 111_320.0
+        cur[key] = {"mtime_ns": tif.stat().st_mtime_ns, "bounds": list(b), "zmax": _native_zoom(res), "changed": True}
+
+    keep = {} if paths is None else {k: e for k, e in old["sources"].items() if k not in cur and Path(k).exists()}
+    allsrc = {**keep, **cur}
+    zmax = int(zmax) if zmax is not None else max([e["zmax"] for e in allsrc.values()] or [zmin])
+    dirty_bounds = [e["bounds"] for e in cur.values() if e.get("changed")]
+    dirty_bounds += [e["bounds"] for k, e in old["sources"].items() if k not in allsrc or allsrc[k].get("changed")]
+    if old.get("zmin") != zmin or old.get("zmax") != zmax:  # faixa de zoom mudou → refaz tudo
+        dirty_bounds = [e["bounds"] for e in allsrc.values()] + [e["bounds"] for e in old["sources"].values()]
+
+    def _hits(b, x, y, z):
+        tb = transform_bounds("EPSG:3857", "EPSG:4326", *rio.transform.array_bounds(TILE, TILE, _tile_transform(x, y, z)))
+        return b[0] < tb[2] and b[2] > tb[0] and b[1] < tb[3] and b[3] > tb[1]
+
+    n = 0
+    for z in range(zmin, zmax + 1):
+        dirty = {t for b in dirty_bounds for t in _tiles_for_bounds(b, z)}
+        opened = {}  # um handle por origem e zoom, reaproveitado por todos os tiles
+        try:
+            for x, y in sorted(dirty):
+                srcs = [k for k, e in allsrc.items() if _hits(e["bounds"], x, y, z)]
+                for k in srcs:
+                    if k not in opened: opened[k] = _open_for_zoom(Path(k), z)
+                _render_tile([opened[k] for k in srcs], x, y, z, tdir / str(z) / str(x) / f"{y}.png"); n += 1
+        finally:
+            for ds in opened.values(): ds.close()
+
+    for e in allsrc.values(): e.pop("changed", None)
+    mf.write_text(json.dumps({"zmin": zmin, "zmax": zmax, "sources": allsrc}, indent=1), encoding="utf-8")
+    return {"zmin": zmin, "zmax": zmax, "rendered": n, "sources": cur}
+
+
+def _stats_layers(m, db_path: str, paths=None, zones_geojson: str | None = None, zone_field: str = "name") -> int:
+    """
+    Camadas e gráficos a partir das tabelas ndvi_stats/ndvi_zone_stats (nenhum raster é aberto):
+    retângulo de cada tile colorido pela média, coropléticos por zona (média e fração < 0,2),
+    e um painel com o histograma agregado, a série temporal e as frações abaixo dos limiares.
+    """
+    import branca.colormap as cm
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    from .database import load_ndvi_stats, zone_aggregates
+    from .ndvi_stats import VEG_THRESHOLDS, thr_col
+    rows = load_ndvi_stats(db_path, paths)
+    if not rows: return 0
+    df = pd.DataFrame(rows)
+    thr = [(t, thr_col(t)) for t in VEG_THRESHOLDS]
+
+    # tiles (retângulos do catálogo)
+    geo = df.dropna(subset=["min_lon", "mean"])
+    if len(geo):
+        cmap = cm.LinearColormap(["#a50026", "#fee08b", "#1a9850"], vmin=-0.2, vmax=0.9, caption="NDVI médio do tile")
+        feats = [{"type": "Feature",
+                  "geometry": {"type": "Polygon", "coordinates": [[[r.min_lon, r.min_lat], [r.max_lon, r.min_lat],
+                               [r.max_lon, r.max_lat], [r.min_lon, r.max_lat], [r.min_lon, r.min_lat]]]},
+                  "properties": {"tile": r.tile, "data": r.acq_date or "", "media": round(r.mean, 3), "p50": round(r.p50, 3),
+                                 **{c: f"{getattr(r, c):.1%}" for _, c in thr}}}
+                 for r in geo.itertuples()]
+        folium.GeoJson({"type": "FeatureCollection", "features": feats}, name="NDVI médio (tiles)",
+                       style_function=lambda f: {"fillColor": cmap(f["properties"]["media"]), "color": "#555",
+                                                 "weight": 0.5, "fillOpacity": 0.55},
+                       tooltip=folium.GeoJsonTooltip(fields=["tile", "data", "media", "p50"] + [c for _, c in thr],
+                                                     aliases=["Tile", "Data", "Média", "Mediana"] +
+                                                             [f"NDVI < {t:g}" for t, _ in thr])).add_to(m)
+        cmap.add_to(m)
+
+    # coropléticos por zona
+    if zones_geojson and Path(zones_geojson).exists():
+        z = pd.DataFrame(zone_aggregates(db_path, paths))
+        if len(z):
+            geo_data = json.loads(Path(zones_geojson).read_text(encoding="utf-8"))
+            for col, legend, colors in (("mean", "NDVI médio por zona", "RdYlGn"),
+                                        (thr[0][1], f"Fração com NDVI < {thr[0][0]:g} por zona", "YlOrRd")):
+                folium.Choropleth(geo_data=geo_data, data=z, columns=["zone", col], key_on=f"feature.properties.{zone_field}",
+                                  fill_color=colors, fill_opacity=0.6, line_weight=1, nan_fill_opacity=0.0,
+                                  legend_name=legend, name=legend, show=col == "mean").add_to(m)
+
+    # painel de gráficos
+    w = df["n_valid"].fillna(0).to_numpy()
+    hist = sum(np.frombuffer(h, dtype="int32").astype("int64") for h in df["hist"] if h is not None)
+    bins = int(df["bins"].iloc[0])
+    centers = -1.0 + (np.arange(bins) + 0.5) * (2.0 / bins)
+    fig = make_subplots(rows=3, cols=1, subplot_titles=("Histograma do NDVI (todos os tiles)", "NDVI médio por data",
+                                                        "Fração de pixels abaixo dos limiares"), vertical_spacing=0.1)
+    fig.add_trace(go.Bar(x=centers, y=hist, name="pixels", marker_color="#1a9850"), row=1, col=1)
+    ts = df.assign(w=w, wm=df["mean"] * w, **{f"w_{c}": df[c] * w for _, c in thr}).dropna(subset=["acq_date"])
+    if len(ts):
+        g = ts.groupby("acq_date")[["w", "wm"] + [f"w_{c}" for _, c in thr]].sum().sort_index()
+        g = g[g["w"] > 0]
+        fig.add_trace(go.Scatter(x=g.index, y=g["wm"] / g["w"], mode="lines+markers", name="média"), row=2, col=1)
+        for t, c in thr:
+            fig.add_trace(go.Scatter(x=g.index, y=g[f"w_{c}"] / g["w"], mode="lines+markers", name=f"< {t:g}"), row=3, col=1)
+    else:  # sem datas no catálogo: frações por tile
+        for t, c in thr:
+            fig.add_trace(go.Bar(x=df["tile"], y=df[c], name=f"< {t:g}"), row=3, col=1)
+    fig.update_layout(height=900, width=560, margin=dict(l=40, r=10, t=40, b=30), showlegend=True)
+    loc = [float(geo[["min_lat", "max_lat"]].to_numpy().mean()), float(geo[["min_lon", "max_lon"]].to_numpy().mean())] \
+        if len(geo) else [-3.0, -60.0]
+    folium.Marker(location=loc, tooltip="Estatísticas do NDVI", icon=folium.Icon(color="green", icon="stats"),
+                  popup=folium.Popup(folium.IFrame(fig.to_html(include_plotlyjs="cdn"), width=600, height=700),
+                                     max_width=620)).add_to(m)
+    return len(df)
+
+
+def build_dashboard(ndvi_dir: str, results_csv: str, out_html: str, zmin: int = 5, zmax: int | None = None, paths=None,
+                    db_path: str | None = None, zones_geojson: str | None = None, zone_field: str = "name"):
+    """
+    Mapa NDVI + distribuição das probabilidades; 'paths' limita a um subconjunto de tiles (catálogo).
+    Com 'db_path', adiciona as camadas/gráficos das estatísticas pré-calculadas (e zonas de 'zones_geojson').
+    """
     ndvi_dir = Path(ndvi_dir); out = Path(out_html); out.parent.mkdir(parents=True, exist_ok=True)
     m = folium.Map(location=[-3.1,-60.0], zoom_start=6, tiles="CartoDB positron")
 
-    # Overlays NDVI (até 6 para ficar leve)
-    for tif in sorted(ndvi_dir.glob("*_ndvi.tif"))[:6]:
-        with rio.open(tif) as ds:
-            bounds = [[ds.bounds.bottom, ds.bounds.left],[ds.bounds.top, ds.bounds.right]]
-            arr = ds.read(1).astype("float32")
-            vis = (np.clip((arr + 0.2)/1.1, 0, 1)*255).astype("uint8")
-            folium.raster_layers.ImageOverlay(vis, bounds=bounds, opacity=0.6, name=tif.stem).add_to(m)
+    # Overlay NDVI: pirâmide XYZ em disco ao lado do HTML (sem base64 embutido → todos os tiles)
+    tiles_dir = out.parent / "ndvi_tiles"
+    pyr = render_xyz_tiles(ndvi_dir, tiles_dir, zmin, zmax, paths)
+    if pyr["sources"]:
+        folium.TileLayer(tiles=f"{tiles_dir.name}/{{z}}/{{x}}/{{y}}.png", attr="VigiAI NDVI", name="NDVI",
+                         overlay=True, opacity=0.6, min_zoom=pyr["zmin"], max_native_zoom=pyr["zmax"], max_zoom=18).add_to(m)
+        bs = np.array([e["bounds"] for e in pyr["sources"].values()])
+        m.fit_bounds([[bs[:,1].min(), bs[:,0].min()], [bs[:,3].max(), bs[:,2].max()]])
     rcsv = Path(results_csv)
     if rcsv.exists():
         df = pd.read_csv(rcsv)
+        if paths is not None and "path" in df.columns:
+            from .database import tile_key
+            df = df[df["path"].map(tile_key).isin({tile_key(p) for p in paths})]
         if "prob" in df.columns:
             fig = px.histogram(df, x="prob", nbins=20, title="Distribuição de probabilidades (CNN)")
             folium.Marker(location=[-2.5,-59.5], tooltip="Distribuição de probabilidades",
                           popup=folium.IFrame(fig.to_html(include_plotlyjs='cdn'), width=500, height=350)).add_to(m)
+    if db_path and Path(db_path).exists():
+        n = _stats_layers(m, db_path, paths, zones_geojson, zone_field)
+        if not n: print("[Dashboard] Sem estatísticas de NDVI no banco (rode --ndvi ou --stats).")
     folium.LayerControl().add_to(m)
     m.save(out)
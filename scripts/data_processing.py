@@ -1,15 +1,28 @@
 from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import json, os, time, logging
+import asyncio, datetime, json, math, os, logging, tempfile, threading, time
 import ee
+from .metrics import call
 
 log = logging.getLogger(__name__)
 
+# Tarefas do EE em andamento ao mesmo tempo (READY/RUNNING). Ajuste à cota de tarefas
+# concorrentes do projeto (gee.max_concurrent_tasks): acima dela o servidor só enfileira.
+MAX_ACTIVE_TASKS = 4
+PLAN_FILE = "export_plan.json"
+
+
+_ee_project = ...  # projeto com que o EE já foi inicializado neste processo (... = nenhum)
+
 
 def _init_ee():
-    """Inicializa o EE usando a variável EE_PROJECT_ID."""
+    """Inicializa o EE usando a variável EE_PROJECT_ID (uma vez por processo e projeto)."""
+    global _ee_project
     proj = os.environ.get("EE_PROJECT_ID", None)
+    if proj == _ee_project: return
     ee.Initialize(project=proj)
+    _ee_project = proj
     log.info("[EE] Initialize(project='%s') OK", proj)
 
 
@@ -58,23 +71,196 @@ def _make_export_task(img, geom, description: str, folder: str, scale: int):
     return ee.batch.Export.image.toDrive(**params)
 
 
-def _wait_for(tasks):
-    """Espera tarefas do EE finalizarem."""
-    states_done = {"COMPLETED", "FAILED", "CANCELLED"}
+def _timed_status(t):
+    with call("gee", "task.status"):
+        return t.status()
+
+
+TASK_DONE_STATES = {"COMPLETED", "FAILED", "CANCELLED"}
+
+
+async def _poll_until_done(t, initial_delay: float = 5.0, factor: float = 1.6, max_delay: float = 60.0) -> dict:
+    """Consulta t.status() com backoff exponencial (volta ao inicial quando o estado muda) até o término."""
+    loop = asyncio.get_running_loop()
+    delay, last = initial_delay, None
     while True:
-        done = 0
-        for t in tasks:
-            s = t.status()
-            st = s.get("state")
-            if st in states_done:
-                done += 1
-        log.info("[EE] Progresso: %d/%d finalizadas.", done, len(tasks))
-        if done == len(tasks):
-            break
-        time.sleep(5)
+        try:
+            s = await loop.run_in_executor(None, _timed_status, t)
+        except Exception as e:  # falha transitória da API: mantém o backoff
+            log.warning("[EE] status() falhou: %s", e); s = {"state": last}
+        st = s.get("state")
+        if st in TASK_DONE_STATES:
+            return s
+        delay = initial_delay if st != last else min(delay * factor, max_delay)
+        last = st
+        await asyncio.sleep(delay)
+
+
+async def _run_hook(on_done, t, s):
+    """on_done(task, status): função comum (roda em thread) ou coroutine; exceção vira log."""
+    try:
+        if asyncio.iscoroutinefunction(on_done): await on_done(t, s)
+        else: await asyncio.get_running_loop().run_in_executor(None, on_done, t, s)
+    except Exception:
+        log.exception("[EE] Hook falhou para %s", s.get("description"))
+
+
+async def monitor_tasks(tasks, on_done=None, initial_delay: float = 5.0, factor: float = 1.6, max_delay: float = 60.0):
+    """
+    Acompanha tarefas do EE em paralelo (asyncio). Cada tarefa tem seu próprio intervalo de
+    polling com backoff exponencial (volta ao inicial quando o estado muda) e deixa de ser
+    consultada ao terminar. A cada término emite um evento: on_done(task, status) — função
+    comum (roda em thread) ou coroutine — disparado na hora, sem esperar as demais.
+    Retorna os status finais na ordem de 'tasks'.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def _poll(t):
+        s = await _poll_until_done(t, initial_delay, factor, max_delay)
+        await events.put((t, s)); return s
+
+    pollers = [asyncio.create_task(_poll(t)) for t in tasks]
+    hooks = []
+    for done in range(1, len(tasks) + 1):
+        t, s = await events.get()
+        log.info("[EE] %s: %s (%d/%d finalizadas).", s.get("description", "?"), s.get("state"), done, len(tasks))
+        if on_done is not None:
+            hooks.append(asyncio.create_task(_run_hook(on_done, t, s)))
+    await asyncio.gather(*hooks)
+    return [p.result() for p in pollers]
+
+
+def _start_task(task, retries: int = 3, backoff: float = 2.0):
+    """task.start() com retry (cota/limite de taxa da API devolvem erro transitório)."""
+    for attempt in range(retries + 1):
+        try:
+            with call("gee", "task.start"):
+                return task.start()
+        except Exception as e:
+            if attempt == retries: raise
+            log.warning("[EE] start() falhou (%s); nova tentativa em %.0fs", e, backoff * 2 ** attempt)
+            time.sleep(backoff * 2 ** attempt)
+
+
+async def submit_tasks(jobs, max_active: int = MAX_ACTIVE_TASKS, wait: bool = True, on_done=None, on_state=None,
+                       workers: int = 8, initial_delay: float = 5.0, factor: float = 1.6, max_delay: float = 60.0) -> list:
+    """
+    jobs: [(description, make_task)]. Inicia as tarefas em paralelo (pool de 'workers' threads) com no
+    máximo 'max_active' em andamento: a próxima só começa quando uma termina (cota de concorrência do EE).
+    on_state(description, task, status) é chamado ao iniciar e ao terminar cada tarefa; on_done como em
+    monitor_tasks. wait=False: inicia todas (o restante da fila fica no servidor) e retorna.
+    Retorna os status na ordem de 'jobs'.
+    """
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="ee-start")
+    slots = asyncio.Semaphore(max(1, int(max_active)) if wait else max(1, len(jobs)))
+    done = 0
+
+    async def _one(desc, make):
+        nonlocal done
+        async with slots:
+            task = make()
+            try:
+                await loop.run_in_executor(pool, _start_task, task)
+            except Exception as e:
+                s = {"state": "FAILED", "description": desc, "error_message": f"start: {e}"}
+                if on_state: on_state(desc, task, s)
+                return s
+            if on_state: on_state(desc, task, {"state": "SUBMITTED", "description": desc})
+            if not wait:
+                return {"state": "SUBMITTED", "description": desc}
+            s = await _poll_until_done(task, initial_delay, factor, max_delay)
+        s = {"description": desc, **s}
+        done += 1
+        log.info("[EE] %s: %s (%d/%d finalizadas).", desc, s.get("state"), done, len(jobs))
+        if on_state: on_state(desc, task, s)
+        if on_done is not None: await _run_hook(on_done, task, s)
+        return s
+
+    try:
+        return list(await asyncio.gather(*(_one(d, m) for d, m in jobs)))
+    finally:
+        pool.shutdown(wait=False)
+
+
+def _wait_for(tasks, on_done=None):
+    """Espera tarefas do EE finalizarem (ver monitor_tasks)."""
+    return asyncio.run(monitor_tasks(tasks, on_done))
+
 
+# ---------- Export: tiles (plano por shards) ----------
+
+def grid_shards(bbox, shard_deg: float | None = None) -> list[dict]:
+    """
+    Divide o bbox [W, S, E, N] numa grade de células de até shard_deg graus (None → 1 shard).
+    Cada shard: {"id": "rNNcNN", "bbox": [...]}; linhas de norte para sul.
+    """
+    W, S, E, N = map(float, bbox)
+    if not shard_deg:
+        return [{"id": "r00c00", "bbox": [W, S, E, N]}]
+    nr, nc = max(1, math.ceil((N - S) / shard_deg - 1e-9)), max(1, math.ceil((E - W) / shard_deg - 1e-9))
+    dy, dx = (N - S) / nr, (E - W) / nc
+    return [{"id": f"r{r:02d}c{c:02d}", "bbox": [W + c * dx, N - (r + 1) * dy, W + (c + 1) * dx, N - r * dy]}
+            for r in range(nr) for c in range(nc)]
+
+
+def _aoi_bbox(aoi_geojson=None, bbox=None) -> list:
+    if aoi_geojson:
+        from .catalog import geojson_bbox
+        p = Path(aoi_geojson)
+        try:
+            return list(geojson_bbox(p if p.exists() else json.loads(str(aoi_geojson))))
+        except Exception:
+            pass
+    if bbox and len(bbox) == 4:
+        return list(bbox)
+    raise ValueError("Forneça 'aoi_geojson' válido ou 'bbox' [minLon, minLat, maxLon, maxLat].")
+
+
+def plan_exports(aoi_geojson=None, bbox=None, start_date=None, end_date=None,
+                 collection="COPERNICUS/S2_SR_HARMONIZED", cloud_filter=50, max_tiles=6, shard_deg=None) -> list[dict]:
+    """
+    Plano de export: para cada shard da grade do AOI, as até 'max_tiles' imagens menos nubladas que o
+    tocam. IDs e datas de todos os shards vêm numa única chamada getInfo (sem toList().get(i) por imagem).
+    Retorna [{"id", "bbox", "images": [{"image_id", "date", "description"}]}].
+    """
+    geom = _geometry_from_inputs(aoi_geojson, bbox)
+    shards = grid_shards(_aoi_bbox(aoi_geojson, bbox), shard_deg)
+    base = (ee.ImageCollection(collection)
+            .filterDate(start_date, end_date)
+            .filter(ee.Filter.lte("CLOUDY_PIXEL_PERCENTAGE", int(cloud_filter))))
+    per_shard = []
+    for sh in shards:
+        col = base.filterBounds(_shard_region(sh, geom, len(shards))).sort("CLOUDY_PIXEL_PERCENTAGE").limit(int(max_tiles))
+        per_shard.append(ee.List([col.aggregate_array("system:id"), col.aggregate_array("system:time_start")]))
+    with call("gee", "getInfo"):
+        info = ee.List(per_shard).getInfo()
+    single = len(shards) == 1
+    for sh, (ids, times) in zip(shards, info):
+        sh["images"] = []
+        for i, (iid, t) in enumerate(zip(ids, times)):
+            day = datetime.datetime.fromtimestamp(t / 1000, datetime.timezone.utc).strftime("%Y%m%d")
+            # 1 shard: mesmo nome de antes; com grade, o id do shard entra no nome
+            desc = f"vigiai_tile_{i:04d}_{day}" if single else f"vigiai_tile_{sh['id']}_{i:03d}_{day}"
+            sh["images"].append({"image_id": iid, "date": day, "description": desc})
+    log.info("[EE] Plano: %d shards, %d exports.", len(shards), sum(len(s["images"]) for s in shards))
+    return shards
+
+
+def _shard_region(shard: dict, geom, n_shards: int):
+    """Região do shard: o retângulo ∩ AOI (o AOI inteiro quando não há grade)."""
+    if n_shards == 1:
+        return geom
+    return ee.Geometry.Rectangle(shard["bbox"], None, False).intersection(geom, ee.ErrorMargin(1))
+
+
+def _write_json(path: Path, data: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
 
-# ---------- Export: tiles ----------
 
 def download_sentinel_tiles_via_drive(
     aoi_geojson=None,
@@ -88,37 +274,56 @@ def download_sentinel_tiles_via_drive(
     export_scale=20,
     out_dir="data/raw",
     wait_for_tasks=True,
+    on_task_done=None,
+    shard_deg=None,
+    max_active=None,
+    submit_workers=8,
 ):
     """
-    Filtra coleção Sentinel-2, ordena por nuvem, limita em 'max_tiles' e exporta cada imagem.
-    Baixa B4/B8 (int16) recortadas ao AOI. Se 'wait_for_tasks' True, fica aguardando.
+    Filtra coleção Sentinel-2 e exporta, por shard da grade do AOI (shard_deg graus; None → AOI inteiro),
+    as 'max_tiles' imagens menos nubladas, com B4/B8 (int16) recortadas ao shard.
+    Tarefas iniciadas em paralelo com no máximo 'max_active' em andamento (cota do EE).
+    O mapeamento shard → imagem → tarefa → prefixo de arquivo (e o estado) fica em out_dir/export_plan.json
+    (lido por drive_sync.expected_exports).
+    Se 'wait_for_tasks' True, fica aguardando; 'on_task_done(task, status)' roda assim que cada export termina.
     """
     _init_ee()
     geom = _geometry_from_inputs(aoi_geojson, bbox)
-
-    col = (ee.ImageCollection(collection)
-           .filterDate(start_date, end_date)
-           .filterBounds(geom)
-           .filter(ee.Filter.lte("CLOUDY_PIXEL_PERCENTAGE", int(cloud_filter)))
-           .sort("CLOUDY_PIXEL_PERCENTAGE"))
-
-    # Deixa para o export (mais leve).
-    imgs = col.limit(int(max_tiles))
-    count = imgs.size().getInfo()
+    shards = plan_exports(aoi_geojson, bbox, start_date, end_date, collection, cloud_filter, max_tiles, shard_deg)
+    count = sum(len(sh["images"]) for sh in shards)
     log.info("[EE] Imagens candidatas (após filtros/ordenação): %s", count)
 
-    tasks = []
-    for i in range(int(count)):
-        img = ee.Image(imgs.toList(count).get(i)).select(["B4", "B8"]).clip(geom).toInt16()
-        desc = f"vigiai_tile_{i:04d}"
-        task = _make_export_task(img, geom, desc, drive_folder, int(export_scale))
-        task.start()
-        tasks.append(task)
+    plan_path = Path(out_dir) / PLAN_FILE
+    plan = {"created_at": datetime.datetime.now().isoformat(timespec="seconds"), "collection": collection,
+            "start_date": start_date, "end_date": end_date, "drive_folder": drive_folder, "scale": int(export_scale),
+            "shard_deg": shard_deg, "shards": shards}
+    by_desc, lock = {}, threading.Lock()
+    jobs = []
+    for sh in shards:
+        region = _shard_region(sh, geom, len(shards))
+        for im in sh["images"]:
+            im.update(file_prefix=im["description"], task_id=None, state="PLANNED")
+            by_desc[im["description"]] = im
+            img = ee.Image(im["image_id"]).select(["B4", "B8"]).clip(region).toInt16()
+            jobs.append((im["description"],
+                         lambda img=img, region=region, d=im["description"]:
+                             _make_export_task(img, region, d, drive_folder, int(export_scale))))
+    _write_json(plan_path, plan)
 
-    log.info("[EE] %d tarefas submetidas para a pasta do Drive: '%s' (scale=%s m)", len(tasks), drive_folder, export_scale)
+    def _on_state(desc, task, s):
+        with lock:
+            im = by_desc[desc]
+            im["task_id"] = getattr(task, "id", None) or im["task_id"]
+            im["state"] = s.get("state")
+            if s.get("error_message"): im["error"] = s["error_message"]
+            _write_json(plan_path, plan)
 
-    if wait_for_tasks and tasks:
-        _wait_for(tasks)
+    cap = int(max_active or MAX_ACTIVE_TASKS)
+    if jobs:
+        asyncio.run(submit_tasks(jobs, cap, wait=bool(wait_for_tasks), on_done=on_task_done, on_state=_on_state,
+                                 workers=submit_workers))
+    log.info("[EE] %d tarefas submetidas para a pasta do Drive: '%s' (scale=%s m, até %d simultâneas); plano em %s",
+             len(jobs), drive_folder, export_scale, cap, plan_path)
 
     Path(out_dir).mkdir(parents=True, exist_ok=True)
     return int(count)
@@ -151,7 +356,8 @@ def download_mosaic_via_drive(
 
     img = col.select(["B4", "B8"]).median().clip(geom).toInt16()
     task = _make_export_task(img, geom, description, drive_folder, int(export_scale))
-    task.start()
+    with call("gee", "task.start"):
+        task.start()
     log.info("[EE] 1 tarefa (mosaico) submetida para o Drive: '%s' (scale=%s m)", drive_folder, export_scale)
 
     if wait_for_task:
@@ -1,8 +1,312 @@
-from pathlib import Path
-import sqlite3
+from __future__ import annotations
+from pathlib import Path, PureWindowsPath
+import datetime, sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT, started_at TEXT NOT NULL, finished_at TEXT,
+    model_path TEXT, source TEXT, n_tiles INTEGER, status TEXT NOT NULL DEFAULT 'running');
+CREATE TABLE IF NOT EXISTS predictions (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id), tile TEXT NOT NULL, path TEXT,
+    prob REAL, pred INTEGER, created_at TEXT NOT NULL, PRIMARY KEY (run_id, tile)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_predictions_tile ON predictions (tile, run_id);
+CREATE INDEX IF NOT EXISTS idx_predictions_time ON predictions (created_at);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Conexão em modo WAL (leitores não bloqueiam a escrita das execuções agendadas)."""
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=WAL"); con.execute("PRAGMA synchronous=NORMAL")
+    con.row_factory = sqlite3.Row
+    return con
+
+
+def tile_key(p) -> str:
+    """Nome do arquivo, aceitando caminhos com '/' ou '\\' (DBs gerados no Windows)."""
+    return PureWindowsPath(str(p)).name
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def _migrate_legacy_predictions(con: sqlite3.Connection):
+    """Tabela antiga (path, prob, pred) sem chave → vira a execução 'legacy' do novo esquema."""
+    cols = [r[1] for r in con.execute("PRAGMA table_info(predictions)")]
+    if not cols or "run_id" in cols: return
+    con.execute("ALTER TABLE predictions RENAME TO predictions_legacy")
+    con.executescript(_SCHEMA)
+    ts = _now()
+    rid = con.execute("INSERT INTO runs (started_at, finished_at, source, status) VALUES (?, ?, 'legacy', 'done')", (ts, ts)).lastrowid
+    con.executemany("INSERT OR REPLACE INTO predictions (run_id, tile, path, prob, pred, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(rid, tile_key(p), p, prob, pred, ts) for p, prob, pred in
+                     con.execute("SELECT path, prob, pred FROM predictions_legacy WHERE path IS NOT NULL")])
+    con.execute("UPDATE runs SET n_tiles=(SELECT COUNT(*) FROM predictions WHERE run_id=?) WHERE run_id=?", (rid, rid))
+    con.execute("DROP TABLE predictions_legacy")
+
 
 def init_db(path: str):
     p = Path(path); p.parent.mkdir(parents=True, exist_ok=True)
-    con = sqlite3.connect(p)
-    con.execute("CREATE TABLE IF NOT EXISTS predictions (path TEXT, prob REAL, pred INTEGER)")
+    con = connect(p)
+    with con:
+        _migrate_legacy_predictions(con)
+    con.executescript(_SCHEMA)
+    con.execute("""CREATE TABLE IF NOT EXISTS ndvi_manifest (
+        out_path TEXT PRIMARY KEY, src_path TEXT NOT NULL, src_size INTEGER, src_mtime_ns INTEGER,
+        src_sha256 TEXT, params TEXT, status TEXT NOT NULL DEFAULT 'ok', updated_at TEXT DEFAULT CURRENT_TIMESTAMP)""")
+    con.executescript(_FOOTPRINT_SCHEMA)
+    con.executescript(_STATS_SCHEMA)
     con.commit(); con.close()
+
+
+# ---------- Manifesto do NDVI (recompute incremental) ----------
+
+def load_ndvi_manifest(path: str, out_paths=None) -> dict:
+    """{out_path: {src_path, src_size, src_mtime_ns, src_sha256, params, status}}; 'out_paths' limita às saídas dadas."""
+    con = sqlite3.connect(path); con.row_factory = sqlite3.Row
+    if out_paths is None:
+        rows = con.execute("SELECT * FROM ndvi_manifest").fetchall()
+    else:
+        keys = list(out_paths)
+        rows = [r for i in range(0, len(keys), 500) for r in con.execute(
+            f"SELECT * FROM ndvi_manifest WHERE out_path IN ({', '.join('?' * len(keys[i:i+500]))})", keys[i:i+500])]
+    con.close()
+    return {r["out_path"]: dict(r) for r in rows}
+
+
+def upsert_ndvi_manifest(path: str, entries: list, con: sqlite3.Connection | None = None):
+    if not entries: return
+    own = con is None
+    if own: con = sqlite3.connect(path)
+    with con:
+        con.executemany("""INSERT INTO ndvi_manifest (out_path, src_path, src_size, src_mtime_ns, src_sha256, params, status, updated_at)
+            VALUES (:out_path, :src_path, :src_size, :src_mtime_ns, :src_sha256, :params, :status, CURRENT_TIMESTAMP)
+            ON CONFLICT(out_path) DO UPDATE SET src_path=excluded.src_path, src_size=excluded.src_size,
+                src_mtime_ns=excluded.src_mtime_ns, src_sha256=excluded.src_sha256, params=excluded.params,
+                status=excluded.status, updated_at=CURRENT_TIMESTAMP""", entries)
+    if own: con.close()
+
+
+def mark_ndvi_stale(path: str, out_paths: list):
+    if not out_paths: return
+    con = sqlite3.connect(path)
+    with con:
+        con.executemany("UPDATE ndvi_manifest SET status='stale', updated_at=CURRENT_TIMESTAMP WHERE out_path=?",
+                        [(p,) for p in out_paths])
+    con.close()
+
+
+# ---------- Catálogo de footprints (índice espacial R*Tree) ----------
+
+_FOOTPRINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS footprints (
+    fid INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, tile TEXT NOT NULL, kind TEXT NOT NULL,
+    crs TEXT, res_x REAL, res_y REAL, width INTEGER, height INTEGER, acq_date TEXT,
+    src_path TEXT, mtime_ns INTEGER, updated_at TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX IF NOT EXISTS idx_footprints_date ON footprints (kind, acq_date);
+CREATE VIRTUAL TABLE IF NOT EXISTS footprints_rtree USING rtree(fid, min_lon, max_lon, min_lat, max_lat);
+"""
+
+
+def upsert_footprints(path: str, entries: list):
+    """
+    entries: {path, kind ('raw'|'ndvi'), crs, res_x, res_y, width, height, acq_date, src_path, mtime_ns,
+    bounds=(W, S, E, N) em EPSG:4326}. Mesmo 'path' → atualiza a linha e o retângulo do R*Tree.
+    """
+    if not entries: return
+    con = connect(path)
+    with con:
+        for e in entries:
+            fid = con.execute("""INSERT INTO footprints (path, tile, kind, crs, res_x, res_y, width, height, acq_date, src_path, mtime_ns, updated_at)
+                VALUES (:path, :tile, :kind, :crs, :res_x, :res_y, :width, :height, :acq_date, :src_path, :mtime_ns, CURRENT_TIMESTAMP)
+                ON CONFLICT(path) DO UPDATE SET tile=excluded.tile, kind=excluded.kind, crs=excluded.crs, res_x=excluded.res_x,
+                    res_y=excluded.res_y, width=excluded.width, height=excluded.height, acq_date=excluded.acq_date,
+                    src_path=excluded.src_path, mtime_ns=excluded.mtime_ns, updated_at=CURRENT_TIMESTAMP
+                RETURNING fid""", {"tile": tile_key(e["path"]), "src_path": None, **e, "path": str(e["path"])}).fetchone()[0]
+            w, s, ea, n = e["bounds"]
+            con.execute("INSERT OR REPLACE INTO footprints_rtree VALUES (?, ?, ?, ?, ?)", (fid, w, ea, s, n))
+    con.close()
+
+
+def delete_footprints(path: str, paths: list):
+    if not paths: return
+    con = connect(path)
+    with con:
+        for p in paths:
+            r = con.execute("DELETE FROM footprints WHERE path=? RETURNING fid", (str(p),)).fetchone()
+            if r: con.execute("DELETE FROM footprints_rtree WHERE fid=?", (r[0],))
+    con.close()
+
+
+def load_footprints(path: str, kind: str | None = None) -> dict:
+    """{path: linha} (sem os retângulos); usado para saber o que já está indexado."""
+    con = connect(path)
+    q, args = "SELECT * FROM footprints", ()
+    if kind: q, args = q + " WHERE kind=?", (kind,)
+    rows = con.execute(q, args).fetchall(); con.close()
+    return {r["path"]: dict(r) for r in rows}
+
+
+def query_footprints(path: str, bbox=None, start: str | None = None, end: str | None = None,
+                     kind: str | None = "ndvi") -> list:
+    """
+    Tiles cujo retângulo (EPSG:4326) intersecta bbox (W, S, E, N) e cuja data de aquisição
+    está em [start, end] (AAAA-MM-DD). Só consulta o SQLite (R*Tree), sem abrir rasters.
+    """
+    q = """SELECT f.*, r.min_lon, r.min_lat, r.max_lon, r.max_lat FROM footprints f
+        JOIN footprints_rtree r ON r.fid = f.fid WHERE 1=1"""
+    args = []
+    if bbox is not None:
+        w, s, e, n = map(float, bbox)
+        q += " AND r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?"; args += [w, e, s, n]
+    if start: q += " AND f.acq_date >= ?"; args.append(start)
+    if end: q += " AND f.acq_date <= ?"; args.append(end)
+    if kind: q += " AND f.kind = ?"; args.append(kind)
+    con = connect(path)
+    rows = con.execute(q + " ORDER BY f.acq_date, f.path", args).fetchall(); con.close()
+    return [dict(r) for r in rows]
+
+
+# ---------- Estatísticas de NDVI por tile e por zona (ver ndvi_stats) ----------
+
+_STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ndvi_stats (
+    out_path TEXT PRIMARY KEY, tile TEXT NOT NULL, n_total INTEGER, n_valid INTEGER, mean REAL, std REAL,
+    min REAL, max REAL, p05 REAL, p25 REAL, p50 REAL, p75 REAL, p95 REAL,
+    lt_020 REAL, lt_040 REAL, lt_060 REAL, bins INTEGER, hist BLOB, mtime_ns INTEGER,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS ndvi_zone_stats (
+    out_path TEXT NOT NULL, zone_id INTEGER NOT NULL, zone TEXT, n INTEGER, sum REAL, sumsq REAL,
+    n_lt_020 INTEGER, n_lt_040 INTEGER, n_lt_060 INTEGER, PRIMARY KEY (out_path, zone_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_zone_stats_zone ON ndvi_zone_stats (zone_id);
+"""
+_STATS_COLS = ("out_path", "tile", "n_total", "n_valid", "mean", "std", "min", "max", "p05", "p25", "p50", "p75", "p95",
+               "lt_020", "lt_040", "lt_060", "bins", "hist", "mtime_ns")
+_ZONE_COLS = ("out_path", "zone_id", "zone", "n", "sum", "sumsq", "n_lt_020", "n_lt_040", "n_lt_060")
+
+
+def upsert_ndvi_stats(path: str, entries: list, con: sqlite3.Connection | None = None):
+    """entries: saída de NDVIStats.result (+ mtime_ns); as zonas do tile são substituídas por inteiro."""
+    if not entries: return
+    own = con is None
+    if own: con = connect(path)
+    with con:
+        con.executemany(f"INSERT OR REPLACE INTO ndvi_stats ({', '.join(_STATS_COLS)}, updated_at) "
+                        f"VALUES ({', '.join(':' + c for c in _STATS_COLS)}, CURRENT_TIMESTAMP)",
+                        [{"mtime_ns": None, **e} for e in entries])
+        con.executemany("DELETE FROM ndvi_zone_stats WHERE out_path=?", [(e["out_path"],) for e in entries])
+        con.executemany(f"INSERT INTO ndvi_zone_stats ({', '.join(_ZONE_COLS)}) VALUES ({', '.join(':' + c for c in _ZONE_COLS)})",
+                        [z for e in entries for z in e.get("zones", ())])
+    if own: con.close()
+
+
+def load_ndvi_stats_mtimes(path: str) -> dict:
+    con = connect(path)
+    rows = con.execute("SELECT out_path, mtime_ns FROM ndvi_stats").fetchall(); con.close()
+    return {r[0]: r[1] for r in rows}
+
+
+def load_ndvi_stats(path: str, tiles=None) -> list:
+    """Estatísticas por tile + data de aquisição e retângulo do catálogo; 'tiles' (nomes/caminhos) filtra."""
+    con = connect(path)
+    rows = con.execute("""SELECT s.*, f.acq_date, r.min_lon, r.min_lat, r.max_lon, r.max_lat FROM ndvi_stats s
+        LEFT JOIN footprints f ON f.path = s.out_path LEFT JOIN footprints_rtree r ON r.fid = f.fid
+        ORDER BY s.tile""").fetchall()
+    con.close()
+    keep = {tile_key(t) for t in tiles} if tiles is not None else None
+    return [dict(r) for r in rows if keep is None or r["tile"] in keep]
+
+
+def zone_aggregates(path: str, tiles=None) -> list:
+    """Soma dos agregados zonais entre tiles: n, média, desvio e fração abaixo dos limiares por zona."""
+    con = connect(path)
+    q = """SELECT z.zone_id, z.zone, SUM(z.n) AS n, SUM(z.sum) AS sum, SUM(z.sumsq) AS sumsq, COUNT(*) AS tiles,
+        SUM(z.n_lt_020) AS n_lt_020, SUM(z.n_lt_040) AS n_lt_040, SUM(z.n_lt_060) AS n_lt_060
+        FROM ndvi_zone_stats z"""
+    args = []
+    if tiles is not None:
+        names = sorted({tile_key(t) for t in tiles})
+        q += f" JOIN ndvi_stats s ON s.out_path = z.out_path WHERE s.tile IN ({', '.join('?' * len(names))})"
+        args = names
+    rows = con.execute(q + " GROUP BY z.zone_id ORDER BY z.zone_id", args).fetchall()
+    con.close()
+    out = []
+    for r in map(dict, rows):
+        n = r["n"] or 0
+        mean = r["sum"] / n if n else None
+        r.update(mean=mean, std=(max(r["sumsq"] / n - mean * mean, 0.0) ** 0.5) if n else None,
+                 **{c[2:]: (r[c] / n if n else None) for c in ("n_lt_020", "n_lt_040", "n_lt_060")})
+        out.append(r)
+    return out
+
+
+# ---------- Execuções e predições ----------
+# 'con' opcional: processos de longa duração (daemon) reutilizam uma conexão aberta.
+
+def start_run(path: str, model_path: str = None, source: str = None, con: sqlite3.Connection | None = None) -> int:
+    own = con is None
+    if own: con = connect(path)
+    with con:
+        rid = con.execute("INSERT INTO runs (started_at, model_path, source) VALUES (?, ?, ?)",
+                          (_now(), model_path, source)).lastrowid
+    if own: con.close()
+    return rid
+
+
+def finish_run(path: str, run_id: int, n_tiles: int, status: str = "done", con: sqlite3.Connection | None = None):
+    own = con is None
+    if own: con = connect(path)
+    with con:
+        con.execute("UPDATE runs SET finished_at=?, n_tiles=?, status=? WHERE run_id=?", (_now(), int(n_tiles), status, run_id))
+    if own: con.close()
+
+
+def insert_predictions(path: str, run_id: int, rows, batch: int = 50_000, con: sqlite3.Connection | None = None) -> int:
+    """
+    Upsert de predições ({path, prob, pred}) em uma única transação, em lotes de executemany.
+    'tile' = nome do arquivo (mesma chave usada na avaliação).
+    """
+    ts = _now(); n = 0
+    own = con is None
+    if own: con = connect(path)
+    with con:
+        buf = []
+        for r in rows:
+            buf.append((run_id, tile_key(r["path"]), str(r["path"]), float(r["prob"]), int(r["pred"]), ts))
+            if len(buf) >= batch:
+                con.executemany(_UPSERT, buf); n += len(buf); buf.clear()
+        if buf:
+            con.executemany(_UPSERT, buf); n += len(buf)
+    if own: con.close()
+    return n
+
+
+_UPSERT = """INSERT INTO predictions (run_id, tile, path, prob, pred, created_at) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(run_id, tile) DO UPDATE SET path=excluded.path, prob=excluded.prob, pred=excluded.pred, created_at=excluded.created_at"""
+
+
+def latest_predictions(path: str) -> list:
+    """Predição mais recente de cada tile entre as execuções concluídas (usa idx_predictions_tile)."""
+    con = connect(path)
+    rows = con.execute("""SELECT p.tile, p.path, p.prob, p.pred, p.run_id, p.created_at
+        FROM predictions p JOIN (SELECT q.tile, MAX(q.run_id) AS run_id FROM predictions q
+            JOIN runs r ON r.run_id = q.run_id WHERE r.status = 'done' GROUP BY q.tile) l
+        ON p.tile = l.tile AND p.run_id = l.run_id ORDER BY p.tile""").fetchall()
+    con.close()
+    return [dict(r) for r in rows]
+
+
+def rising_tiles(path: str, run_a: int = None, run_b: int = None, min_delta: float = 0.0) -> list:
+    """Tiles cuja prob subiu mais que 'min_delta' de run_a para run_b (padrão: as duas últimas execuções concluídas)."""
+    con = connect(path)
+    if run_a is None or run_b is None:
+        ids = [r[0] for r in con.execute("SELECT run_id FROM runs WHERE status='done' ORDER BY run_id DESC LIMIT 2")]
+        if len(ids) < 2:
+            con.close(); return []
+        run_b, run_a = ids
+    rows = con.execute("""SELECT b.tile, a.prob AS prob_before, b.prob AS prob_after, b.prob - a.prob AS delta
+        FROM predictions b JOIN predictions a ON a.tile = b.tile AND a.run_id = ?
+        WHERE b.run_id = ? AND b.prob - a.prob > ? ORDER BY delta DESC""", (run_a, run_b, float(min_delta))).fetchall()
+    con.close()
+    return [dict(r) for r in rows]
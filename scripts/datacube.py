@@ -0,0 +1,259 @@
+"""
+Datacube NDVI multi-data por AOI, em disco e memory-mapped.
+- Grade fixa (EPSG:4326) cobrindo o bbox do AOI; cada cena é reprojetada para ela.
+- Uma camada por data de aquisição: data/cube/<aoi>/<AAAA-MM-DD>.npy, float32, em layout
+  "chunk-major" (nby, nbx, C, C) → cada chunk é contíguo no disco.
+- Chunks nunca escritos são marcados em <data>.valid.npy (NaN na leitura). Custo em disco: cada camada tem
+  tamanho lógico nby*nbx*chunk²*4 bytes (ex.: ~1 GB por data a 60 m sobre um bbox de ~2°x2°); em sistemas
+  de arquivos com arquivos esparsos (ext4, xfs, btrfs, APFS) só os chunks escritos ocupam disco; em NTFS/FAT
+  a camada é alocada inteira na criação — dimensione cube.res_m / o bbox de acordo.
+- A escrita (append) reprojeta uma faixa de chunks por vez: memória ~ chunk x largura da cena.
+- cube.json guarda a grade e o índice de datas/origens.
+Detecção de mudança (detect_change) percorre chunk a chunk: delta, queda máxima e data da queda.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+import datetime, hashlib, json, logging, os, re
+import numpy as np, rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.transform import Affine, from_origin
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window, from_bounds
+from .ndvi_utils import read_ndvi
+
+log = logging.getLogger(__name__)
+
+CUBE_DIR = "data/cube"
+CHUNK = 512
+_DATE_RE = re.compile(r"(20\d{2})-?(\d{2})-?(\d{2})")
+
+
+def aoi_name(bbox) -> str:
+    """Nome estável do AOI a partir do bbox (quando o config não define 'cube.aoi')."""
+    return "aoi_" + hashlib.sha1(json.dumps([round(float(v), 6) for v in bbox]).encode()).hexdigest()[:8]
+
+
+def scene_date(tif: str | Path) -> str:
+    """
+    Data de aquisição (AAAA-MM-DD): tag ACQUISITION_DATE do GeoTIFF, senão uma data no nome
+    do arquivo (ex.: vigiai_tile_0003_20251014), senão o mtime do arquivo.
+    """
+    tif = Path(tif)
+    try:
+        with rio.open(tif) as ds:
+            tag = ds.tags().get("ACQUISITION_DATE")
+        if tag: return str(tag)[:10]
+    except Exception:
+        pass
+    m = _DATE_RE.search(tif.name)
+    if m:
+        try: return datetime.date(*map(int, m.groups())).isoformat()
+        except ValueError: pass
+    return datetime.date.fromtimestamp(tif.stat().st_mtime).isoformat()
+
+
+class NDVICube:
+    """Acesso a um datacube existente (ver open_cube)."""
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+        meta = json.loads((self.root / "cube.json").read_text(encoding="utf-8"))
+        self.meta = meta
+        self.crs = meta["crs"]
+        self.transform = Affine(*meta["transform"])
+        self.height, self.width, self.chunk = meta["height"], meta["width"], meta["chunk"]
+        self.nby, self.nbx = -(-self.height // self.chunk), -(-self.width // self.chunk)
+        self._ro: dict = {}  # data → (dados, máscara) abertos para leitura uma vez por cubo
+
+    # ----- índice -----
+    @property
+    def dates(self) -> list:
+        return sorted(self.meta["dates"])
+
+    def _save_meta(self):
+        tmp = self.root / "cube.json.tmp"
+        tmp.write_text(json.dumps(self.meta, indent=1), encoding="utf-8"); os.replace(tmp, self.root / "cube.json")
+
+    def _layer(self, date: str, mode: str = "r"):
+        """
+        (memmap dos dados, memmap da máscara de chunks válidos) de uma data. Em leitura, cada data é
+        aberta uma vez e reaproveitada por todos os chunks (detect_change percorre chunks × datas).
+        """
+        if mode == "r" and date in self._ro:
+            return self._ro[date]
+        shape = (self.nby, self.nbx, self.chunk, self.chunk)
+        data, valid = self.root / f"{date}.npy", self.root / f"{date}.valid.npy"
+        if mode == "r":
+            self._ro[date] = np.load(data, mmap_mode="r"), np.load(valid, mmap_mode="r")
+            return self._ro[date]
+        if mode == "r+" and not data.exists():
+            # arquivo esparso onde o sistema de arquivos suporta: só os chunks tocados ocupam disco
+            log.info("[Cube] Nova camada %s: %.0f MB lógicos.", date, 4 * np.prod(shape) / 2**20)
+            np.lib.format.open_memmap(data, "w+", "float32", shape).flush()
+            np.lib.format.open_memmap(valid, "w+", "bool", (self.nby, self.nbx)).flush()
+        return np.load(data, mmap_mode=mode), np.load(valid, mmap_mode=mode)
+
+    # ----- escrita -----
+    def _warp(self, ds, win: Window, scale: tuple) -> np.ndarray:
+        """
+        Reprojeta para a janela 'win' da grade só a parte da cena sob ela (com margem para o bilinear).
+        'scale' fixa a escala do kernel (XSCALE/YSCALE) na da cena inteira: sem isso o GDAL a deduz de
+        cada janela e as faixas sairiam diferentes de uma reprojeção única.
+        """
+        arr = np.full((int(win.height), int(win.width)), np.nan, dtype="float32")
+        b = transform_bounds(self.crs, ds.crs, *rio.windows.bounds(win, self.transform))
+        try:
+            f = from_bounds(*b, transform=ds.transform)
+            c0, r0 = int(np.floor(f.col_off)) - 2, int(np.floor(f.row_off)) - 2
+            sw = Window(c0, r0, int(np.ceil(f.col_off + f.width)) + 2 - c0, int(np.ceil(f.row_off + f.height)) + 2 - r0)
+            sw = sw.intersection(Window(0, 0, ds.width, ds.height))
+        except WindowError:  # faixa fora da cena
+            return arr
+        reproject(read_ndvi(ds, window=sw), arr, src_transform=ds.window_transform(sw), src_crs=ds.crs,
+                  src_nodata=np.nan, dst_nodata=np.nan, dst_transform=rio.windows.transform(win, self.transform),
+                  dst_crs=self.crs, resampling=Resampling.bilinear, XSCALE=scale[0], YSCALE=scale[1])
+        return arr
+
+    def append(self, ndvi_tif: str | Path, date: str | None = None, src: str | Path | None = None) -> str | None:
+        """
+        Reprojeta um NDVI para a grade e grava na camada da sua data (mesma data → mosaico, a última cena
+        vence onde tem dado). Uma faixa de chunks por vez (a cena nunca é reprojetada inteira na memória).
+        Retorna a data, ou None se a cena não toca o AOI.
+        """
+        ndvi_tif = Path(ndvi_tif)
+        date = date or scene_date(src or ndvi_tif)
+        with rio.open(ndvi_tif) as ds:
+            b = transform_bounds(ds.crs, self.crs, *ds.bounds)
+            f = from_bounds(*b, transform=self.transform)
+            c0, r0 = int(np.floor(f.col_off)), int(np.floor(f.row_off))
+            try:
+                win = Window(c0, r0, int(np.ceil(f.col_off + f.width)) - c0, int(np.ceil(f.row_off + f.height)) - r0)
+                win = win.intersection(Window(0, 0, self.width, self.height))
+            except WindowError:  # fora do AOI
+                log.warning("[Cube] %s fora do AOI; ignorado.", ndvi_tif.name); return None
+            data, valid = self._layer(date, "r+")
+            r0, c0, h, w, C = int(win.row_off), int(win.col_off), int(win.height), int(win.width), self.chunk
+            scale = (f.width / ds.width, f.height / ds.height)
+            for by in range(r0 // C, (r0 + h - 1) // C + 1):
+                y0, y1 = max(r0, by * C), min(r0 + h, (by + 1) * C)
+                arr = self._warp(ds, Window(c0, y0, w, y1 - y0), scale)
+                for bx in range(c0 // C, (c0 + w - 1) // C + 1):
+                    x0, x1 = max(c0, bx * C), min(c0 + w, (bx + 1) * C)
+                    part = arr[:, x0 - c0:x1 - c0]
+                    if np.isnan(part).all(): continue
+                    blk = data[by, bx]
+                    if not valid[by, bx]:
+                        blk[:] = np.nan; valid[by, bx] = True
+                    dst = blk[y0 - by * C:y1 - by * C, x0 - bx * C:x1 - bx * C]
+                    np.copyto(dst, part, where=~np.isnan(part))
+        data.flush(); valid.flush(); del data, valid
+        self._ro.pop(date, None)  # camada criada/alterada: a próxima leitura reabre
+        entry = self.meta["dates"].setdefault(date, {"sources": []})
+        name = Path(src or ndvi_tif).name
+        if name not in entry["sources"]: entry["sources"].append(name)
+        self._save_meta()
+        return date
+
+    # ----- leitura -----
+    def chunk_window(self, by: int, bx: int) -> Window:
+        C = self.chunk
+        return Window(bx * C, by * C, min(C, self.width - bx * C), min(C, self.height - by * C))
+
+    def read_chunk(self, by: int, bx: int, dates: list | None = None) -> np.ndarray:
+        """Série temporal de um chunk: (T, h, w) float32, NaN onde não há observação."""
+        dates = dates or self.dates
+        w = self.chunk_window(by, bx)
+        out = np.full((len(dates), int(w.height), int(w.width)), np.nan, dtype="float32")
+        for t, d in enumerate(dates):
+            data, valid = self._layer(d)
+            if valid[by, bx]: out[t] = data[by, bx, :int(w.height), :int(w.width)]
+        return out
+
+    def chunks_with_data(self, dates: list | None = None) -> list:
+        """Chunks (by, bx) observados em pelo menos uma das datas."""
+        acc = np.zeros((self.nby, self.nbx), dtype=bool)
+        for d in dates or self.dates:
+            acc |= np.asarray(self._layer(d)[1])
+        return [tuple(map(int, ij)) for ij in np.argwhere(acc)]
+
+
+def open_cube(root: str | Path, bbox=None, res: float | None = None, chunk: int = CHUNK) -> NDVICube:
+    """Abre o datacube em 'root'; se não existir, cria a grade a partir de bbox [W, S, E, N] e res (graus)."""
+    root = Path(root)
+    if (root / "cube.json").exists():
+        return NDVICube(root)
+    if bbox is None or res is None:
+        raise FileNotFoundError(f"Datacube inexistente em {root} (informe bbox e res para criar).")
+    w, s, e, n = map(float, bbox)
+    width, height = int(np.ceil((e - w) / res)), int(np.ceil((n - s) / res))
+    root.mkdir(parents=True, exist_ok=True)
+    meta = {"crs": "EPSG:4326", "transform": list(from_origin(w, n, res, res))[:6], "width": width, "height": height,
+            "chunk": int(chunk), "bbox": [w, s, e, n], "dates": {}}
+    (root / "cube.json").write_text(json.dumps(meta, indent=1), encoding="utf-8")
+    log.info("[Cube] Criado %s: %dx%d px, chunk %d.", root, width, height, chunk)
+    return NDVICube(root)
+
+
+def cube_from_cfg(cfg: dict) -> NDVICube:
+    """Datacube do AOI do config (bloco 'cube': dir, aoi, res_m, chunk; grade a partir de gee.bbox_approx)."""
+    gee, c = cfg.get("gee", {}), cfg.get("cube", {})
+    bbox = c.get("bbox") or gee.get("bbox_approx")
+    res = float(c.get("res_m", gee.get("export_scale", 60))) / 111_320.0
+    root = Path(c.get("dir", CUBE_DIR)) / (c.get("aoi") or aoi_name(bbox))
+    return open_cube(root, bbox, res, int(c.get("chunk", CHUNK)))
+
+
+# ---------- Detecção de mudança ----------
+
+def _change_stats(ts: np.ndarray) -> tuple:
+    """
+    ts: (T, h, w) em ordem de data. Por pixel:
+    - delta = última observação válida − primeira;
+    - queda máxima = max_t (máximo anterior a t − ndvi_t), ou seja, queda em relação ao pico já visto;
+    - índice da data dessa queda (-1 sem queda/observações insuficientes).
+    """
+    T = ts.shape[0]
+    ok = ~np.isnan(ts)
+    any_ok = ok.any(0)
+    first = np.argmax(ok, 0); last = T - 1 - np.argmax(ok[::-1], 0)
+    delta = np.take_along_axis(ts, last[None], 0)[0] - np.take_along_axis(ts, first[None], 0)[0]
+    delta[~any_ok] = np.nan
+    with np.errstate(invalid="ignore"):
+        peak = np.fmax.accumulate(ts, axis=0)  # ignora NaN
+        prior = np.concatenate([np.full((1,) + ts.shape[1:], np.nan, "float32"), peak[:-1]])
+        drop = prior - ts
+    has = ~np.isnan(drop).all(0)
+    idx = np.where(has, np.nanargmax(np.where(np.isnan(drop), -np.inf, drop), 0), -1)
+    max_drop = np.where(has, np.take_along_axis(drop, np.maximum(idx, 0)[None], 0)[0], np.nan).astype("float32")
+    return delta.astype("float32"), max_drop, idx
+
+
+def detect_change(cube: NDVICube | str | Path, out_dir: str | Path = "output/change", start: str | None = None,
+                  end: str | None = None, min_drop: float = 0.0) -> dict:
+    """
+    Mapas de mudança no intervalo [start, end] (datas AAAA-MM-DD), processando um chunk por vez
+    (memória ~ T × chunk²). Grava GeoTIFFs tiled: ndvi_delta.tif, ndvi_max_drop.tif e drop_date.tif
+    (AAAAMMDD, 0 = sem queda ≥ min_drop). Retorna os caminhos e as datas usadas.
+    """
+    cube = cube if isinstance(cube, NDVICube) else NDVICube(cube)
+    dates = [d for d in cube.dates if (start is None or d >= start) and (end is None or d <= end)]
+    if len(dates) < 2:
+        raise ValueError(f"Detecção de mudança precisa de ≥2 datas; há {len(dates)} no intervalo.")
+    codes = np.array([int(d.replace("-", "")) for d in dates], dtype="int32")
+    out = Path(out_dir); out.mkdir(parents=True, exist_ok=True)
+    base = {"driver": "GTiff", "height": cube.height, "width": cube.width, "count": 1, "crs": cube.crs,
+            "transform": cube.transform, "tiled": True, "blockxsize": cube.chunk, "blockysize": cube.chunk, "compress": "lzw"}
+    paths = {"delta": out / "ndvi_delta.tif", "max_drop": out / "ndvi_max_drop.tif", "drop_date": out / "drop_date.tif"}
+    with rio.open(paths["delta"], "w", dtype="float32", nodata=np.nan, **base) as d_ds, \
+         rio.open(paths["max_drop"], "w", dtype="float32", nodata=np.nan, **base) as m_ds, \
+         rio.open(paths["drop_date"], "w", dtype="int32", nodata=0, **base) as t_ds:
+        for ds in (d_ds, m_ds, t_ds): ds.update_tags(dates=",".join(dates))
+        for by, bx in cube.chunks_with_data(dates):
+            win = cube.chunk_window(by, bx)
+            delta, max_drop, idx = _change_stats(cube.read_chunk(by, bx, dates))
+            when = np.where((idx >= 0) & (max_drop >= min_drop), codes[np.maximum(idx, 0)], 0).astype("int32")
+            d_ds.write(delta, 1, window=win); m_ds.write(max_drop, 1, window=win); t_ds.write(when, 1, window=win)
+    log.info("[Cube] Mudança %s → %s (%d datas) em %s", dates[0], dates[-1], len(dates), out)
+    return {"dates": dates, **{k: str(v) for k, v in paths.items()}}
@@ -5,8 +5,11 @@ Sincronização com Google Drive usando PyDrive2.
 """
 
 from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Optional
+import hashlib, json, os, threading, time
+from .metrics import call
 
 try:
     from pydrive2.auth import GoogleAuth
@@ -47,47 +50,215 @@ def _find_folder_id(drive, folder_name: str) -> Optional[str]:
     return None
 
 
+def _list_exports(drive, parent_ids: list, prefix: str, page_size: int = 1000) -> list:
+    """
+    Uma única query paginada para todas as pastas ('fid' in parents or 'root' in parents).
+    Títulos repetidos: vale o primeiro (pasta alvo antes da raiz).
+    """
+    parents = " or ".join(f"'{p}' in parents" for p in parent_ids)
+    q = f"({parents}) and trashed = false and mimeType != 'application/vnd.google-apps.folder'"
+    if prefix: q += f" and title contains '{prefix}'"
+    order = {p: i for i, p in enumerate(parent_ids)}
+    files = []
+    pages = iter(drive.ListFile({'q': q, 'maxResults': page_size}))
+    while True:
+        with call("drive", "ListFile"):
+            page = next(pages, None)
+        if page is None: break
+        files.extend(f for f in page if not prefix or f['title'].startswith(prefix))
+
+    def _rank(f):
+        ps = [("root" if p.get('isRoot') else p.get('id')) for p in (f.get('parents') or [])]
+        return min([order.get(p, len(order)) for p in ps] or [len(order)])
+    seen, out = set(), []
+    for f in sorted(files, key=_rank):
+        if f['title'] in seen: continue
+        seen.add(f['title']); out.append(f)
+    return out
+
+
+def _md5(path: Path, chunk: int = 1 << 20) -> str:
+    h = hashlib.md5()
+    with open(path, "rb") as fh:
+        for buf in iter(lambda: fh.read(chunk), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+
+VERIFIED_FILE = ".drive_verified.json"  # em local_dir: {nome: [tamanho, mtime_ns, md5]} já conferidos
+_verified_lock = threading.Lock()
+
+
+def _load_verified(local: Path) -> dict:
+    try:
+        return json.loads((local / VERIFIED_FILE).read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def _save_verified(local: Path, entries: dict):
+    """Mescla com o que já está no arquivo (syncs concorrentes do pipeline) e grava atomicamente."""
+    if not entries: return
+    with _verified_lock:
+        cur = {**_load_verified(local), **entries}
+        tmp = local / f"{VERIFIED_FILE}.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(cur), encoding="utf-8"); os.replace(tmp, local / VERIFIED_FILE)
+
+
+def _stamp(out: Path, md5: str) -> list:
+    st = out.stat()
+    return [st.st_size, st.st_mtime_ns, md5]
+
+
+def _is_complete(out: Path, f, verified: dict | None = None, new: dict | None = None) -> bool:
+    """
+    Arquivo local só conta como baixado se bater tamanho e md5 do Drive (quando informados).
+    Tamanho é conferido primeiro; o md5 só é calculado uma vez por (nome, tamanho, mtime, md5 do Drive):
+    o resultado fica em 'verified' (e vai para 'new', gravado depois em VERIFIED_FILE).
+    """
+    if not out.exists(): return False
+    size, md5 = f.get('fileSize'), f.get('md5Checksum')
+    if size is not None and out.stat().st_size != int(size): return False
+    if md5 is None: return True
+    stamp = _stamp(out, md5)
+    if verified is not None and verified.get(out.name) == stamp: return True
+    if _md5(out) != md5: return False
+    if new is not None: new[out.name] = stamp
+    return True
+
+
+def _fetch_ranges(f, tmp: Path, size: int, chunksize: int) -> None:
+    """
+    Continua '<arquivo>.part' a partir do seu tamanho com pedidos HTTP Range de até 'chunksize' bytes
+    (cliente autorizado do PyDrive2); se o servidor ignorar o Range (200), recomeça do zero.
+    """
+    http = f.auth.Get_Http_Object()
+    url = f.get('downloadUrl') or f"https://www.googleapis.com/drive/v2/files/{f['id']}?alt=media"
+    with open(tmp, "ab") as fh:
+        pos = fh.tell()
+        if pos > size: fh.truncate(0); pos = 0
+        while pos < size:
+            with call("drive", "GetRange"):
+                resp, body = http.request(url, headers={"Range": f"bytes={pos}-{min(pos + chunksize, size) - 1}"})
+            if int(resp.status) not in (200, 206) or not body:
+                raise IOError(f"HTTP {resp.status} ao baixar {f['title']} (byte {pos})")
+            if int(resp.status) == 200 and pos:
+                fh.truncate(0); pos = 0
+            fh.write(body); pos += len(body)
+
+
+def _download_one(f, out: Path, retries: int = 3, backoff: float = 2.0, chunksize: int = 8 << 20) -> int:
+    """
+    Baixa para '<arquivo>.part', confere o md5 e renomeia atomicamente.
+    Falha → nova tentativa com backoff exponencial; com tamanho conhecido e cliente HTTP do PyDrive2,
+    a tentativa continua o .part de onde parou (Range). md5 divergente descarta o .part. Retorna bytes baixados.
+    """
+    tmp = out.with_name(out.name + ".part")
+    size = f.get('fileSize')
+    resumable = size is not None and hasattr(getattr(f, "auth", None), "Get_Http_Object")
+    tmp.unlink(missing_ok=True)
+    for attempt in range(int(retries) + 1):
+        try:
+            if resumable:
+                _fetch_ranges(f, tmp, int(size), chunksize)
+            else:
+                tmp.unlink(missing_ok=True)
+                with call("drive", "GetContentFile"):
+                    f.GetContentFile(tmp.as_posix(), chunksize=chunksize)
+            md5 = f.get('md5Checksum')
+            if md5 and _md5(tmp) != md5:
+                tmp.unlink(missing_ok=True)
+                raise IOError(f"md5 divergente para {out.name}")
+            os.replace(tmp, out)
+            return out.stat().st_size
+        except Exception as e:
+            if attempt >= int(retries):
+                tmp.unlink(missing_ok=True)
+                raise
+            wait = backoff * (2 ** attempt)
+            print(f"[Drive] {out.name}: {e} — nova tentativa em {wait:.0f}s ({attempt+1}/{retries})")
+            time.sleep(wait)
+
+
 def download_new_exports(folder_name: str = "VigiAI",
                          local_dir: str = "data/raw",
                          prefix: str = "vigiai_tile_",
-                         dry_run: bool = False):
+                         dry_run: bool = False,
+                         drive=None,
+                         workers: int = 4,
+                         retries: int = 3,
+                         backoff: float = 2.0,
+                         db_path: Optional[str] = None):
     """
     Baixa do Drive todos os .tif com prefixo, estejam na pasta alvo OU na raiz.
+    Downloads em paralelo (pool limitado a 'workers'), com verificação de md5 e retry.
+    Com 'db_path', os arquivos baixados entram no catálogo de footprints.
+    'drive' permite injetar um cliente (ex.: fake em testes) com ListFile/GetContentFile.
     """
     local = Path(local_dir); local.mkdir(parents=True, exist_ok=True)
 
-    gauth, drive = _gauth()
     if drive is None:
-        return 0
-
-    parent_queries = []
+        gauth, drive = _gauth()
+        if drive is None:
+            return 0
 
-    # 1) pasta alvo (se existir)
+    # pasta alvo (se existir) + raiz, numa única listagem
     fid = _find_folder_id(drive, folder_name)
-    if fid:
-        parent_queries.append(f"'{fid}' in parents")
-
-    # 2) sempre varre a raiz também
-    parent_queries.append("'root' in parents")
-
-    n = 0
-    for pq in parent_queries:
-        q = f"{pq} and trashed = false and mimeType != 'application/vnd.google-apps.folder'"
-        files = drive.ListFile({'q': q}).GetList()
-        for f in files:
-            title = f['title']
-            if prefix and not title.startswith(prefix):
-                continue
-            # garante a extensão .tif
-            if not title.lower().endswith(('.tif', '.tiff')):
-                title = title + ".tif"
-            out = local / title
-            if out.exists():
-                continue
-            print(f"[Drive] Baixando {title} -> {out}")
-            if not dry_run:
-                f.GetContentFile(out.as_posix())
-            n += 1
-
-    print(f"[Drive] {n} novos arquivos baixados para {local_dir}.")
+    files = _list_exports(drive, ([fid] if fid else []) + ["root"], prefix)
+
+    todo, verified, new = [], _load_verified(local), {}
+    for f in files:
+        title = f['title']
+        # garante a extensão .tif
+        if not title.lower().endswith(('.tif', '.tiff')):
+            title = title + ".tif"
+        out = local / title
+        if _is_complete(out, f, verified, new):
+            continue
+        print(f"[Drive] Baixando {title} -> {out}")
+        todo.append((f, out))
+
+    if dry_run or not todo:
+        _save_verified(local, new)
+        print(f"[Drive] {len(todo)} novos arquivos {'a baixar' if dry_run else 'baixados'} para {local_dir}.")
+        return len(todo)
+
+    t0, total, done = time.perf_counter(), 0, []
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as ex:
+        futs = {ex.submit(_download_one, f, out, retries, backoff): out for f, out in todo}
+        for fut in as_completed(futs):
+            try:
+                total += fut.result(); done.append(futs[fut])
+            except Exception as e:
+                print(f"[Drive] Falha ao baixar {futs[fut].name}: {e}")
+    md5s = {out: f.get('md5Checksum') for f, out in todo}
+    new.update({out.name: _stamp(out, md5s[out]) for out in done if md5s[out]})  # já conferidos no download
+    _save_verified(local, new)
+    n = len(done)
+    if db_path:
+        from .catalog import record_footprints
+        from .database import init_db
+        init_db(db_path); record_footprints(db_path, sorted(done), "raw")
+    dt = max(time.perf_counter() - t0, 1e-9)
+    print(f"[Drive] {n} novos arquivos baixados para {local_dir} "
+          f"({total/2**20:.1f} MB em {dt:.1f}s, {total/2**20/dt:.1f} MB/s).")
     return n
+
+
+def load_export_plan(local_dir: str = "data/raw") -> Optional[dict]:
+    """Plano gravado por data_processing.download_sentinel_tiles_via_drive (local_dir/export_plan.json)."""
+    p = Path(local_dir) / "export_plan.json"
+    return json.loads(p.read_text(encoding="utf-8")) if p.exists() else None
+
+
+def expected_exports(local_dir: str = "data/raw", states=("COMPLETED",)) -> list:
+    """Prefixos (description) dos arquivos esperados segundo o plano, para exports nos estados dados (None = todos)."""
+    plan = load_export_plan(local_dir) or {"shards": []}
+    return [im["file_prefix"] for sh in plan["shards"] for im in sh["images"]
+            if states is None or im.get("state") in states]
+
+
+def missing_exports(local_dir: str = "data/raw") -> list:
+    """Exports concluídos no EE cujo arquivo (prefixo*.tif) ainda não está em local_dir."""
+    have = [p.name for p in Path(local_dir).glob("*.tif")]
+    return [d for d in expected_exports(local_dir) if not any(n.startswith(d) for n in have)]
@@ -1,38 +1,198 @@
+"""
+Avaliação em streaming: lê as predições em blocos (CSV ou tabela 'predictions' do SQLite),
+junta com os labels por nome do arquivo (operações vetorizadas) e acumula um histograma de
+scores por classe (memória fixa, independe do nº de predições). Uma passada pelos bins em ordem
+decrescente dá ROC, PR, AUC, o limiar de melhor F1 e a tabela limiar × métricas.
+"""
+
 from __future__ import annotations
 from pathlib import Path
-import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.metrics import confusion_matrix, classification_report
-import numpy as np
+import json
+import numpy as np, pandas as pd
+from .database import tile_key
 
+BINS = 100_000  # resolução dos limiares: 1e-5
 
-def evaluate_from_csv(results_csv: str, labels_csv: str, out_dir: str = "output/figures", threshold: float = 0.5):
-    out = Path(out_dir); out.mkdir(parents=True, exist_ok=True)
-    rcsv, lcsv = Path(results_csv), Path(labels_csv)
-    if not (rcsv.exists() and lcsv.exists()):
-        print("[Eval] Precisa de results_csv e labels_csv."); return None
-    dfp = pd.read_csv(rcsv)
-    dfl = pd.read_csv(lcsv)
-    # normaliza chave por nome do arquivo
-    dfp['key'] = dfp['path'].apply(lambda p: Path(p).name)
-    dfl['key'] = dfl['path'].apply(lambda p: Path(p).name)
-    df = dfp.merge(dfl[['key','label']], on='key', how='inner')
-
-    if df.empty:
-        print("[Eval] Não houve interseção entre predições e labels."); return None
-    y_true = df['label'].astype(int).to_numpy()
-    y_pred = (df['prob'].to_numpy() > threshold).astype(int)
-    cm = confusion_matrix(y_true, y_pred)
-    rep = classification_report(y_true, y_pred, digits=3)
+
+def _keys(s: pd.Series) -> pd.Series:
+    """Nome do arquivo (aceita '/' e '\\'), vetorizado — mesma chave de database.tile_key."""
+    return s.astype(str).str.replace("\\", "/", regex=False).str.rsplit("/", n=1).str[-1]
+
+
+def _load_labels(labels_csv: str | Path) -> pd.Series:
+    dfl = pd.read_csv(labels_csv, usecols=["path", "label"])
+    return pd.Series(dfl["label"].astype("int8").to_numpy(), index=_keys(dfl["path"])).groupby(level=0).last()
+
+
+def _bin_index(prob: np.ndarray, bins: int) -> np.ndarray:
+    """Bin j tal que 'prob > j/bins' ⇔ índice ≥ j (mesma regra de 'pred = prob > limiar')."""
+    return np.clip(np.ceil(prob * bins).astype("int64") - 1, 0, bins - 1)
+
+
+def _accumulate(chunks, labels: pd.Series, tiles=None, threshold: float = 0.5, bins: int = BINS) -> dict:
+    pos, neg = np.zeros(bins, "int64"), np.zeros(bins, "int64")
+    cm = np.zeros((2, 2), "int64"); n_in, n_join = 0, 0
+    keep = {tile_key(t) for t in tiles} if tiles is not None else None
+    for ch in chunks:
+        n_in += len(ch)
+        # chave/label calculados só sobre os caminhos distintos do bloco (muitas linhas por tile)
+        codes, uniq = pd.factorize(ch["tile"] if "tile" in ch.columns else ch["path"])
+        ukey = pd.Series(uniq) if "tile" in ch.columns else _keys(pd.Series(uniq))
+        ulab = ukey.map(labels).to_numpy(dtype="float64")
+        uok = ~np.isnan(ulab)
+        if keep is not None: uok &= ukey.isin(keep).to_numpy()
+        ok = (codes >= 0) & uok[codes]
+        if not ok.any(): continue
+        y = ulab[codes[ok]].astype("int64"); p = ch["prob"].to_numpy(dtype="float64")[ok]
+        n_join += len(y)
+        idx = _bin_index(p, bins)
+        pos += np.bincount(idx[y == 1], minlength=bins); neg += np.bincount(idx[y == 0], minlength=bins)
+        cm += np.bincount(2 * y + (p > threshold), minlength=4).reshape(2, 2)
+    return {"pos": pos, "neg": neg, "cm": cm, "n_in": n_in, "n": n_join}
+
+
+def sweep(pos: np.ndarray, neg: np.ndarray) -> pd.DataFrame:
+    """
+    Uma passada do maior para o menor bin: para cada limiar t = j/bins (pred = prob > t),
+    tp/fp/fn/tn, tpr, fpr, precision, recall, f1, accuracy.
+    """
+    bins = len(pos)
+    tp = np.cumsum(pos[::-1])[::-1]; fp = np.cumsum(neg[::-1])[::-1]
+    P, N = int(pos.sum()), int(neg.sum())
+    fn, tn = P - tp, N - fp
+    with np.errstate(divide="ignore", invalid="ignore"):
+        prec = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+        rec = tp / P if P else np.zeros(bins)
+        fpr = fp / N if N else np.zeros(bins)
+        f1 = np.where(prec + rec > 0, 2 * prec * rec / (prec + rec), 0.0)
+    return pd.DataFrame({"threshold": np.arange(bins) / bins, "tp": tp, "fp": fp, "fn": fn, "tn": tn,
+                         "tpr": rec, "fpr": fpr, "precision": prec, "recall": rec, "f1": f1,
+                         "accuracy": (tp + tn) / max(P + N, 1)})
+
+
+def _curves(tab: pd.DataFrame, occupied: np.ndarray) -> dict:
+    """
+    ROC/PR nos bins com predições (limiar crescente → fpr/recall decrescentes) e áreas.
+    Com uma classe só, as áreas são indefinidas: NaN (null no evaluation.json), não 0.
+    """
+    t = tab[occupied]
+    P, N = int(tab["tp"].iloc[0] + tab["fn"].iloc[0]), int(tab["fp"].iloc[0] + tab["tn"].iloc[0])
+    fpr, tpr = np.r_[t["fpr"].to_numpy(), 0.0], np.r_[t["tpr"].to_numpy(), 0.0]
+    auc = float(np.sum((fpr[:-1] - fpr[1:]) * (tpr[:-1] + tpr[1:]) / 2)) if P and N else float("nan")
+    rec, prec = np.r_[t["recall"].to_numpy(), 0.0], np.r_[t["precision"].to_numpy(), 1.0]
+    ap = float(np.sum((rec[:-1] - rec[1:]) * prec[:-1])) if P else float("nan")  # average precision (degraus, como o sklearn)
+    if not (P and N):
+        print(f"[Eval] Aviso: só há exemplos {'positivos' if P else 'negativos'} avaliados; "
+              f"{'AUC indefinida' if P else 'AUC e AP indefinidas'} (NaN).")
+    return {"fpr": fpr, "tpr": tpr, "recall": rec, "precision": prec, "auc_roc": auc, "auc_pr": ap}
+
+
+def _fmt(v: float) -> str:
+    return "n/d" if np.isnan(v) else f"{v:.3f}"
+
+
+def _report(cm: np.ndarray) -> str:
+    """
+    Texto do classification_report (digits=3) direto da matriz de confusão inteira, sem materializar
+    os vetores: mesmo layout do sklearn, com support inteiro; só as classes que aparecem.
+    """
+    cm = np.asarray(cm, dtype="int64")
+    labels = [i for i in range(len(cm)) if cm[i, :].sum() + cm[:, i].sum() > 0]
+    rows = []
+    for i in labels:
+        tp, pred, sup = cm[i, i], cm[:, i].sum(), cm[i, :].sum()
+        p, r = (tp / pred if pred else 0.0), (tp / sup if sup else 0.0)
+        f1 = 2 * tp / (pred + sup) if pred + sup else 0.0
+        rows.append((str(i), p, r, f1, int(sup)))
+    sup = np.array([row[4] for row in rows]); total = int(sup.sum())
+    prf = np.array([row[1:4] for row in rows], dtype="float64")
+    width, d = len("weighted avg"), 3
+    row_fmt = "{:>{width}s} " + " {:>9.{d}f}" * 3 + " {:>9}\n"
+    rep = ("{:>{width}s} " + " {:>9}" * 4).format("", "precision", "recall", "f1-score", "support", width=width) + "\n\n"
+    rep += "".join(row_fmt.format(*row, width=width, d=d) for row in rows) + "\n"
+    rep += ("{:>{width}s} " + " {:>9}" * 2 + " {:>9.{d}f} {:>9}\n").format(
+        "accuracy", "", "", np.trace(cm) / total if total else 0.0, total, width=width, d=d)
+    rep += row_fmt.format("macro avg", *prf.mean(axis=0), total, width=width, d=d)
+    rep += row_fmt.format("weighted avg", *(sup @ prf / total if total else prf.mean(axis=0)), total, width=width, d=d)
+    return rep
+
+
+def _write_outputs(acc: dict, out: Path, threshold: float, table_step: float) -> dict:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    tab = sweep(acc["pos"], acc["neg"])
+    cur = _curves(tab, (acc["pos"] + acc["neg"]) > 0)
+    best = tab.iloc[int(tab["f1"].to_numpy().argmax())]
+    cm = acc["cm"]
+    rep = _report(cm)
     (out/"metricas_modelo.txt").write_text(rep, encoding="utf-8")
+    bins = len(acc["pos"]); step = max(1, int(round(table_step * bins)))
+    tab.iloc[::step].to_csv(out/"threshold_table.csv", index=False, float_format="%.6g")
+    summary = {"n_predictions": int(acc["n_in"]), "n_evaluated": int(acc["n"]), "positives": int(acc["pos"].sum()),
+               **{k: (None if np.isnan(cur[k]) else cur[k]) for k in ("auc_roc", "auc_pr")}, "best_f1": float(best["f1"]),
+               "best_threshold": float(best["threshold"]), "threshold": threshold, "cm": cm.tolist()}
+    (out/"evaluation.json").write_text(json.dumps(summary, indent=2), encoding="utf-8")
+
     # Matriz de confusão
     fig, ax = plt.subplots(figsize=(4,4))
-    im = ax.imshow(cm, interpolation="nearest")
+    ax.imshow(cm, interpolation="nearest")
     ax.set_title("Matriz de confusão"); ax.set_xlabel("Predito"); ax.set_ylabel("Verdadeiro")
-    
     for (i,j), v in np.ndenumerate(cm):
         ax.text(j, i, str(v), ha='center', va='center')
-    fig.tight_layout(); fig.savefig(out/"confusion_matrix.png", dpi=150)
-    plt.close(fig)
-    print("[Eval] Relatório salvo e matriz gerada.")
-    return {"report": rep, "cm": cm.tolist()}
+    fig.tight_layout(); fig.savefig(out/"confusion_matrix.png", dpi=150); plt.close(fig)
+    # Curvas ROC e PR
+    for name, x, y, xl, yl, area in (("roc_curve", cur["fpr"], cur["tpr"], "FPR", "TPR", f"AUC={_fmt(cur['auc_roc'])}"),
+                                     ("pr_curve", cur["recall"], cur["precision"], "Recall", "Precisão", f"AP={_fmt(cur['auc_pr'])}")):
+        fig, ax = plt.subplots(figsize=(4,4))
+        ax.plot(x, y, drawstyle="steps-post" if name == "pr_curve" else "default")
+        ax.set_xlabel(xl); ax.set_ylabel(yl); ax.set_title(area); ax.set_xlim(0, 1); ax.set_ylim(0, 1.02)
+        fig.tight_layout(); fig.savefig(out/f"{name}.png", dpi=150); plt.close(fig)
+    print(f"[Eval] {acc['n']} predições avaliadas: AUC={_fmt(cur['auc_roc'])}, AP={_fmt(cur['auc_pr'])}, "
+          f"melhor F1={best['f1']:.3f} em limiar {best['threshold']:.4f}.")
+    return {"report": rep, **summary}
+
+
+def evaluate_from_csv(results_csv: str, labels_csv: str, out_dir: str = "output/figures", threshold: float = 0.5,
+                      tiles=None, chunksize: int = 1_000_000, bins: int = BINS, table_step: float = 0.001):
+    """
+    Avalia um CSV de predições (path, prob) lido em blocos de 'chunksize' linhas.
+    'tiles' (nomes ou caminhos) restringe a avaliação a um subconjunto, ex.: catalog.select_tiles.
+    Grava metricas_modelo.txt, evaluation.json, threshold_table.csv e os gráficos em out_dir.
+    """
+    out = Path(out_dir); out.mkdir(parents=True, exist_ok=True)
+    rcsv, lcsv = Path(results_csv), Path(labels_csv)
+    if not (rcsv.exists() and lcsv.exists()):
+        print("[Eval] Precisa de results_csv e labels_csv."); return None
+    chunks = pd.read_csv(rcsv, usecols=["path", "prob"], dtype={"path": str, "prob": "float64"}, chunksize=int(chunksize))
+    acc = _accumulate(chunks, _load_labels(lcsv), tiles, threshold, int(bins))
+    if acc["n"] == 0:
+        print("[Eval] Não houve interseção entre predições e labels."); return None
+    return _write_outputs(acc, out, threshold, table_step)
+
+
+def evaluate_from_db(db_path: str, labels_csv: str, out_dir: str = "output/figures", run_id: int | None = None,
+                     threshold: float = 0.5, tiles=None, chunksize: int = 1_000_000, bins: int = BINS,
+                     table_step: float = 0.001):
+    """Igual ao evaluate_from_csv, lendo a tabela 'predictions' (padrão: última execução concluída)."""
+    from .database import connect
+    out = Path(out_dir); out.mkdir(parents=True, exist_ok=True)
+    if not Path(labels_csv).exists():
+        print("[Eval] Precisa de labels_csv."); return None
+    con = connect(db_path)
+    try:
+        if run_id is None:
+            r = con.execute("SELECT MAX(run_id) FROM runs WHERE status='done'").fetchone()
+            run_id = r[0] if r else None
+        if run_id is None:
+            print("[Eval] Nenhuma execução concluída no banco."); return None
+        chunks = pd.read_sql_query("SELECT tile, prob FROM predictions WHERE run_id = ?", con, params=(run_id,),
+                                   chunksize=int(chunksize))
+        acc = _accumulate(chunks, _load_labels(labels_csv), tiles, threshold, int(bins))
+    finally:
+        con.close()
+    if acc["n"] == 0:
+        print("[Eval] Não houve interseção entre predições e labels."); return None
+    res = _write_outputs(acc, out, threshold, table_step)
+    res["run_id"] = run_id
+    return res
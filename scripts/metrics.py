@@ -0,0 +1,176 @@
+"""
+Instrumentação do pipeline: spans de tempo por estágio/tile, pico de RSS do processo, bytes lidos/escritos,
+throughput e contagem/latência de chamadas externas (GEE/Drive).
+Cada execução grava JSON-lines (um evento por linha) e um arquivo texto no formato Prometheus;
+processos longos (daemon) descarregam os eventos a cada ciclo (write_metrics(clear=True)).
+Perfil opcional (cProfile ou pyinstrument) por estágio: enable_profiling({"ndvi", "predict"}).
+"""
+
+from __future__ import annotations
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+import datetime, json, os, threading, time
+
+try:
+    import psutil
+except Exception:
+    psutil = None
+try:
+    import resource
+except Exception:  # Windows
+    resource = None
+
+_lock = threading.Lock()
+MAX_EVENTS = 100_000   # eventos não descarregados; acima disso os mais antigos são descartados
+_events: deque = deque(maxlen=MAX_EVENTS)
+_agg: dict = {}        # (métrica, labels) -> [count, sum]
+_profile = {"stages": set(), "kind": "cprofile", "dir": Path("output/logs")}
+
+
+def _io_bytes() -> tuple:
+    """(lidos, escritos) pelo processo via read/write (inclui page cache), quando o SO informa."""
+    try:
+        if psutil is not None:
+            io = psutil.Process().io_counters()
+            return getattr(io, "read_chars", io.read_bytes), getattr(io, "write_chars", io.write_bytes)
+        with open("/proc/self/io") as fh:
+            d = dict(line.split(": ") for line in fh.read().splitlines())
+        return int(d["rchar"]), int(d["wchar"])
+    except Exception:
+        return 0, 0
+
+
+def peak_rss_bytes() -> int:
+    """
+    Pico de RSS do processo desde que ele começou (não é por estágio): ru_maxrss no Unix,
+    peak_wset (psutil) no Windows; 0 se o SO não informa.
+    """
+    if resource is not None:
+        import sys
+        kb = int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        return kb if sys.platform == "darwin" else kb * 1024  # bytes no macOS, KB no Linux
+    if psutil is not None:
+        return int(getattr(psutil.Process().memory_info(), "peak_wset", 0) or 0)
+    return 0
+
+
+def _record(event: dict):
+    with _lock:
+        _events.append(event)
+
+
+def _add(metric: str, labels: dict, value: float):
+    key = (metric, tuple(sorted(labels.items())))
+    with _lock:
+        c = _agg.setdefault(key, [0, 0.0]); c[0] += 1; c[1] += float(value)
+
+
+def observe(metric: str, value: float, **labels):
+    """Amostra avulsa (ex.: latência de uma chamada ao GEE/Drive)."""
+    _add(metric, labels, value)
+    _record({"ts": time.time(), "metric": metric, "value": float(value), **labels})
+
+
+@contextmanager
+def call(service: str, op: str):
+    """Conta e cronometra uma chamada externa: with call("gee", "getInfo"): ..."""
+    t0 = time.perf_counter(); ok = True
+    try:
+        yield
+    except Exception:
+        ok = False; raise
+    finally:
+        observe("vigiai_call_seconds", time.perf_counter() - t0, service=service, op=op, ok=str(ok).lower())
+
+
+@contextmanager
+def span(stage: str, tile: str | None = None, items: int | None = None, **labels):
+    """
+    Cronometra um estágio (ou um tile dentro dele). 'items' permite calcular throughput
+    (ex.: imagens/s na inferência); pode ser definido depois via info["items"] = n.
+    """
+    info = {"items": items}
+    prof = _start_profile(stage) if tile is None and stage in _profile["stages"] else None
+    r0, w0 = _io_bytes(); t0 = time.perf_counter()
+    try:
+        yield info
+    finally:
+        dt = time.perf_counter() - t0; r1, w1 = _io_bytes()
+        if prof is not None: _stop_profile(stage, prof)
+        ev = {"ts": time.time(), "stage": stage, "seconds": round(dt, 6), "process_peak_rss_bytes": peak_rss_bytes(), **labels}
+        if tile is not None: ev["tile"] = tile
+        else: ev.update(read_bytes=r1 - r0, write_bytes=w1 - w0)
+        n = info.get("items")
+        if n is not None:
+            ev["items"] = int(n); ev["items_per_s"] = round(n / dt, 3) if dt > 0 else None
+        _record(ev)
+        kind = "tile" if tile is not None else "stage"
+        _add(f"vigiai_{kind}_seconds", {"stage": stage}, dt)
+        if tile is None:
+            _add("vigiai_stage_read_bytes", {"stage": stage}, r1 - r0)
+            _add("vigiai_stage_write_bytes", {"stage": stage}, w1 - w0)
+            if n is not None: _add("vigiai_stage_items", {"stage": stage}, n)
+
+
+# ---------- Perfil opcional ----------
+
+def enable_profiling(stages, kind: str = "cprofile", out_dir: str = "output/logs"):
+    _profile.update(stages=set(stages or ()), kind=kind, dir=Path(out_dir))
+
+
+def _start_profile(stage: str):
+    if _profile["kind"] == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except Exception:
+            print("[Metrics] pyinstrument não instalado; usando cProfile.")
+        else:
+            p = Profiler(); p.start(); return p
+    import cProfile
+    p = cProfile.Profile(); p.enable(); return p
+
+
+def _stop_profile(stage: str, p):
+    d = _profile["dir"]; d.mkdir(parents=True, exist_ok=True)
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    if hasattr(p, "output_html"):
+        p.stop(); (d / f"profile_{stage}_{ts}.html").write_text(p.output_html(), encoding="utf-8")
+    else:
+        p.disable(); p.dump_stats(str(d / f"profile_{stage}_{ts}.pstats"))
+
+
+# ---------- Exportação ----------
+
+def _prom_labels(labels) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+
+def write_metrics(out_dir: str = "output/logs", run_name: str | None = None, clear: bool = False) -> tuple:
+    """
+    Acrescenta os eventos a metrics_<run>.jsonl e regrava metrics.prom (agregados + pico de RSS do processo).
+    clear=True esvazia os eventos já gravados (descarga periódica do daemon). Retorna os caminhos.
+    """
+    d = Path(out_dir); d.mkdir(parents=True, exist_ok=True)
+    run_name = run_name or datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    with _lock:
+        events = list(_events); agg = dict(_agg)
+        if clear: _events.clear()
+    jl = d / f"metrics_{run_name}.jsonl"
+    with open(jl, "a", encoding="utf-8") as fh:
+        for ev in events: fh.write(json.dumps(ev, ensure_ascii=False) + "\n")
+    lines, seen = [], set()
+    for (metric, labels), (count, total) in sorted(agg.items()):
+        if metric not in seen:
+            lines.append(f"# TYPE {metric} summary"); seen.add(metric)
+        lines.append(f"{metric}_count{_prom_labels(labels)} {count}")
+        lines.append(f"{metric}_sum{_prom_labels(labels)} {total:.6f}")
+    lines += ["# TYPE vigiai_process_peak_rss_bytes gauge", f"vigiai_process_peak_rss_bytes {peak_rss_bytes()}"]
+    prom = d / "metrics.prom"
+    tmp = prom.with_suffix(".prom.tmp"); tmp.write_text("\n".join(lines) + "\n", encoding="utf-8"); os.replace(tmp, prom)
+    return jl, prom
+
+
+def reset():
+    with _lock:
+        _events.clear(); _agg.clear()
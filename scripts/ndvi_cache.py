@@ -0,0 +1,109 @@
+"""
+Cache em disco de arrays pré-processados (NDVI redimensionado p/ CNN, visualização do dashboard).
+- Um .npy por entrada, lido com mmap (np.load(mmap_mode="r")).
+- Chave: caminho absoluto da origem + mtime + tamanho-alvo + tipo; origem alterada → nova entrada.
+- Eviction LRU por tamanho total (o mtime do .npy marca o último acesso).
+"""
+
+from __future__ import annotations
+from pathlib import Path
+import hashlib, os, tempfile, threading
+import numpy as np
+
+CACHE_DIR = os.environ.get("VIGIAI_CACHE_DIR", "data/cache/ndvi")
+MAX_BYTES = int(os.environ.get("VIGIAI_CACHE_MAX_MB", "2048")) << 20
+
+_settings = {"dir": CACHE_DIR, "max_bytes": MAX_BYTES}
+_lock = threading.Lock()
+_total = {}  # dir -> bytes em uso (calculado na 1ª escrita)
+
+
+def configure(cache_dir: str | None = CACHE_DIR, max_bytes: int = MAX_BYTES):
+    """cache_dir=None desliga o cache (load_cached passa a chamar o loader direto)."""
+    _settings.update(dir=cache_dir, max_bytes=int(max_bytes))
+
+
+def _src_id(src: Path) -> str:
+    return hashlib.sha1(str(Path(src).resolve()).encode()).hexdigest()[:16]
+
+
+def _entry(cache_dir: Path, src: Path, size, kind: str) -> Path:
+    tag = "full" if size is None else f"{size[0]}x{size[1]}"
+    return cache_dir / f"{_src_id(src)}_{kind}_{tag}_{Path(src).stat().st_mtime_ns}.npy"
+
+
+def _try_unlink(p: Path) -> bool:
+    """Remove uma entrada; False se ela ainda está mapeada por um leitor (PermissionError no Windows)."""
+    try:
+        p.unlink(missing_ok=True); return True
+    except OSError:
+        return False
+
+
+def _stats(cache_dir: Path) -> list:
+    """(caminho, stat) das entradas; ignora as que sumiram no meio da listagem (outro processo)."""
+    out = []
+    for p in cache_dir.glob("*.npy"):
+        try: out.append((p, p.stat()))
+        except OSError: pass
+    return out
+
+
+def _dir_bytes(cache_dir: Path) -> int:
+    return sum(st.st_size for _, st in _stats(cache_dir))
+
+
+def _evict(cache_dir: Path, max_bytes: int):
+    """Remove as entradas menos usadas até caber em max_bytes; entradas em uso são puladas."""
+    files = sorted(_stats(cache_dir), key=lambda e: e[1].st_mtime)
+    total = sum(st.st_size for _, st in files)
+    for p, st in files:
+        if total <= max_bytes: break
+        if _try_unlink(p): total -= st.st_size
+    _total[str(cache_dir)] = total
+
+
+def load_cached(src: str | Path, size, kind: str, loader, cache_dir: str | None = "default") -> np.ndarray:
+    """
+    Devolve loader() (array) via cache: hit → mmap do .npy; miss → calcula, grava atomicamente e evicta.
+    'size' faz parte da chave (None = resolução nativa).
+    """
+    cache_dir = _settings["dir"] if cache_dir == "default" else cache_dir
+    if not cache_dir:
+        return loader()
+    cdir = Path(cache_dir); cdir.mkdir(parents=True, exist_ok=True)
+    path = _entry(cdir, Path(src), size, kind)
+    if path.exists():
+        try:
+            arr = np.load(path, mmap_mode="r")
+            os.utime(path)  # LRU
+            return arr
+        except (ValueError, OSError):
+            _try_unlink(path)
+    arr = np.ascontiguousarray(loader())
+    # versões antigas (mtime anterior) da mesma origem/tipo/tamanho deixam de valer
+    for old in cdir.glob(path.name.rsplit("_", 1)[0] + "_*.npy"):
+        if old != path: _try_unlink(old)
+    fd, tmp = tempfile.mkstemp(dir=cdir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp, path)
+    with _lock:
+        key = str(cdir)
+        if key not in _total: _total[key] = _dir_bytes(cdir)
+        else: _total[key] += path.stat().st_size
+        if _total[key] > _settings["max_bytes"]:
+            _evict(cdir, _settings["max_bytes"])
+    return arr
+
+
+def invalidate(src: str | Path | None = None, cache_dir: str | None = None) -> int:
+    """Apaga as entradas de 'src' (todas as versões/tamanhos) ou o cache inteiro se src=None."""
+    cdir = Path(cache_dir or _settings["dir"] or CACHE_DIR)
+    if not cdir.exists(): return 0
+    pattern = f"{_src_id(Path(src))}_*.npy" if src is not None else "*.npy"
+    n = 0
+    for p in cdir.glob(pattern):
+        n += _try_unlink(p)
+    _total.pop(str(cdir), None)
+    return n
@@ -0,0 +1,170 @@
+"""
+Estatísticas de NDVI por tile, calculadas junto do NDVI (mesmos arrays já em memória, bloco a bloco
+no modo streaming) e gravadas no SQLite (tabelas ndvi_stats e ndvi_zone_stats):
+- histograma fixo em [-1, 1] (STATS_BINS bins), média/desvio/mín/máx, percentis (do histograma);
+- fração de pixels abaixo dos limiares de vegetação (VEG_THRESHOLDS → colunas lt_020/lt_040/lt_060);
+- agregados zonais (n, soma, soma², n abaixo dos limiares) por polígono de um GeoJSON opcional
+  (ex.: municípios), somáveis entre tiles em SQL.
+O dashboard monta gráficos e coropléticos só a partir dessas tabelas, sem abrir rasters.
+"""
+
+from __future__ import annotations
+from functools import lru_cache
+from pathlib import Path
+import json, logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+STATS_BINS = 200                  # largura 0,01
+VEG_THRESHOLDS = (0.2, 0.4, 0.6)  # colunas lt_020, lt_040, lt_060
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def thr_col(t: float) -> str:
+    return f"lt_{int(round(t * 100)):03d}"
+
+
+# ---------- Zonas (GeoJSON) ----------
+
+def zones_from_cfg(cfg: dict) -> tuple | None:
+    """(geojson, campo_do_nome) do bloco "stats" da config, ou None se não há zonas."""
+    st = cfg.get("stats", {})
+    return (st["zones_geojson"], st.get("zone_field", "name")) if st.get("zones_geojson") else None
+
+
+@lru_cache(maxsize=4)
+def load_zones(geojson: str, field: str = "name") -> tuple:
+    """Polígonos do GeoJSON (EPSG:4326): ((zone_id, nome, geometria, bbox), ...); zone_id = índice + 1."""
+    from .catalog import geojson_bbox
+    data = json.loads(Path(geojson).read_text(encoding="utf-8"))
+    feats = data["features"] if data.get("type") == "FeatureCollection" else [data]
+    out = []
+    for i, f in enumerate(feats):
+        if not f.get("geometry"): continue
+        name = str((f.get("properties") or {}).get(field, i + 1))
+        out.append((i + 1, name, f["geometry"], geojson_bbox(f["geometry"])))
+    return tuple(out)
+
+
+def zone_raster(zones, shape: tuple, transform, crs) -> np.ndarray | None:
+    """zone_id por pixel (0 = fora de todas) para a grade dada; None se nenhuma zona toca a grade."""
+    from rasterio.features import rasterize
+    from rasterio.transform import array_bounds
+    from rasterio.warp import transform_bounds, transform_geom
+    w, s, e, n = array_bounds(shape[0], shape[1], transform)
+    geo = crs is None or crs.to_string() == "EPSG:4326"
+    W, S, E, N = (w, s, e, n) if geo else transform_bounds(crs, "EPSG:4326", w, s, e, n)
+    shapes = [(g if geo else transform_geom("EPSG:4326", crs, g), zid)
+              for zid, _, g, b in zones if b[0] <= E and b[2] >= W and b[1] <= N and b[3] >= S]
+    if not shapes: return None
+    return rasterize(shapes, out_shape=shape, transform=transform, fill=0, dtype="int32")
+
+
+# ---------- Acumulador ----------
+
+class NDVIStats:
+    """Acumula estatísticas de NDVI bloco a bloco em memória fixa (NaN = sem dado)."""
+
+    def __init__(self, zones=None, bins: int = STATS_BINS):
+        self.bins, self.zones = int(bins), zones
+        self.hist = np.zeros(self.bins, "int64")
+        self.below = np.zeros(len(VEG_THRESHOLDS), "int64")
+        self.n_total, self.sum, self.sumsq, self.min, self.max = 0, 0.0, 0.0, np.inf, -np.inf
+        self.zone_acc: dict = {}  # zone_id → [n, soma, soma², n_lt...]
+
+    def add(self, ndvi: np.ndarray, transform=None, crs=None):
+        self.n_total += ndvi.size
+        ok = np.isfinite(ndvi)
+        v = ndvi[ok].astype("float64")
+        if not v.size: return
+        self.hist += np.bincount(np.clip(((v + 1.0) * (self.bins / 2)).astype("int64"), 0, self.bins - 1), minlength=self.bins)
+        lt = [v < t for t in VEG_THRESHOLDS]
+        self.below += [int(m.sum()) for m in lt]
+        self.sum += float(v.sum()); self.sumsq += float(np.dot(v, v))
+        self.min, self.max = min(self.min, float(v.min())), max(self.max, float(v.max()))
+        if self.zones and transform is not None:
+            zr = zone_raster(self.zones, ndvi.shape, transform, crs)
+            if zr is None: return
+            z = zr[ok]; inz = z > 0
+            if not inz.any(): return
+            uz, inv = np.unique(z[inz], return_inverse=True)
+            vv = v[inz]
+            cols = [np.bincount(inv, minlength=len(uz)), np.bincount(inv, vv, len(uz)), np.bincount(inv, vv * vv, len(uz))]
+            cols += [np.bincount(inv, m[inz], len(uz)) for m in lt]
+            for zid, row in zip(uz.tolist(), np.stack(cols, 1)):
+                self.zone_acc[zid] = self.zone_acc.get(zid, 0) + row
+
+    def percentile(self, p: float) -> float | None:
+        """Percentil interpolado linearmente dentro do bin (erro ≤ 1 bin = 0,01)."""
+        n = int(self.hist.sum())
+        if not n: return None
+        cdf = np.cumsum(self.hist); target = p / 100.0 * n
+        j = int(np.searchsorted(cdf, target))
+        j = min(j, self.bins - 1)
+        prev = cdf[j - 1] if j else 0
+        frac = (target - prev) / self.hist[j] if self.hist[j] else 0.0
+        val = -1.0 + (j + frac) * (2.0 / self.bins)
+        return float(np.clip(val, self.min, self.max))
+
+    def result(self, out_path: str | Path) -> dict:
+        out_path = Path(out_path)
+        n = int(self.hist.sum())
+        mean = self.sum / n if n else None
+        std = float(np.sqrt(max(self.sumsq / n - mean * mean, 0.0))) if n else None
+        entry = {"out_path": out_path.as_posix(), "tile": out_path.name, "n_total": int(self.n_total), "n_valid": n,
+                 "mean": mean, "std": std, "min": self.min if n else None, "max": self.max if n else None,
+                 "bins": self.bins, "hist": self.hist.astype("int32").tobytes()}
+        entry.update({f"p{p:02d}": self.percentile(p) for p in PERCENTILES})
+        entry.update({thr_col(t): (int(b) / n if n else None) for t, b in zip(VEG_THRESHOLDS, self.below)})
+        names = {zid: name for zid, name, _, _ in (self.zones or ())}
+        entry["zones"] = [{"out_path": entry["out_path"], "zone_id": zid, "zone": names.get(zid, str(zid)),
+                           "n": int(r[0]), "sum": float(r[1]), "sumsq": float(r[2]),
+                           **{f"n_{thr_col(t)}": int(r[3 + k]) for k, t in enumerate(VEG_THRESHOLDS)}}
+                          for zid, r in sorted(self.zone_acc.items())]
+        return entry
+
+
+def stats_from_array(ndvi: np.ndarray, out_path, transform=None, crs=None, zones=None) -> dict:
+    st = NDVIStats(zones); st.add(ndvi, transform, crs)
+    return st.result(out_path)
+
+
+# ---------- Gravação e backfill ----------
+
+def save_stats(db_path: str, entries: list, con=None):
+    """Grava as estatísticas (e zonas) de cada tile; mtime do NDVI marca a versão."""
+    from .database import upsert_ndvi_stats
+    for e in entries:
+        p = Path(e["out_path"])
+        if p.exists(): e.setdefault("mtime_ns", p.stat().st_mtime_ns)
+    upsert_ndvi_stats(db_path, entries, con=con)
+
+
+def backfill_stats(db_path: str, ndvi_dir: str = "data/ndvi", zones_geojson: str | None = None,
+                   zone_field: str = "name", force: bool = False) -> int:
+    """
+    Estatísticas dos NDVI já existentes que ainda não têm (ou mudaram desde) a última gravação.
+    Lê os rasters em blocos (read_ndvi decodifica float32/int16). Retorna quantos foram calculados.
+    """
+    import rasterio as rio
+    from rasterio.windows import Window
+    from .ndvi_utils import read_ndvi
+    from .database import init_db, load_ndvi_stats_mtimes
+    init_db(db_path)
+    zones = load_zones(zones_geojson, zone_field) if zones_geojson else None
+    known = {} if force else load_ndvi_stats_mtimes(db_path)
+    todo = [p for p in sorted(Path(ndvi_dir).glob("*_ndvi.tif")) if known.get(p.as_posix()) != p.stat().st_mtime_ns]
+    entries = []
+    for p in todo:
+        st = NDVIStats(zones)
+        with rio.open(p) as ds:
+            for row in range(0, ds.height, 1024):  # faixas de linhas: memória limitada em cenas grandes
+                win = Window(0, row, ds.width, min(1024, ds.height - row))
+                st.add(read_ndvi(ds, window=win), ds.window_transform(win), ds.crs)
+        entries.append(st.result(p))
+        if len(entries) >= 200:
+            save_stats(db_path, entries); entries = []
+    save_stats(db_path, entries)
+    log.info("[Stats] %d NDVI com estatísticas (re)calculadas.", len(todo))
+    return len(todo)
@@ -0,0 +1,247 @@
+"""
+Pipeline em streaming: cada tile avança de estágio assim que o anterior termina.
+Estágios são nós de um DAG ligados por filas limitadas (backpressure); cada estágio
+tem seu próprio número de workers. Ex.: NDVI do tile 3 roda enquanto o tile 7 ainda
+baixa e o tile 1 está na inferência.
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+import logging, queue, threading, time
+
+log = logging.getLogger(__name__)
+
+_END = object()
+
+
+@dataclass
+class Stage:
+    """
+    fn(item) -> próximo item | None (descarta) | lista (se fanout=True).
+    'after' = nome do estágio de origem (padrão: o anterior na lista); vários estágios
+    podem consumir o mesmo 'after' (cada um recebe uma cópia do item).
+    batch > 1: fn recebe uma lista de até 'batch' itens (os que já estão na fila, sem esperar
+    encher) e devolve uma lista de saídas, repassadas uma a uma.
+    """
+    name: str
+    fn: callable
+    workers: int = 1
+    maxsize: int = 4
+    fanout: bool = False
+    after: str | None = None
+    batch: int = 1
+    # estatísticas
+    done: int = 0
+    failed: int = 0
+    busy_s: float = 0.0
+    _q: queue.Queue = field(default=None, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """put bloqueante (backpressure) que desiste se o pipeline for cancelado."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.2); return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_pipeline(source, stages: list, stop: threading.Event | None = None) -> dict:
+    """
+    Executa 'source' (iterável, pode bloquear esperando itens) através dos estágios.
+    Falha em um item é registrada e o item é descartado; Ctrl+C / stop.set() cancela tudo.
+    Retorna {nome_do_estágio_folha: [itens produzidos]}.
+    """
+    stop = stop or threading.Event()
+    by_name = {s.name: s for s in stages}
+    children = {s.name: [] for s in stages}
+    roots, prev = [], None
+    for s in stages:
+        s._q = queue.Queue(maxsize=max(1, int(s.maxsize)))
+        up = s.after if s.after is not None else prev
+        if up is None: roots.append(s)
+        else: children[up].append(s)
+        prev = s.name
+    leaves = {s.name: [] for s in stages if not children[s.name]}
+    pending = {s.name: max(1, int(s.workers)) for s in stages}  # workers vivos por estágio
+
+    def _emit(s: Stage, out):
+        for item in (out if s.fanout or s.batch > 1 else [out]):
+            if item is None: continue
+            if s.name in leaves:
+                with s._lock: leaves[s.name].append(item)
+            for c in children[s.name]:
+                if not _put(c._q, item, stop): return
+
+    def _worker(s: Stage):
+        try:
+            while not stop.is_set():
+                try: item = s._q.get(timeout=0.2)
+                except queue.Empty: continue
+                if item is _END:
+                    s._q.put(_END)  # repassa aos outros workers do estágio
+                    break
+                items, end = [item], False
+                while len(items) < s.batch:  # micro-lote com o que já está na fila
+                    try: nxt = s._q.get_nowait()
+                    except queue.Empty: break
+                    if nxt is _END: end = True; break
+                    items.append(nxt)
+                t0, ok = time.perf_counter(), False
+                try:
+                    out = s.fn(items if s.batch > 1 else item); ok = True
+                except Exception as e:
+                    with s._lock: s.failed += len(items)
+                    log.error("[Pipeline] %s falhou em %s: %s", s.name, items if s.batch > 1 else item, e)
+                finally:
+                    with s._lock: s.busy_s += time.perf_counter() - t0
+                if ok:
+                    with s._lock: s.done += len(items)
+                    _emit(s, out)
+                if end:
+                    s._q.put(_END)
+                    break
+        finally:
+            with s._lock:
+                pending[s.name] -= 1
+                last = pending[s.name] == 0
+            if last:  # último worker do estágio fecha os filhos
+                for c in children[s.name]: _put(c._q, _END, stop)
+
+    threads = [threading.Thread(target=_worker, args=(s,), name=f"{s.name}-{i}", daemon=True)
+               for s in stages for i in range(max(1, int(s.workers)))]
+    for th in threads: th.start()
+    t0 = time.perf_counter()
+    try:
+        for item in source:
+            if stop.is_set(): break
+            for r in roots:
+                if not _put(r._q, item, stop): break
+        for r in roots: _put(r._q, _END, stop)
+        while any(th.is_alive() for th in threads):
+            for th in threads: th.join(0.2)
+    except KeyboardInterrupt:
+        log.warning("[Pipeline] Cancelado; aguardando workers encerrarem...")
+        stop.set()
+        for th in threads: th.join(5)
+        raise
+    finally:
+        dt = time.perf_counter() - t0
+        for s in stages:
+            log.info("[Pipeline] %-8s ok=%d falhas=%d ocupado=%.1fs (workers=%d)", s.name, s.done, s.failed, s.busy_s, s.workers)
+        log.info("[Pipeline] Tempo total: %.1fs", dt)
+    return leaves
+
+
+# ---------- Pipeline do VigiAI ----------
+
+def _gee_source(gee: dict, stop: threading.Event, errors: list):
+    """
+    Submete os exports e gera a 'description' de cada tarefa assim que ela termina (COMPLETED).
+    Erro na submissão (plano, start) encerra a origem e vai para 'errors' (relançado pelo chamador).
+    """
+    from .data_processing import download_sentinel_tiles_via_drive
+    q: queue.Queue = queue.Queue()
+
+    def _submit():
+        try:
+            download_sentinel_tiles_via_drive(
+                aoi_geojson=gee.get("aoi_geojson"), bbox=gee.get("bbox_approx"),
+                start_date=gee.get("start_date"), end_date=gee.get("end_date"),
+                collection=gee.get("collection", "COPERNICUS/S2_SR_HARMONIZED"),
+                cloud_filter=int(gee.get("cloud_filter", 80)), drive_folder=gee.get("drive_folder", "VigiAI"),
+                max_tiles=int(gee.get("max_tiles", 6)), export_scale=int(gee.get("export_scale", 20)),
+                out_dir="data/raw", shard_deg=gee.get("shard_deg"), max_active=gee.get("max_concurrent_tasks"),
+                wait_for_tasks=True,
+                on_task_done=lambda t, s: q.put(s["description"]) if s.get("state") == "COMPLETED" else None)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            q.put(_END)
+
+    threading.Thread(target=_submit, name="gee-export", daemon=True).start()
+    while not stop.is_set():
+        try: item = q.get(timeout=0.5)
+        except queue.Empty: continue
+        if item is _END: return
+        yield item
+
+
+def run_vigiai_pipeline(cfg: dict, download: bool = True, raw_dir: str = "data/raw", ndvi_dir: str = "data/ndvi",
+                        model_path: str = "models/modelo_final.h5", out_csv: str = "output/reports/resultados_queimadas.csv",
+                        db_path: str = "data/db/ndvi_data.db", workers: dict | None = None, streaming: bool = False,
+                        cube=None, processed_dir: str = "data/processed", fmt: str | None = None,
+                        zones: tuple | None = None) -> int:
+    """
+    download (GEE) → sync (Drive, só os arquivos do tile) → ndvi → predict, por tile.
+    Sem 'download', a origem são os GeoTIFFs já presentes em raw_dir.
+    O NDVI passa pelo batch_compute_ndvi de cada tile (manifesto: tile inalterado não é recalculado;
+    footprints, estatísticas e 'cube'); a predição roda em micro-lotes ('predict_batch' em 'workers').
+    Ao final atualiza as linhas destes tiles no CSV e grava a execução no SQLite como o run_inference;
+    se a submissão dos exports falhou, relança o erro depois de gravar os tiles que chegaram a ser inferidos.
+    """
+    import numpy as np
+    from .ndvi_utils import batch_compute_ndvi
+    from .cnn_model import _load_ndvi, load_model, merge_results_csv
+    from .database import init_db, start_run, finish_run, insert_predictions
+    from .ndvi_stats import zones_from_cfg
+
+    gee = cfg.get("gee", {})
+    w = {"sync": 4, "ndvi": 2, "predict": 1, "predict_batch": 16, **(workers or {})}
+    raw, ndvi = Path(raw_dir), Path(ndvi_dir)
+    raw.mkdir(parents=True, exist_ok=True); ndvi.mkdir(parents=True, exist_ok=True)
+    stop = threading.Event()
+    init_db(db_path)
+    cnn = cfg.get("cnn", {})
+    m = load_model(model_path, cnn.get("backend", "keras"), cnn.get("tflite_threads"))
+    m_lock = threading.Lock()
+    fmt = fmt or cfg.get("ndvi", {}).get("format", "float32")
+    zones = zones if zones is not None else zones_from_cfg(cfg)
+
+    def _sync(desc):
+        from .drive_sync import download_new_exports
+        download_new_exports(folder_name=gee.get("drive_folder", "VigiAI"), local_dir=raw_dir, prefix=desc, workers=1,
+                             db_path=db_path)
+        return sorted(raw.glob(f"{desc}*.tif"))
+
+    cube_lock = threading.Lock()
+
+    class _Cube:  # NDVICube.append lê e regrava blocos do mosaico: um tile por vez
+        def append(self, *a, **kw):
+            with cube_lock: return cube.append(*a, **kw)
+
+    def _ndvi(tif):
+        out = ndvi / (Path(tif).stem + "_ndvi.tif")
+        n = batch_compute_ndvi(raw_dir, ndvi_dir, processed_dir, streaming=streaming, db_path=db_path, fmt=fmt,
+                               zones=zones, cube=_Cube() if cube is not None else None, paths=[tif])
+        if not n and not out.exists():
+            raise RuntimeError(f"NDVI não gerado para {Path(tif).name}")
+        return out
+
+    def _predict(paths):
+        X = np.stack([_load_ndvi(p) for p in paths])
+        with m_lock:
+            probs = np.asarray(m.predict_on_batch(X)).reshape(-1)
+        return [{"path": str(p), "prob": float(pr), "pred": int(pr > 0.5)} for p, pr in zip(paths, probs)]
+
+    stages, errors = [], []
+    if download:
+        source = _gee_source(gee, stop, errors)
+        stages.append(Stage("sync", _sync, workers=w["sync"], fanout=True))
+    else:
+        source = sorted(list(raw.glob("*.tif")) + list(raw.glob("*.tiff")))
+    stages += [Stage("ndvi", _ndvi, workers=w["ndvi"]),
+               Stage("predict", _predict, workers=w["predict"], batch=max(1, int(w["predict_batch"])),
+                     maxsize=max(4, 2 * int(w["predict_batch"])))]
+
+    rows = sorted(run_pipeline(source, stages, stop)["predict"], key=lambda r: r["path"])
+    if rows:
+        merge_results_csv(out_csv, rows)
+        run_id = start_run(db_path, model_path=model_path, source="pipeline")
+        finish_run(db_path, run_id, insert_predictions(db_path, run_id, rows))
+    if errors:
+        raise RuntimeError(f"Submissão dos exports do GEE falhou ({len(rows)} tiles inferidos antes): {errors[0]}") from errors[0]
+    return len(rows)
@@ -0,0 +1,224 @@
+"""
+Busca de hiperparâmetros do train_cnn em paralelo na CPU:
+- espaço em grade (produto cartesiano) ou amostragem aleatória (cfg "sweep");
+- os NDVI rotulados são decodificados UMA vez por input_size para um .npy em disco, que cada
+  trial abre com mmap (as páginas ficam no page cache e são compartilhadas entre processos);
+- cada worker (processo spawn) tem orçamento fixo de threads do TF (intra/inter-op) e, no Linux,
+  afinidade de CPU própria, para os trials não disputarem os mesmos núcleos;
+- parada antecipada: EarlyStopping no trial + regra da mediana entre trials (após 'warmup' epochs,
+  o trial cuja melhor val_loss está pior que a mediana dos outros no mesmo epoch é interrompido);
+- leaderboard (CSV) com métricas de validação, epochs e tempo de parede por trial.
+"""
+
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+import itertools, json, logging, multiprocessing as mp, os, random, time
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+SWEEP_KEYS = ("input_size", "batch_size", "epochs", "learning_rate", "augment")
+SWEEP_DIR = "data/cache/sweep"
+LEADERBOARD = "output/reports/sweep_leaderboard.csv"
+
+
+# ---------- Espaço de busca ----------
+
+def expand_space(space: dict, base: dict, mode: str = "grid", n_trials: int | None = None, seed: int = 42) -> list[dict]:
+    """
+    Lista de trials (dicts com SWEEP_KEYS). 'space' = {chave: [valores]}; o que faltar vem de 'base'
+    (bloco "cnn"). grid: produto cartesiano (cortado em n_trials); random: n_trials amostras sem repetição.
+    """
+    bad = set(space) - set(SWEEP_KEYS)
+    if bad: raise ValueError(f"Chaves desconhecidas no espaço de busca: {sorted(bad)} (use {SWEEP_KEYS}).")
+    defaults = {"input_size": [128, 128], "batch_size": 16, "epochs": 8, "learning_rate": 5e-4, "augment": True}
+    fixed = {k: base.get(k, defaults[k]) for k in SWEEP_KEYS}
+    keys = list(space)
+    combos = [dict(zip(keys, v)) for v in itertools.product(*(space[k] for k in keys))]
+    if mode == "random":
+        random.Random(seed).shuffle(combos)
+    elif mode != "grid":
+        raise ValueError(f"Modo de busca desconhecido: {mode!r} (use 'grid' ou 'random').")
+    if n_trials: combos = combos[:int(n_trials)]
+    return [{**fixed, **c, "input_size": list(c.get("input_size", fixed["input_size"]))} for c in combos]
+
+
+# ---------- Dados decodificados compartilhados (memmap) ----------
+
+def shared_dataset(paths, labels, input_size, cache_dir: str = SWEEP_DIR, loaders: int = 4) -> str:
+    """
+    Decodifica os NDVI para um .npy (N, H, W, 1) float32; reaproveita se a lista, os rótulos, o tamanho
+    e o mtime de cada NDVI não mudaram (a chave vem de cnn_model._cache_file).
+    """
+    from .cnn_model import _cache_file, _load_ndvi
+    size = tuple(int(v) for v in input_size)
+    out = _cache_file(cache_dir, "sweep", paths, labels, size).with_suffix(".npy")
+    if out.exists(): return str(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_suffix(".tmp.npy")
+    X = np.lib.format.open_memmap(tmp, mode="w+", dtype="float32", shape=(len(paths), size[1], size[0], 1))
+
+    def _put(i):
+        X[i] = _load_ndvi(Path(paths[i]), size)
+    with ThreadPoolExecutor(max(1, int(loaders))) as ex:
+        list(ex.map(_put, range(len(paths))))
+    X.flush(); del X
+    os.replace(tmp, out)
+    return str(out)
+
+
+def _batches(x_path: str, y: np.ndarray, idx: np.ndarray, batch_size: int, shuffle: bool, seed: int = 42):
+    """Sequence que lê os lotes direto do memmap (nada é copiado para o processo além do lote)."""
+    import tensorflow as tf
+
+    class _Batches(tf.keras.utils.Sequence):  # Sequence: TF 2.10 (requirements) e Keras 3 (alias de PyDataset)
+        def __init__(self):
+            super().__init__()
+            self.X = np.load(x_path, mmap_mode="r")
+            self.idx, self.rng = np.array(idx), np.random.default_rng(seed)
+            if shuffle: self.rng.shuffle(self.idx)
+
+        def __len__(self):
+            return -(-len(self.idx) // int(batch_size))
+
+        def __getitem__(self, i):
+            b = np.sort(self.idx[i * int(batch_size):(i + 1) * int(batch_size)])
+            return np.asarray(self.X[b], dtype="float32"), y[b]
+
+        def on_epoch_end(self):
+            if shuffle: self.rng.shuffle(self.idx)
+
+    return _Batches()
+
+
+# ---------- Worker ----------
+
+def _init_worker(intra: int, inter: int, cores, board):
+    """Roda uma vez por processo: fixa threads do TF (antes de qualquer op) e a afinidade de CPU."""
+    global _BOARD
+    _BOARD = board
+    os.environ.update(OMP_NUM_THREADS=str(intra), TF_NUM_INTRAOP_THREADS=str(intra),
+                      TF_NUM_INTEROP_THREADS=str(inter), TF_CPP_MIN_LOG_LEVEL="2")
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores.get_nowait())
+        except Exception:
+            pass
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(int(intra))
+    tf.config.threading.set_inter_op_parallelism_threads(int(inter))
+
+
+def _median_stop(tid: int, warmup: int, min_trials: int):
+    """Callback da regra da mediana; publica a val_loss de cada epoch no quadro compartilhado."""
+    import tensorflow as tf
+
+    class _MedianStop(tf.keras.callbacks.Callback):
+        pruned = False
+
+        def on_epoch_end(self, epoch, logs=None):
+            loss = float((logs or {}).get("val_loss", np.inf))
+            hist = list(_BOARD.get(tid, [])) + [loss]
+            _BOARD[tid] = hist
+            if epoch + 1 < warmup: return
+            others = [min(h[:epoch + 1]) for k, h in _BOARD.items() if k != tid and len(h) > epoch]
+            if len(others) >= min_trials and min(hist) > float(np.median(others)):
+                self.pruned = self.model.stop_training = True
+
+    return _MedianStop()
+
+
+def _run_trial(tid: int, trial: dict, data: dict, patience: int, warmup: int, min_trials: int, models_dir: str | None) -> dict:
+    import tensorflow as tf
+    from tensorflow.keras import callbacks
+    from .cnn_model import build_cnn
+    t0 = time.perf_counter()
+    row = {"trial": tid, **{k: json.dumps(v) if k == "input_size" else v for k, v in trial.items()}}
+    try:
+        d = data[json.dumps(trial["input_size"])]
+        y = np.asarray(d["y"], dtype="int32")
+        tf.keras.backend.clear_session()
+        tf.keras.utils.set_random_seed(42 + tid)
+        model = build_cnn(tuple(trial["input_size"]), float(trial["learning_rate"]), bool(trial["augment"]))
+        ms = _median_stop(tid, warmup, min_trials)
+        es = callbacks.EarlyStopping(patience=patience, restore_best_weights=True)
+        h = model.fit(_batches(d["x"], y, d["tr"], trial["batch_size"], True, 42 + tid),
+                      validation_data=_batches(d["x"], y, d["va"], trial["batch_size"], False),
+                      epochs=int(trial["epochs"]), callbacks=[es, ms], verbose=0).history
+        best = int(np.argmin(h["val_loss"]))
+        row.update(status="pruned" if ms.pruned else "ok", epochs_run=len(h["val_loss"]), best_epoch=best + 1,
+                   val_loss=float(h["val_loss"][best]), val_accuracy=float(h["val_accuracy"][best]),
+                   max_val_accuracy=float(max(h["val_accuracy"])), train_loss=float(h["loss"][best]))
+        if models_dir:
+            Path(models_dir).mkdir(parents=True, exist_ok=True)
+            row["model"] = str(Path(models_dir) / f"trial_{tid:03d}.h5")
+            model.save(row["model"])
+    except Exception as e:  # um trial ruim (ex.: OOM) não derruba a busca
+        row.update(status="failed", error=str(e))
+    row["wall_s"] = round(time.perf_counter() - t0, 2)
+    return row
+
+
+# ---------- Orquestração ----------
+
+def run_sweep(cfg: dict, ndvi_dir: str = "data/ndvi", labels_csv: str = "data/labels/labels.csv",
+              out_csv: str = LEADERBOARD, models_dir: str | None = "models/sweep", workers: int | None = None,
+              threads_per_worker: int | None = None) -> list[dict]:
+    """
+    Executa os trials do bloco "sweep" da config em 'workers' processos paralelos (padrão: núcleos /
+    threads_per_worker). O split treino/validação é o mesmo do train_cnn (estratificado, random_state=42).
+    Grava o leaderboard ordenado (val_accuracy ↓, val_loss ↑) e devolve as linhas.
+    """
+    import pandas as pd
+    from sklearn.model_selection import train_test_split
+    from .cnn_model import _labelled_paths
+    sw = cfg.get("sweep", {})
+    trials = expand_space(sw.get("space", {}), cfg.get("cnn", {}), sw.get("mode", "grid"), sw.get("n_trials"),
+                          int(sw.get("seed", 42)))
+    if not trials: raise ValueError("Espaço de busca vazio (cfg sweep.space).")
+    paths, y = _labelled_paths(labels_csv, ndvi_dir)
+    if len(paths) < 4: raise ValueError("Poucos exemplos em labels.csv para a busca.")
+    idx = np.arange(len(paths))
+    tr, va = train_test_split(idx, test_size=0.25, random_state=42, stratify=y if len(np.unique(y)) > 1 else None)
+
+    t0 = time.perf_counter()
+    data = {}
+    for size in {json.dumps(t["input_size"]) for t in trials}:
+        data[size] = {"x": shared_dataset(paths, y, json.loads(size), sw.get("cache_dir", SWEEP_DIR)),
+                      "y": y.tolist(), "tr": tr.tolist(), "va": va.tolist()}
+    log.info("[Sweep] %d exemplos decodificados para %d tamanho(s) em %.1fs", len(paths), len(data), time.perf_counter() - t0)
+
+    ncpu = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    tpw = max(1, int(threads_per_worker or sw.get("threads_per_worker", 2)))
+    nw = max(1, min(int(workers or sw.get("workers") or ncpu // tpw or 1), len(trials)))
+    patience, warmup = int(sw.get("patience", 3)), int(sw.get("prune_warmup", 2))
+    min_trials = int(sw.get("prune_min_trials", 3))
+
+    ctx = mp.get_context("spawn")
+    cores = None
+    if hasattr(os, "sched_getaffinity") and nw * tpw <= ncpu:  # um bloco de núcleos por worker
+        cores = ctx.Queue()
+        avail = sorted(os.sched_getaffinity(0))
+        for w in range(nw): cores.put(set(avail[w * tpw:(w + 1) * tpw]))
+    rows = []
+    with ctx.Manager() as mgr:
+        board = mgr.dict()
+        log.info("[Sweep] %d trials, %d workers x %d threads", len(trials), nw, tpw)
+        with ProcessPoolExecutor(nw, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(tpw, 1 if tpw < 4 else 2, cores, board)) as ex:
+            futs = [ex.submit(_run_trial, i, t, data, patience, warmup, min_trials, models_dir) for i, t in enumerate(trials)]
+            for f in as_completed(futs):
+                r = f.result(); rows.append(r)
+                if r["status"] == "failed":
+                    log.error("[Sweep] trial %d falhou: %s", r["trial"], r.get("error")); continue
+                log.info("[Sweep] trial %d %s val_acc=%s val_loss=%s (%.1fs)", r["trial"], r["status"],
+                         r.get("val_accuracy"), r.get("val_loss"), r["wall_s"])
+
+    df = pd.DataFrame(rows)
+    if "val_accuracy" in df:
+        df = df.sort_values(["val_accuracy", "val_loss"], ascending=[False, True], na_position="last")
+    out = Path(out_csv); out.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(out, index=False, encoding="utf-8")
+    log.info("[Sweep] Leaderboard: %s (%.1fs no total)", out, time.perf_counter() - t0)
+    return df.to_dict("records")
@@ -0,0 +1,140 @@
+"""
+Backend TFLite para inferência em CPU.
+- export_tflite: .h5 → .tflite (float32) ou _int8.tflite (quantização pós-treino calibrada em data/ndvi).
+- TFLiteModel: interpretador multi-thread com a mesma interface predict_on_batch do Keras.
+  Usa ai_edge_litert ou tflite_runtime se instalados (sem TensorFlow); senão tf.lite.
+- compare_backends: paridade (Keras × TFLite) e latência/throughput nos mesmos NDVI.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+import logging, os, time
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def _interpreter_cls():
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except Exception:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except Exception:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+def tflite_path_for(model_path: str | Path, quantize: bool | None = None) -> Path:
+    """.tflite ao lado do .h5; sem 'quantize', prefere o int8 se existir."""
+    p = Path(model_path)
+    if p.suffix == ".tflite": return p
+    q, f = p.with_name(p.stem + "_int8.tflite"), p.with_suffix(".tflite")
+    if quantize is None: return q if q.exists() else f
+    return q if quantize else f
+
+
+def _calibration_paths(calib_dir: str | Path, n: int, seed: int = 0) -> list:
+    paths = sorted(Path(calib_dir).glob("*_ndvi.tif"))
+    if len(paths) > n:
+        idx = np.random.default_rng(seed).choice(len(paths), n, replace=False)
+        paths = [paths[i] for i in sorted(idx)]
+    return paths
+
+
+def export_tflite(model_path: str = "models/modelo_final.h5", out_path: str | None = None, quantize: bool = False,
+                  calib_dir: str = "data/ndvi", calib_samples: int = 200, size=(128, 128)) -> Path:
+    """
+    Converte o modelo Keras para TFLite. Com quantize=True: pesos e ativações int8 (entrada/saída
+    continuam float32), com faixas calibradas em até 'calib_samples' NDVI de calib_dir.
+    """
+    import tensorflow as tf
+    from .cnn_model import _decode_ndvi
+    m = tf.keras.models.load_model(model_path, compile=False)
+    conv = tf.lite.TFLiteConverter.from_keras_model(m)
+    if quantize:
+        paths = _calibration_paths(calib_dir, int(calib_samples))
+        if not paths:
+            raise FileNotFoundError(f"Sem NDVI em {calib_dir} para calibrar a quantização int8.")
+
+        def _representative():
+            for p in paths:
+                yield [_decode_ndvi(p, size)[None, ...].astype("float32")]
+        conv.optimizations = [tf.lite.Optimize.DEFAULT]
+        conv.representative_dataset = _representative
+        log.info("[TFLite] Calibrando int8 com %d NDVI de %s", len(paths), calib_dir)
+    out = Path(out_path) if out_path else tflite_path_for(model_path, quantize)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_bytes(conv.convert())
+    log.info("[TFLite] %s → %s (%.1f KB)", model_path, out, out.stat().st_size / 1024)
+    return out
+
+
+class TFLiteModel:
+    """Interpretador TFLite com predict_on_batch(X) → (n, 1) float32, como o modelo Keras."""
+
+    def __init__(self, path: str | Path, threads: int | None = None):
+        self.path = Path(path)
+        if not self.path.exists():
+            raise FileNotFoundError(f"{self.path} não existe (gere com --export-tflite).")
+        self.threads = int(threads or os.cpu_count() or 1)
+        self._it = _interpreter_cls()(model_path=str(self.path), num_threads=self.threads)
+        self._it.allocate_tensors()
+        self._in, self._out = self._it.get_input_details()[0], self._it.get_output_details()[0]
+        self._batch = int(self._in["shape"][0])
+
+    def _resize(self, n: int):
+        if n != self._batch:
+            self._it.resize_tensor_input(self._in["index"], [n, *self._in["shape"][1:]])
+            self._it.allocate_tensors()
+            self._in, self._out = self._it.get_input_details()[0], self._it.get_output_details()[0]
+            self._batch = n
+
+    def predict_on_batch(self, X) -> np.ndarray:
+        X = np.asarray(X, dtype="float32")
+        self._resize(len(X))
+        if self._in["dtype"] != np.float32:  # modelo com entrada inteira
+            scale, zero = self._in["quantization"]; info = np.iinfo(self._in["dtype"])
+            X = np.clip(np.round(X / scale + zero), info.min, info.max).astype(self._in["dtype"])
+        self._it.set_tensor(self._in["index"], X)
+        self._it.invoke()
+        y = self._it.get_tensor(self._out["index"])
+        if self._out["dtype"] != np.float32:
+            s, z = self._out["quantization"]
+            y = (y.astype("float32") - z) * s
+        return y.astype("float32")
+
+
+def compare_backends(model_path: str = "models/modelo_final.h5", tflite_path: str | None = None,
+                     ndvi_dir: str = "data/ndvi", n: int = 200, batch_size: int = 1, threads: int | None = None,
+                     tol: float = 0.02) -> dict:
+    """
+    Roda Keras e TFLite nos mesmos NDVI (até n): diferença máxima/média de 'prob', concordância
+    de 'pred' (limiar 0,5) e imagens/s de cada backend. ok=True se concordância 100% e max_abs ≤ tol.
+    """
+    from .cnn_model import load_model, _decode_ndvi
+    paths = _calibration_paths(ndvi_dir, int(n), seed=1)
+    if not paths:
+        raise FileNotFoundError(f"Sem NDVI em {ndvi_dir} para comparar os backends.")
+    X = np.stack([_decode_ndvi(p) for p in paths])
+    tfl = Path(tflite_path) if tflite_path else tflite_path_for(model_path)
+    res = {"n": len(paths), "batch_size": int(batch_size), "tflite": str(tfl)}
+    probs = {}
+    for name, m in (("keras", load_model(model_path)), ("tflite", TFLiteModel(tfl, threads))):
+        m.predict_on_batch(X[:batch_size])  # aquecimento
+        out, t0 = [], time.perf_counter()
+        for i in range(0, len(X), batch_size):
+            out.append(np.asarray(m.predict_on_batch(X[i:i + batch_size])).reshape(-1))
+        dt = time.perf_counter() - t0
+        probs[name] = np.concatenate(out)
+        res[name] = {"seconds": round(dt, 4), "images_per_s": round(len(X) / dt, 1),
+                     "ms_per_batch": round(1000 * dt / -(-len(X) // batch_size), 3)}
+    diff = np.abs(probs["keras"] - probs["tflite"])
+    agree = float(np.mean((probs["keras"] > 0.5) == (probs["tflite"] > 0.5)))
+    res.update(max_abs=float(diff.max()), mean_abs=float(diff.mean()), agreement=agree,
+               speedup=round(res["tflite"]["images_per_s"] / res["keras"]["images_per_s"], 2))
+    res["ok"] = agree == 1.0 and res["max_abs"] <= tol
+    log.info("[TFLite] Paridade: concordância %.1f%%, |Δprob| máx %.4g; %.0f vs %.0f img/s (x%.2f)",
+             100 * agree, res["max_abs"], res["tflite"]["images_per_s"], res["keras"]["images_per_s"], res["speedup"])
+    return res
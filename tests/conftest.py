@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# testes importam 'scripts.*' como o main.py (raiz do repositório no sys.path)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,108 @@
+"""drive_sync com um cliente do Drive falso (sem rede): md5, retry, limpeza do .part e retomada por Range."""
+
+import hashlib
+from types import SimpleNamespace
+
+from scripts import drive_sync
+
+GOOD = b"GeoTIFF" * 1000
+
+
+def _md5(b: bytes) -> str:
+    return hashlib.md5(b).hexdigest()
+
+
+class FakeFile(dict):
+    """Arquivo do Drive: entrega, em ordem, os conteúdos de 'payloads' (o último se repete)."""
+
+    def __init__(self, title, payloads, md5=_md5(GOOD), size=None, **kw):
+        super().__init__(id=title, title=title, md5Checksum=md5, parents=[{"id": "fid"}], **kw)
+        if size is not None: self["fileSize"] = str(size)
+        self.payloads, self.calls = list(payloads), 0
+
+    def GetContentFile(self, path, chunksize=None):
+        data = self.payloads[min(self.calls, len(self.payloads) - 1)]
+        self.calls += 1
+        with open(path, "wb") as fh: fh.write(data)
+        if isinstance(data, bytes) and data.startswith(b"FAIL"):
+            raise IOError("conexão interrompida")
+
+
+class _Pages(list):
+    """Resultado de ListFile: iterável por páginas (uma só) e GetList()."""
+
+    def __init__(self, res):
+        super().__init__([list(res)])
+
+    def GetList(self):
+        return self[0]
+
+
+class FakeDrive:
+    def __init__(self, files):
+        self.files = files
+
+    def ListFile(self, params):
+        if "mimeType = 'application/vnd.google-apps.folder'" in params["q"]:
+            return _Pages([{"id": "fid", "title": "VigiAI", "mimeType": "application/vnd.google-apps.folder"}])
+        return _Pages(self.files)
+
+
+def _sync(tmp_path, files, **kw):
+    return drive_sync.download_new_exports(local_dir=str(tmp_path), prefix="vigiai_tile_", drive=FakeDrive(files),
+                                           workers=2, backoff=0, **kw)
+
+
+def test_md5_mismatch_is_retried(tmp_path):
+    f = FakeFile("vigiai_tile_0000_20240101.tif", [b"corrompido", GOOD])
+    assert _sync(tmp_path, [f]) == 1
+    assert f.calls == 2
+    assert (tmp_path / f["title"]).read_bytes() == GOOD
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_gives_up_and_removes_part(tmp_path):
+    f = FakeFile("vigiai_tile_0000_20240101.tif", [b"FAIL parcial"])
+    assert _sync(tmp_path, [f], retries=2) == 0
+    assert f.calls == 3
+    assert not (tmp_path / f["title"]).exists()
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_verified_file_is_not_rehashed(tmp_path, monkeypatch):
+    f = FakeFile("vigiai_tile_0000_20240101.tif", [GOOD], size=len(GOOD))
+    assert _sync(tmp_path, [f]) == 1
+    hashed = []
+    real = drive_sync._md5
+    monkeypatch.setattr(drive_sync, "_md5", lambda p, *a: hashed.append(p) or real(p, *a))
+    assert _sync(tmp_path, [f]) == 0
+    assert hashed == [] and f.calls == 1
+    (tmp_path / f["title"]).write_bytes(GOOD[::-1])  # mesmo tamanho, conteúdo diferente → rebaixa
+    assert _sync(tmp_path, [f]) == 1
+    assert (tmp_path / f["title"]).read_bytes() == GOOD
+
+
+class FakeHttp:
+    """Responde pedidos Range de GOOD; falha uma vez depois do 1º bloco."""
+
+    def __init__(self):
+        self.ranges, self.failed = [], False
+
+    def request(self, url, headers):
+        a, b = map(int, headers["Range"].split("=")[1].split("-"))
+        self.ranges.append(a)
+        if a > 0 and not self.failed:
+            self.failed = True
+            raise IOError("timeout")
+        return SimpleNamespace(status=206), GOOD[a:b + 1]
+
+
+def test_retry_resumes_from_part(tmp_path):
+    http = FakeHttp()
+    f = FakeFile("vigiai_tile_0000_20240101.tif", [], size=len(GOOD), downloadUrl="https://drive/x")
+    f.auth = SimpleNamespace(Get_Http_Object=lambda: http)
+    out = tmp_path / f["title"]
+    assert drive_sync._download_one(f, out, retries=2, backoff=0, chunksize=4096) == len(GOOD)
+    assert out.read_bytes() == GOOD
+    assert http.ranges == [0, 4096, 4096]  # a nova tentativa continua do byte 4096, não do 0
+    assert not list(tmp_path.glob("*.part"))
@@ -0,0 +1,97 @@
+"""Monitoramento/submissão de tarefas do EE com tarefas falsas (sem rede nem credenciais)."""
+
+import asyncio
+from unittest import mock
+
+import pytest
+
+from scripts import data_processing as dp
+
+
+class StubTask:
+    """Tarefa do ee.batch: status() percorre 'states' (o último se repete)."""
+
+    def __init__(self, desc, states, board=None):
+        self.desc, self.states, self.i, self.board = desc, list(states), 0, board
+        self.id = f"T_{desc}"
+
+    def start(self):
+        if self.board is not None:
+            self.board["active"] += 1
+            self.board["peak"] = max(self.board["peak"], self.board["active"])
+
+    def status(self):
+        st = self.states[min(self.i, len(self.states) - 1)]
+        self.i += 1
+        if st in dp.TASK_DONE_STATES and self.board is not None and self.i == len(self.states):
+            self.board["active"] -= 1
+        return {"state": st, "description": self.desc}
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """Registra os intervalos de polling sem esperar de fato."""
+    seen, real = [], asyncio.sleep
+
+    async def _sleep(d, *a, **kw):
+        seen.append(d)
+        await real(0)
+    monkeypatch.setattr(dp.asyncio, "sleep", _sleep)
+    return seen
+
+
+def test_backoff_resets_on_state_change(delays):
+    t = StubTask("a", ["READY", "READY", "RUNNING", "RUNNING", "RUNNING", "RUNNING", "COMPLETED"])
+    [s] = asyncio.run(dp.monitor_tasks([t], initial_delay=1, factor=2, max_delay=3))
+    assert s["state"] == "COMPLETED"
+    assert delays == [1, 2, 1, 2, 3, 3]
+
+
+def test_hook_fires_once_per_finished_task(delays):
+    tasks = [StubTask("a", ["RUNNING", "COMPLETED"]), StubTask("b", ["RUNNING", "RUNNING", "FAILED"]),
+             StubTask("c", ["COMPLETED"])]
+    fired = []
+    res = asyncio.run(dp.monitor_tasks(tasks, on_done=lambda t, s: fired.append((t.desc, s["state"])),
+                                       initial_delay=0))
+    assert [s["state"] for s in res] == ["COMPLETED", "FAILED", "COMPLETED"]
+    assert sorted(fired) == [("a", "COMPLETED"), ("b", "FAILED"), ("c", "COMPLETED")]
+    assert sorted(d for d, st in fired if st == "COMPLETED") == ["a", "c"]
+
+
+def test_submit_respects_max_active(delays):
+    board = {"active": 0, "peak": 0}
+    jobs = [(f"t{i}", lambda i=i: StubTask(f"t{i}", ["READY", "RUNNING", "COMPLETED"], board)) for i in range(9)]
+    states, fired = {}, []
+    res = asyncio.run(dp.submit_tasks(jobs, max_active=3, on_done=lambda t, s: fired.append(s["description"]),
+                                      on_state=lambda d, t, s: states.setdefault(d, []).append(s["state"]),
+                                      initial_delay=0))
+    assert [s["description"] for s in res] == [f"t{i}" for i in range(9)]
+    assert all(s["state"] == "COMPLETED" for s in res)
+    assert board["peak"] == 3 and board["active"] == 0
+    assert sorted(fired) == sorted(d for d, _ in jobs)  # uma vez por tarefa
+    assert all(v == ["SUBMITTED", "COMPLETED"] for v in states.values())
+
+
+def test_submit_start_failure_is_reported(delays, monkeypatch):
+    class Broken(StubTask):
+        def start(self):
+            raise RuntimeError("quota")
+    monkeypatch.setattr(dp.time, "sleep", lambda s: None)
+    res = asyncio.run(dp.submit_tasks([("x", lambda: Broken("x", ["COMPLETED"]))], initial_delay=0))
+    assert res[0]["state"] == "FAILED" and "quota" in res[0]["error_message"]
+
+
+def test_plan_exports_uses_one_getinfo(monkeypatch):
+    fake = mock.MagicMock()
+    day = 1704067200000  # 2024-01-01 UTC
+    fake.List.return_value.getInfo.return_value = [[["S2/a", "S2/b"], [day, day]], [["S2/c"], [day]],
+                                                   [[], []], [["S2/d"], [day]]]
+    monkeypatch.setattr(dp, "ee", fake)
+    shards = dp.plan_exports(bbox=[-48.0, -16.0, -46.0, -14.0], start_date="2024-01-01", end_date="2024-02-01",
+                             max_tiles=2, shard_deg=1.0)
+    gets = [c for c in fake.mock_calls if c[0].endswith("getInfo")]
+    assert len(gets) == 1
+    assert [sh["id"] for sh in shards] == ["r00c00", "r00c01", "r01c00", "r01c01"]
+    assert [len(sh["images"]) for sh in shards] == [2, 1, 0, 1]
+    assert shards[0]["images"][1] == {"image_id": "S2/b", "date": "20240101",
+                                      "description": "vigiai_tile_r00c00_001_20240101"}